@@ -0,0 +1,77 @@
+"""数据库管道写入基准：每行 commit 对比后台批量写库线程
+
+python benchmarks/bench_db_writer.py [item数量]
+"""
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from setudownloader.pipelines import MEDIA_DONE
+from setudownloader.spiders.pixiv import PixivDBPipeline, PixivItem
+
+
+class OldPixivDBPipeline(PixivDBPipeline):
+    # 旧实现：reactor 线程上每行一次 commit
+    def insert(self, table, data):
+        sql = f"""
+            INSERT OR REPLACE INTO `{table}` ({','.join(data.keys())})
+            VALUES ({', '.join(['?']*len(data))});
+        """
+        self.cursor.execute(sql, tuple(data.values()))
+        self.connect.commit()
+
+
+class FakeSpider:
+    force = False
+
+    def log(self, *args, **kwargs):
+        pass
+
+
+def make_items(count):
+    upload_date = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    for i in range(count):
+        item = PixivItem()
+        item["user_id"] = i % 300
+        item["user_name"] = f"user{i % 300}"
+        item["illust_id"] = 100_000_000 + i
+        item["illust_title"] = f"title{i}"
+        item["illust_type"] = 0
+        item["page_count"] = 2
+        item["upload_date"] = upload_date
+        item["urls"] = [
+            f"https://i.pximg.net/img-original/img/2024/01/01/00/00/00/{100_000_000 + i}_p{p}.png"
+            for p in range(2)
+        ]
+        # 文件管道处理完的 item 带每个文件的下载结果
+        item["files"] = [{"page": p, "state": MEDIA_DONE, "path": f"{i}_p{p}.png", "size": 1024, "checksum": "0" * 32} for p in range(2)]
+        yield item
+
+
+def bench(pipeline_cls, count):
+    with tempfile.TemporaryDirectory() as tmp:
+        spider = FakeSpider()
+        pipeline = pipeline_cls(db_path=os.path.join(tmp, "pixiv.db"))
+        pipeline.open_spider(spider)
+        items = list(make_items(count))
+        t = time.perf_counter()
+        for item in items:
+            pipeline.process_item(item, spider)
+        process_time = time.perf_counter() - t
+        pipeline.close_spider(spider)
+        total_time = time.perf_counter() - t
+    return process_time, total_time
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50_000
+    for name, cls in (("per-row commit", OldPixivDBPipeline), ("SqliteWriter", PixivDBPipeline)):
+        process_time, total_time = bench(cls, count)
+        print(
+            f"{name:>15} | {count} items | reactor thread {count / process_time:9.0f} items/s | "
+            f"incl. final flush {count / total_time:9.0f} items/s"
+        )
@@ -0,0 +1,90 @@
+"""ehentai 页面解析基准：BeautifulSoup 对比 scrapy 自带的 lxml 选择器
+
+用 fixtures 里存的目录页（40张缩略图）和图片页，统计每页的 CPU 时间
+before 是原来 BeautifulSoup(features="lxml") 的写法，需要装 beautifulsoup4，没装就只跑 after
+
+python benchmarks/bench_ehentai_parse.py [次数]
+"""
+import sys
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+
+from scrapy.http import HtmlResponse
+from setudownloader.spiders.ehentai import PixivSpider as EHSpider
+
+FIXTURES = ROOT / "benchmarks" / "fixtures"
+GALLERY = (FIXTURES / "ehentai_gallery.html").read_bytes()
+IMAGE = (FIXTURES / "ehentai_image.html").read_bytes()
+KWARGS = {"gid": "2849352", "host": "exhentai", "title": "t", "title_jpn": "", "filecount": "84", "g_token": "a6e2be081b"}
+
+
+class NullWriter:
+    # 只测解析，目录页里的 token 不写库
+    def execute(self, sql, params=()):
+        pass
+
+
+def bs4_parse(body):
+    from bs4 import BeautifulSoup
+    bs = BeautifulSoup(body.decode("utf-8"), features="lxml")
+    return [thumb.find("a")["href"] for thumb in bs.find_all(class_="gdtm")]
+
+
+def bs4_sparse(body):
+    from bs4 import BeautifulSoup
+    bs = BeautifulSoup(body.decode("utf-8"), features="lxml")
+    url = bs.find(id="i3").find(id="img")["src"]
+    for _a in bs.find(id="i6").find_all("a"):
+        if "original" in _a.text:
+            url = _a["href"]
+            break
+    return url
+
+
+def spider_parse(spider, body):
+    response = HtmlResponse("https://exhentai.org/g/2849352/a6e2be081b/", body=body)
+    return [r.url for r in spider.parse(response, pages=list(range(1, 41)), **KWARGS)]
+
+
+def spider_sparse(spider, body):
+    response = HtmlResponse("https://exhentai.org/s/0123456789/2849352-3", body=body)
+    return [item["url"][0] for item in spider.sparse(response, page=3, m_token="0123456789", **KWARGS)][0]
+
+
+def timeit(func, rounds):
+    func()
+    began = time.process_time()
+    for _ in range(rounds):
+        func()
+    return (time.process_time() - began) / rounds * 1000
+
+
+def bench(rounds):
+    spider = EHSpider()
+    spider.writer = NullWriter()
+    spider.page_tokens = {}
+    cases = [
+        ("gallery", GALLERY, lambda: bs4_parse(GALLERY), lambda: spider_parse(spider, GALLERY)),
+        ("image", IMAGE, lambda: bs4_sparse(IMAGE), lambda: spider_sparse(spider, IMAGE)),
+    ]
+    try:
+        import bs4  # noqa: F401
+    except ImportError:
+        print("beautifulsoup4 not installed, skip before")
+        bs4 = None
+    print(f"{rounds} rounds, CPU ms per page")
+    for name, body, before, after in cases:
+        line = f"{name:>8} {len(body) // 1024:3} KiB | after {timeit(after, rounds):7.3f}ms"
+        if bs4:
+            # 两种写法解析出的链接要一致
+            assert sorted(before()) == sorted(after()) if name == "gallery" else before() == after()
+            ms = timeit(before, rounds)
+            line += f" | before {ms:7.3f}ms"
+        print(line)
+
+
+if __name__ == "__main__":
+    bench(int(sys.argv[1]) if len(sys.argv) > 1 else 200)
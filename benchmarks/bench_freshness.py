@@ -0,0 +1,143 @@
+"""新作品优先基准：STD_FRESHNESS_DAYS=0（按作者和翻页顺序下）对比按发布时间排优先级
+
+本地起 kemono 的接口，每个作者有几页旧作品和两个这几天发布的新作品，每个响应加固定延迟
+统计从开始到每个新作品的文件被下载的时间（平均/最晚），以及全部下完的总耗时
+
+python benchmarks/bench_freshness.py [作者数] [每个作者的旧作品数] [延迟ms]
+"""
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlparse
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+
+
+class LocalHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    posts = {}      # 作者: [作品，从新到旧]
+    files = {}
+    fresh = set()   # 新作品的文件路径
+    served = {}     # 新作品文件路径: 下载的时间
+    start = None
+    delay = 0
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        time.sleep(self.delay)
+        if LocalHandler.start is None:
+            LocalHandler.start = time.perf_counter()
+        if url.path == "/api/v1/creators.txt":
+            body, content_type = json.dumps([{"id": user, "service": "fanbox", "name": user, "updated": 1}
+                                             for user in self.posts]).encode(), "application/json"
+        elif url.path.startswith("/api/v1/fanbox/user/"):
+            offset = int(parse_qs(url.query).get("o", ["0"])[0])
+            posts = self.posts.get(url.path.rsplit("/", 1)[-1], [])
+            body, content_type = json.dumps(posts[offset:offset + 50]).encode(), "application/json"
+        else:
+            body, content_type = self.files.get(url.path), "image/png"
+            if url.path in self.fresh:
+                self.served.setdefault(url.path, time.perf_counter() - self.start)
+        if body is None:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def make_site(authors, backlog):
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    posts, files, fresh = {}, {}, set()
+    for a in range(authors):
+        user = str(100 + a)
+        dates = [now - timedelta(hours=a + 1), now - timedelta(days=2, hours=a)]
+        dates += [datetime(2023, 1, 1) - timedelta(days=i) for i in range(backlog)]
+        posts[user] = []
+        for i, date in enumerate(dates):
+            data = hashlib.sha256(f"{user}-{i}".encode()).digest() * 512
+            sha256 = hashlib.sha256(data).hexdigest()
+            path = f"/{sha256[:2]}/{sha256[2:4]}/{sha256}.png"
+            files["/data" + path] = data
+            if i < 2:
+                fresh.add("/data" + path)
+            posts[user].append({"id": str(10000 * (a + 1) + i), "user": user, "service": "fanbox", "title": f"post {i}",
+                                "content": "", "published": date.isoformat(timespec="seconds"), "file": {},
+                                "attachments": [{"name": "0.png", "path": path}]})
+    return posts, files, fresh
+
+
+def run_crawl(base, days, store, config):
+    # 子进程里跑，twisted 的 reactor 不能重启
+    os.environ["SCRAPY_SETTINGS_MODULE"] = "setudownloader.settings"
+    import stdownloader
+    from setudownloader.spiders.kemono import KemonoSpider
+
+    class LocalSites:
+        def process_request(self, request, spider):
+            if request.url.startswith("https://kemono.su"):
+                return request.replace(url=request.url.replace("https://kemono.su", base))
+
+    spidercls = type(KemonoSpider.__name__, (KemonoSpider,), {"custom_settings": {
+        **KemonoSpider.custom_settings,
+        "ITEM_PIPELINES": {"setudownloader.spiders.kemono.KemonoFilesPipeline": 300, "setudownloader.spiders.kemono.KemonoDBPipeline": 400},
+        "DOWNLOADER_MIDDLEWARES": {**KemonoSpider.custom_settings["DOWNLOADER_MIDDLEWARES"], LocalSites: 1},
+    }})
+    options = {
+        "FILES_STORE": store, "CONFIG_PATH": config, "STD_COOKIES_DIR": None, "STD_HTTPPROXY": None,
+        "LOG_LEVEL": "ERROR", "DOWNLOAD_DELAY": 0, "AUTOTHROTTLE_ENABLED": False, "STD_FRESHNESS_DAYS": days,
+    }
+    os.makedirs("log", exist_ok=True)
+    with open(os.devnull, "w") as devnull:
+        sys.stdout = devnull
+        stdownloader.crawl_many([spidercls], {}, options)
+
+
+def bench(authors, backlog, delay_ms):
+    posts, LocalHandler.files, LocalHandler.fresh = make_site(authors, backlog)
+    LocalHandler.posts = posts
+    LocalHandler.delay = delay_ms / 1000
+    server = ThreadingHTTPServer(("127.0.0.1", 0), LocalHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = f"http://127.0.0.1:{server.server_port}"
+    print(f"{authors} authors, {backlog} old + 2 new posts each, {delay_ms}ms per response")
+    for name, days in (("page order", 0), ("freshness", 7)):
+        LocalHandler.served, LocalHandler.start = {}, None
+        with tempfile.TemporaryDirectory() as tmp:
+            config = os.path.join(tmp, "config.json")
+            with open(config, "w") as f:
+                json.dump([{"path": user, "kemono": [["fanbox", user]]} for user in posts], f)
+            store = os.path.join(tmp, "downloads")
+            subprocess.run([sys.executable, __file__, "--crawl", base, str(days), store, config], cwd=tmp, check=True)
+            elapsed = time.perf_counter() - LocalHandler.start
+            downloaded = sum(1 for f in Path(store).rglob("*") if f.is_file())
+        served = sorted(LocalHandler.served.values())
+        mean = sum(served) / len(served) if served else float("nan")
+        print(f"{name:>10} | new works mean {mean:6.2f}s last {served[-1] if served else float('nan'):6.2f}s"
+              f" | all done {elapsed:6.2f}s | files {downloaded}/{len(LocalHandler.files)}")
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["--crawl"]:
+        run_crawl(sys.argv[2], float(sys.argv[3]), sys.argv[4], sys.argv[5])
+    else:
+        args = list(map(int, sys.argv[1:]))
+        defaults = [30, 150, 50]
+        bench(*(args + defaults[len(args):]))
@@ -0,0 +1,135 @@
+"""kemono 附件下载基准：CONCURRENT_ITEMS=1 逐个作品下载对比按字节额度同时下载多个作品的附件
+
+本地起一个 kemono 接口，每个作品若干张小图，每个响应加固定延迟模拟代理的往返时间
+统计耗时和子进程的最大内存
+
+python benchmarks/bench_kemono_concurrency.py [作品数] [每个作品的附件数] [附件KB] [延迟ms]
+"""
+import hashlib
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlparse
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+
+
+class KemonoHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    posts = []
+    files = {}
+    delay = 0
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        time.sleep(self.delay)
+        if url.path == "/api/v1/fanbox/user/1":
+            offset = int(parse_qs(url.query).get("o", ["0"])[0])
+            body, content_type = json.dumps(self.posts[offset:offset + 50]).encode(), "application/json"
+        else:
+            body, content_type = self.files.get(url.path.removeprefix("/data")), "image/png"
+        if body is None:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def make_posts(count, attachments, size):
+    posts, files = [], {}
+    for i in range(count):
+        post = {"id": str(1000 + i), "user": "1", "service": "fanbox", "title": f"post {i}", "content": "",
+                "published": f"2024-01-01T{i // 60 % 24:02d}:{i % 60:02d}:00", "file": {}, "attachments": []}
+        for j in range(attachments):
+            data = hashlib.sha256(f"{i}-{j}".encode()).digest() * (size // 32)
+            sha256 = hashlib.sha256(data).hexdigest()
+            path = f"/{sha256[:2]}/{sha256[2:4]}/{sha256}.png"
+            files[path] = data
+            post["attachments"].append({"name": f"{j}.png", "path": path})
+        posts.append(post)
+    posts.sort(key=lambda p: p["published"], reverse=True)
+    return posts, files
+
+
+def run_crawl(base, budget, store):
+    # 子进程里跑，twisted 的 reactor 不能重启
+    os.environ["SCRAPY_SETTINGS_MODULE"] = "setudownloader.settings"
+    from scrapy.crawler import CrawlerProcess
+    from scrapy.utils.project import get_project_settings
+    from setudownloader.spiders.kemono import KemonoSpider
+
+    class LocalKemono:
+        def process_request(self, request, spider):
+            if request.url.startswith("https://kemono.su"):
+                return request.replace(url=request.url.replace("https://kemono.su", base))
+
+    class BenchSpider(KemonoSpider):
+        custom_settings = {
+            **KemonoSpider.custom_settings,
+            "ITEM_PIPELINES": {
+                "setudownloader.spiders.kemono.KemonoFilesPipeline": 300,
+                "setudownloader.spiders.kemono.KemonoDBPipeline": 400,
+            },
+            "DOWNLOADER_MIDDLEWARES": {**KemonoSpider.custom_settings["DOWNLOADER_MIDDLEWARES"], LocalKemono: 1},
+            "LOG_FILE": None,
+            "LOG_LEVEL": "ERROR",
+        }
+        if not budget:  # 原来的做法：一次只处理一个作品
+            custom_settings["CONCURRENT_ITEMS"] = 1
+
+    settings = get_project_settings()
+    settings.setdict({
+        "FILES_STORE": store, "CONFIG_PATH": "", "STD_COOKIES_DIR": None, "STD_HTTPPROXY": None,
+        "DOWNLOAD_DELAY": 0, "AUTOTHROTTLE_ENABLED": False,
+        "STD_KEMONO_INFLIGHT_BYTES": budget,
+    })
+    process = CrawlerProcess(settings)
+    process.crawl(BenchSpider, sp_user="fanbox,1")
+    process.start()
+    with open(os.path.join(os.path.dirname(store), "rss"), "w") as f:
+        f.write(str(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024))
+
+
+def bench(count, attachments, size_kb, delay_ms):
+    KemonoHandler.posts, KemonoHandler.files = make_posts(count, attachments, size_kb * 1024)
+    KemonoHandler.delay = delay_ms / 1000
+    server = ThreadingHTTPServer(("127.0.0.1", 0), KemonoHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = f"http://127.0.0.1:{server.server_port}"
+    print(f"{count} posts x {attachments} attachments x {size_kb} KiB, {delay_ms}ms per response")
+    for budget in (0, 256 * 1024 * 1024):
+        with tempfile.TemporaryDirectory() as tmp:
+            store = os.path.join(tmp, "downloads")
+            t = time.perf_counter()
+            subprocess.run([sys.executable, __file__, "--crawl", base, str(budget), store], cwd=tmp, check=True)
+            elapsed = time.perf_counter() - t
+            downloaded = sum(1 for f in Path(store).rglob("*.png"))
+            rss = int(Path(tmp, "rss").read_text())
+        mode = "CONCURRENT_ITEMS=1" if not budget else f"budget {budget // 1024 // 1024} MiB"
+        print(f"{mode:>18} | {elapsed:7.2f}s | files {downloaded}/{len(KemonoHandler.files)} | max rss {rss} MiB")
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["--crawl"]:
+        run_crawl(sys.argv[2], int(sys.argv[3]), sys.argv[4])
+    else:
+        args = list(map(int, sys.argv[1:]))
+        defaults = [40, 10, 64, 100]
+        bench(*(args + defaults[len(args):]))
@@ -0,0 +1,83 @@
+"""查重阶段基准：逐个ID SELECT 对比预加载的 KnownIdIndex
+
+python benchmarks/bench_known_index.py [行数 ...]
+"""
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from setudownloader.database import KnownIdIndex
+
+
+def make_db(path, rows):
+    connect = sqlite3.connect(path)
+    connect.executescript("""
+        CREATE TABLE illust
+        (
+            id          INT NOT NULL ,
+            title       TEXT,
+            user_id     INT,
+            page_count  INT NOT NULL,
+            upload_date DATETIME NOT NULL,
+            type        INT NOT NULL,
+            PRIMARY KEY (id)
+        );
+    """)
+    ids = random.sample(range(rows * 4), rows)
+    connect.executemany(
+        "INSERT INTO illust VALUES (?, 'title', 1, 1, '2024-01-01 00:00:00+00:00', 0);",
+        ((i,) for i in ids),
+    )
+    connect.commit()
+    connect.close()
+    return ids
+
+
+def old_check(cursor, pid):
+    sql = f"SELECT * FROM illust WHERE id = {pid}"
+    result = cursor.execute(sql).fetchall()
+    if result:
+        if None in result[0]:
+            return False
+    return bool(result)
+
+
+def bench(rows):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "pixiv.db")
+        ids = make_db(path, rows)
+        # 一半已下载，一半新作品
+        pids = ids[: rows // 2] + [i + rows * 4 for i in range(rows // 2)]
+        random.shuffle(pids)
+
+        connect = sqlite3.connect(path)
+        cursor = connect.cursor()
+        t = time.perf_counter()
+        old_hits = sum(old_check(cursor, pid) for pid in pids)
+        old_time = time.perf_counter() - t
+
+        t = time.perf_counter()
+        index = KnownIdIndex.from_table(cursor, "illust", ("id",))
+        load_time = time.perf_counter() - t
+        t = time.perf_counter()
+        new_hits = sum(pid in index for pid in pids)
+        lookup_time = time.perf_counter() - t
+        connect.close()
+
+    assert old_hits == new_hits
+    print(
+        f"{rows:>9} rows | SELECT: {old_time:8.3f}s | "
+        f"index load: {load_time:6.3f}s lookup: {lookup_time:6.3f}s | "
+        f"speedup x{old_time / (load_time + lookup_time):6.1f} | "
+        f"index {index._ids.itemsize * len(index) / 1024 / 1024:6.1f} MiB"
+    )
+
+
+if __name__ == "__main__":
+    for rows in map(int, sys.argv[1:] or (10_000, 100_000, 1_000_000)):
+        bench(rows)
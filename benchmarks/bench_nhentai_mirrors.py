@@ -0,0 +1,141 @@
+"""nhentai 图片节点选择基准：固定用 i7 对比按延迟和速度分配节点
+
+每个图片节点起一个本地服务器，分别加上不同的响应延迟和单连接限速，i3 一直返回 503
+i7 模拟被限速的慢节点，统计下载整个画廊的耗时、每个节点分到的请求数和换节点次数
+
+python benchmarks/bench_nhentai_mirrors.py [页数] [每页KB]
+"""
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+
+GID, MEDIA_ID = 499947, "3000"
+# 节点: (响应延迟秒, 单连接速度 MiB/s, 是否故障)
+HOSTS = {
+    "i1.nhentai.net": (0.03, 16, False),
+    "i2.nhentai.net": (0.15, 8, False),
+    "i3.nhentai.net": (0.05, 16, True),
+    "i5.nhentai.net": (0.4, 2, False),
+    "i7.nhentai.net": (0.8, 1, False),
+}
+
+
+def make_handler(latency, rate, broken, pages, size):
+    class ImageHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        count = 0
+
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            type(self).count += 1
+            time.sleep(latency)
+            if self.path.startswith("/api/gallery/"):
+                body, content_type = json.dumps({
+                    "id": GID, "media_id": MEDIA_ID, "num_pages": pages, "title": {"english": "bench", "japanese": ""},
+                    "images": {"pages": [{"t": "j"}] * pages},
+                }).encode(), "application/json"
+            elif broken:
+                self.send_response(503)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            else:
+                body, content_type = b"\0" * size, "image/jpeg"
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            chunk = 64 * 1024
+            began = time.perf_counter()
+            for sent, i in enumerate(range(0, len(body), chunk), 1):
+                self.wfile.write(body[i:i + chunk])
+                delay = sent * chunk / (rate * 1024 * 1024) - (time.perf_counter() - began)
+                if delay > 0:
+                    time.sleep(delay)
+    return ImageHandler
+
+
+def run_crawl(ports, hosts, store):
+    # 子进程里跑，twisted 的 reactor 不能重启
+    os.environ["SCRAPY_SETTINGS_MODULE"] = "setudownloader.settings"
+    from scrapy.crawler import CrawlerProcess
+    from scrapy.utils.project import get_project_settings
+    from setudownloader.spiders.nhentai import PixivSpider as NHSpider
+
+    class LocalNodes:
+        # 在 NHDownloadMiddleware 选好节点之后再把域名换成本地端口
+        def process_request(self, request, spider):
+            for host, port in ports.items():
+                if f"://{host}/" in request.url:
+                    return request.replace(url=request.url.replace(f"https://{host}", f"http://127.0.0.1:{port}"))
+
+    class BenchSpider(NHSpider):
+        custom_settings = {
+            **NHSpider.custom_settings,
+            "ITEM_PIPELINES": {
+                "setudownloader.spiders.nhentai.NHFilesPipeline": 300,
+                "setudownloader.spiders.nhentai.NHDBPipeline": 400,
+            },
+            "DOWNLOADER_MIDDLEWARES": {**NHSpider.custom_settings["DOWNLOADER_MIDDLEWARES"], LocalNodes: 590},
+            "LOG_FILE": None,
+            "LOG_LEVEL": "ERROR",
+            "DOWNLOAD_DELAY": 0,
+            "CONCURRENT_REQUESTS": 4,
+        }
+
+    settings = get_project_settings()
+    settings.setdict({
+        "FILES_STORE": store, "CONFIG_PATH": "", "STD_COOKIES_DIR": None, "STD_HTTPPROXY": None,
+        "AUTOTHROTTLE_ENABLED": False, "STD_NHENTAI_IMAGE_HOSTS": hosts,
+    })
+    process = CrawlerProcess(settings)
+    crawler = process.create_crawler(BenchSpider)
+    process.crawl(crawler, url=f"https://nhentai.net/g/{GID}/")
+    process.start()
+    failover = crawler.stats.get_value("mirror/failover", 0)
+    with open(os.path.join(os.path.dirname(store), "failover"), "w") as f:
+        f.write(str(failover))
+
+
+def bench(pages, size_kb):
+    servers, handlers, ports = [], {}, {}
+    for host, (latency, rate, broken) in {**HOSTS, "nhentai.net": (0, 100, False)}.items():
+        handler = handlers[host] = make_handler(latency, rate, broken, pages, size_kb * 1024)
+        server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        ports[host] = server.server_port
+    print(f"{pages} pages x {size_kb} KiB")
+    for mode, hosts in (("i7 only", []), ("mirrors", list(HOSTS))):
+        for handler in handlers.values():
+            handler.count = 0
+        with tempfile.TemporaryDirectory() as tmp:
+            store = os.path.join(tmp, "downloads")
+            t = time.perf_counter()
+            subprocess.run([sys.executable, __file__, "--crawl", json.dumps(ports), json.dumps(hosts), store], cwd=tmp, check=True)
+            elapsed = time.perf_counter() - t
+            downloaded = sum(1 for _ in Path(store).rglob("*.jpg"))
+            failover = int(Path(tmp, "failover").read_text())
+        spread = " ".join(f"{host.split('.')[0]}:{handlers[host].count}" for host in HOSTS)
+        print(f"{mode:>8} | {elapsed:6.2f}s | files {downloaded}/{pages} | {spread} | failover {failover}")
+    for server in servers:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["--crawl"]:
+        run_crawl(json.loads(sys.argv[2]), json.loads(sys.argv[3]), sys.argv[4])
+    else:
+        args = list(map(int, sys.argv[1:]))
+        bench(args[0] if args else 60, args[1] if len(args) > 1 else 256)
@@ -0,0 +1,156 @@
+"""pixiv 元数据请求基准：逐个请求 /ajax/illust 对比按作者批量请求 /profile/illusts
+
+用 fixtures/pixiv_profile.json 里录好的作者作品数据起一个本地的 pixiv 接口和图片服务器，文件管道真的下载
+统计接口请求数、图片请求数（推算链接猜错扩展名的 404 也算在里面）、/pages 请求数和耗时
+
+python benchmarks/bench_pixiv_metadata.py [DOWNLOAD_DELAY]
+"""
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlparse
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+FIXTURE = json.loads((ROOT / "benchmarks" / "fixtures" / "pixiv_profile.json").read_text("utf-8"))
+# 图片服务器上真实存在的文件
+IMAGES = {urlparse(u).path for i in FIXTURE["illusts"].values() for u in i["originals"] + [i["ugoira"]] if u}
+
+
+def illust_body(pid):
+    work, illust = FIXTURE["works"][pid], FIXTURE["illusts"][pid]
+    return {
+        "illustId": pid, "illustTitle": work["title"], "title": work["title"], "illustType": work["illustType"],
+        "userId": work["userId"], "userName": work["userName"], "pageCount": work["pageCount"],
+        "createDate": work["createDate"], "uploadDate": illust["uploadDate"],
+        "urls": {"original": (illust["originals"] or [None])[0]},
+    }
+
+
+class PixivHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    paths = []
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        self.paths.append(url.path)
+        if url.path.startswith("/img-"):
+            self.send_image(url.path)
+            return
+        parts = url.path.strip("/").split("/")
+        works = FIXTURE["works"]
+        body = None
+        if url.path.endswith("/profile/all"):
+            illusts = {pid: None for pid, w in works.items() if w["illustType"] != 1}
+            manga = {pid: None for pid, w in works.items() if w["illustType"] == 1}
+            body = {"illusts": illusts, "manga": manga}
+        elif url.path.endswith("/profile/illusts"):
+            ids = parse_qs(url.query)["ids[]"]
+            body = {"works": {pid: works[pid] for pid in ids if pid in works}}
+        elif parts[:2] == ["ajax", "illust"] and len(parts) == 3:
+            body = illust_body(parts[2])
+        elif url.path.endswith("/pages"):
+            body = [{"urls": {"original": u}} for u in FIXTURE["illusts"][parts[2]]["originals"]]
+        elif url.path.endswith("/ugoira_meta"):
+            body = {"originalSrc": FIXTURE["illusts"][parts[2]]["ugoira"]}
+        data = json.dumps({"error": body is None, "message": "", "body": body}).encode()
+        self.send_response(200 if body is not None else 404)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_image(self, path):
+        data = path.encode() * 64 if path in IMAGES else b""
+        self.send_response(200 if data else 404)
+        self.send_header("Content-Type", "image/png")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def run_crawl(base, image_base, batch_size, delay, out):
+    # 子进程里跑，twisted 的 reactor 不能重启
+    os.environ["SCRAPY_SETTINGS_MODULE"] = "setudownloader.settings"
+    import scrapy.signals
+    from scrapy.crawler import CrawlerProcess
+    from scrapy.utils.project import get_project_settings
+    from setudownloader.spiders.pixiv import PixivSpider
+
+    class LocalPixiv:
+        def process_request(self, request, spider):
+            if request.url.startswith("https://www.pixiv.net"):
+                return request.replace(url=request.url.replace("https://www.pixiv.net", base))
+            if request.url.startswith("https://i.pximg.net"):
+                return request.replace(url=request.url.replace("https://i.pximg.net", image_base))
+
+    class BenchSpider(PixivSpider):
+        custom_settings = {
+            "ITEM_PIPELINES": {"setudownloader.spiders.pixiv.PixivFilesPipeline": 300, "setudownloader.spiders.pixiv.PixivDBPipeline": 400},
+            "DOWNLOADER_MIDDLEWARES": {LocalPixiv: 1},
+        }
+
+    settings = get_project_settings()
+    settings.setdict({
+        "LOG_LEVEL": "ERROR", "LOG_FILE": None, "CONFIG_PATH": "", "STD_COOKIES_DIR": None, "STD_HTTPPROXY": None,
+        "DOWNLOAD_DELAY": delay, "RANDOMIZE_DOWNLOAD_DELAY": False, "AUTOTHROTTLE_ENABLED": False,
+        "STD_PIXIV_BATCH_SIZE": batch_size, "FILES_STORE": "downloads",
+    })
+    items = []
+    process = CrawlerProcess(settings)
+    crawler = process.create_crawler(BenchSpider)
+
+    def collect(item, **kwargs):
+        items.append(dict(item))
+
+    for signal in (scrapy.signals.item_scraped, scrapy.signals.item_dropped):
+        crawler.signals.connect(collect, signal=signal)
+    process.crawl(crawler, sp_user=FIXTURE["user_id"])
+    process.start()
+
+    files = sum(1 for f in Path("downloads").rglob("*") if f.is_file())
+    with open(out, "w") as f:
+        json.dump({"items": len(items), "files": files}, f)
+
+
+def bench(delay):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), PixivHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    # 图片用 localhost，和接口不在同一个下载槽，跟 www.pixiv.net / i.pximg.net 一样各自算延迟
+    base = f"http://127.0.0.1:{server.server_port}"
+    image_base = f"http://localhost:{server.server_port}"
+    print(f"{len(FIXTURE['works'])} works, {len(IMAGES)} files, DOWNLOAD_DELAY={delay}")
+    for batch_size in (0, 48):
+        PixivHandler.paths.clear()
+        with tempfile.TemporaryDirectory() as tmp:
+            out = os.path.join(tmp, "result.json")
+            t = time.perf_counter()
+            subprocess.run([sys.executable, __file__, "--crawl", base, image_base, str(batch_size), str(delay), out], cwd=tmp, check=True)
+            elapsed = time.perf_counter() - t
+            result = json.load(open(out))
+        images = [p for p in PixivHandler.paths if p.startswith("/img-")]
+        missing = sum(1 for p in images if p not in IMAGES)
+        api = len(PixivHandler.paths) - len(images)
+        pages = sum(1 for p in PixivHandler.paths if p.endswith("/pages"))
+        mode = "per-illust" if batch_size == 0 else f"batch {batch_size}"
+        print(
+            f"{mode:>10} | api {api:4} (/pages {pages:3}) | images {len(images):4} (404 {missing:4}) | "
+            f"{elapsed:6.2f}s | items {result['items']} files {result['files']}/{len(IMAGES)}"
+        )
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["--crawl"]:
+        run_crawl(sys.argv[2], sys.argv[3], int(sys.argv[4]), float(sys.argv[5]), sys.argv[6])
+    else:
+        bench(float(sys.argv[1]) if len(sys.argv) > 1 else 0.05)
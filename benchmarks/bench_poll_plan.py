@@ -0,0 +1,103 @@
+"""检查计划基准：固定每 6 小时检查所有作者，对比按发布频率安排的检查计划
+
+模拟一批发布频率不同的作者（天更、周更、月更、几年没发），先生成 60 天的历史作品
+再模拟 30 天，统计两种做法发出的主页请求数，以及新作品从发布到被发现的平均/95分位延迟
+
+python benchmarks/bench_poll_plan.py [作者数] [天数]
+"""
+import random
+import sqlite3
+import sys
+from datetime import datetime, timezone
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+
+from setudownloader.planner import PollPlanner
+
+HOUR = 3600
+DAY = 24 * HOUR
+START = 1_700_000_000   # 模拟开始的时间戳
+# (比例, 平均几天发一次，None 是不再发了)
+KINDS = [(0.2, 1), (0.3, 7), (0.3, 30), (0.2, None)]
+
+
+class NullWriter:
+    def execute(self, sql, params=()):
+        pass
+
+
+class SimSpider:
+    # 只给 PollPlanner 提供数据库和发布历史
+    poll_plan = True
+
+    def __init__(self):
+        self.cursor = sqlite3.connect(":memory:").cursor()
+        self.writer = NullWriter()
+        self.known = {}     # 作者: [已经发现的作品发布时间]
+
+    def upload_history(self, limit):
+        return {author: [datetime.fromtimestamp(START + d, timezone.utc) for d in sorted(dates, reverse=True)[:limit]]
+                for author, dates in self.known.items()}
+
+
+def make_posts(count, days, seed=1):
+    rnd = random.Random(seed)
+    posts = {}
+    for i in range(count):
+        roll, kind = rnd.random(), None
+        for share, mean in KINDS:
+            roll -= share
+            if roll < 0:
+                kind = mean
+                break
+        dates, t = [], -60 * DAY - rnd.random() * 400 * DAY
+        if kind is None:    # 很久以前发过一些，然后不发了
+            dates = [t + j * 7 * DAY for j in range(10)]
+        else:
+            while t < days * DAY:
+                t += rnd.expovariate(1 / (kind * DAY))
+                dates.append(t)
+        posts[str(i)] = [d for d in dates if d < days * DAY]
+    return posts
+
+
+def simulate(posts, days, planned):
+    spider = SimSpider()
+    planner = PollPlanner(spider, 6 * HOUR, 14 * DAY)
+    fixed = 6 * HOUR
+    for author, dates in posts.items():
+        spider.known[author] = [d for d in dates if d < 0]
+        planner.checked[author] = START
+    requests, delays = 0, []
+    for now in range(HOUR, days * DAY + 1, HOUR):
+        if planned:
+            due = planner.due(posts, START + now)[0]
+        else:
+            due = [a for a in posts if START + now - planner.checked[a] >= fixed]
+        for author in due:
+            requests += 1
+            found = [d for d in posts[author] if planner.checked[author] - START <= d < now and d >= 0]
+            delays.extend(now - d for d in found)
+            spider.known[author].extend(found)
+            planner.checked[author] = START + now
+        planner.history = None
+    # 模拟结束时还没发现的作品按结束时间算延迟
+    for author, dates in posts.items():
+        delays.extend(days * DAY - d for d in dates if d >= planner.checked[author] - START)
+    delays.sort()
+    return requests, sum(delays) / len(delays) / HOUR, delays[int(len(delays) * 0.95)] / HOUR, len(delays)
+
+
+def bench(count, days):
+    posts = make_posts(count, days)
+    print(f"{count} authors, {days} days")
+    for name, planned in (("every 6h", False), ("planned", True)):
+        requests, mean, p95, works = simulate(posts, days, planned)
+        print(f"{name:>9} | requests {requests:6} | new works {works:5} | delay mean {mean:5.1f}h p95 {p95:5.1f}h")
+
+
+if __name__ == "__main__":
+    args = list(map(int, sys.argv[1:]))
+    bench(args[0] if args else 300, args[1] if len(args) > 1 else 30)
@@ -0,0 +1,138 @@
+"""多个爬虫基准：每个爬虫单独起一个进程依次跑，对比 stdownloader.py all 在一个进程里一起跑
+
+本地起 kemono 和 nhentai 的接口，每个响应加固定延迟模拟代理的往返时间
+依次跑时每个爬虫都要重新启动 scrapy，一个爬虫在等响应时另一个也用不上
+统计总耗时，一起跑时所有爬虫的下载并发加起来不超过 STD_GLOBAL_CONCURRENCY
+
+python benchmarks/bench_run_all.py [作品数] [画廊页数] [延迟ms]
+"""
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlparse
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+
+GID = 499947
+
+
+class LocalHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    posts = []
+    files = {}
+    gallery = b""
+    delay = 0
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        time.sleep(self.delay)
+        if url.path == "/api/v1/fanbox/user/1":
+            offset = int(parse_qs(url.query).get("o", ["0"])[0])
+            body, content_type = json.dumps(self.posts[offset:offset + 50]).encode(), "application/json"
+        elif url.path == f"/api/gallery/{GID}":
+            body, content_type = self.gallery, "application/json"
+        else:
+            body, content_type = self.files.get(url.path), "image/png"
+        if body is None:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def make_site(count, pages):
+    posts, files = [], {}
+    for i in range(count):
+        data = hashlib.sha256(str(i).encode()).digest() * 512
+        sha256 = hashlib.sha256(data).hexdigest()
+        path = f"/{sha256[:2]}/{sha256[2:4]}/{sha256}.png"
+        files["/data" + path] = data
+        posts.append({"id": str(1000 + i), "user": "1", "service": "fanbox", "title": f"post {i}", "content": "",
+                      "published": f"2024-01-01T{i // 60 % 24:02d}:{i % 60:02d}:00", "file": {},
+                      "attachments": [{"name": "0.png", "path": path}]})
+    posts.sort(key=lambda p: p["published"], reverse=True)
+    for i in range(1, pages + 1):
+        files[f"/galleries/3000/{i}.jpg"] = b"\0" * 16 * 1024
+    gallery = json.dumps({"id": GID, "media_id": "3000", "num_pages": pages, "title": {"english": "bench", "japanese": ""},
+                          "images": {"pages": [{"t": "j"}] * pages}}).encode()
+    return posts, files, gallery
+
+
+def run_crawl(base, names, store):
+    # 子进程里跑，twisted 的 reactor 不能重启
+    os.environ["SCRAPY_SETTINGS_MODULE"] = "setudownloader.settings"
+    import stdownloader
+    from setudownloader.spiders.kemono import KemonoSpider
+    from setudownloader.spiders.nhentai import PixivSpider as NHSpider
+
+    class LocalSites:
+        def process_request(self, request, spider):
+            for host in ("https://kemono.su", "https://nhentai.net", "https://i7.nhentai.net"):
+                if request.url.startswith(host):
+                    return request.replace(url=request.url.replace(host, base))
+
+    def local(spidercls, pipelines):
+        return type(spidercls.__name__, (spidercls,), {"custom_settings": {
+            **spidercls.custom_settings,
+            "ITEM_PIPELINES": {f"{spidercls.__module__}.{name}": 300 + i * 100 for i, name in enumerate(pipelines)},
+            "DOWNLOADER_MIDDLEWARES": {**spidercls.custom_settings["DOWNLOADER_MIDDLEWARES"], LocalSites: 1},
+        }})
+
+    spiders = {
+        "kemono": local(KemonoSpider, ["KemonoFilesPipeline", "KemonoDBPipeline"]),
+        "nhentai": local(NHSpider, ["NHFilesPipeline", "NHDBPipeline"]),
+    }
+    options = {
+        "FILES_STORE": store, "CONFIG_PATH": "", "STD_COOKIES_DIR": None, "STD_HTTPPROXY": None,
+        "LOG_LEVEL": "ERROR", "DOWNLOAD_DELAY": 0, "AUTOTHROTTLE_ENABLED": False, "STD_NHENTAI_IMAGE_HOSTS": [],
+    }
+    os.makedirs("log", exist_ok=True)
+    kwargs = {"sp_user": "fanbox,1", "url": f"https://nhentai.net/g/{GID}/"}
+    with open(os.devnull, "w") as devnull:
+        # 只要耗时，不打印结束时的汇总表
+        sys.stdout = devnull
+        stdownloader.crawl_many([spiders[name] for name in names], kwargs, options)
+
+
+def bench(count, pages, delay_ms):
+    LocalHandler.posts, LocalHandler.files, LocalHandler.gallery = make_site(count, pages)
+    LocalHandler.delay = delay_ms / 1000
+    server = ThreadingHTTPServer(("127.0.0.1", 0), LocalHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = f"http://127.0.0.1:{server.server_port}"
+    print(f"kemono {count} posts, nhentai {pages} pages, {delay_ms}ms per response")
+    for mode, runs in (("one by one", [["kemono"], ["nhentai"]]), ("all", [["kemono", "nhentai"]])):
+        with tempfile.TemporaryDirectory() as tmp:
+            store = os.path.join(tmp, "downloads")
+            t = time.perf_counter()
+            for names in runs:
+                subprocess.run([sys.executable, __file__, "--crawl", base, ",".join(names), store], cwd=tmp, check=True)
+            elapsed = time.perf_counter() - t
+            downloaded = sum(1 for f in Path(store).rglob("*") if f.is_file())
+        print(f"{mode:>10} | {elapsed:6.2f}s | files {downloaded}/{len(LocalHandler.files)}")
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["--crawl"]:
+        run_crawl(sys.argv[2], sys.argv[3].split(","), sys.argv[4])
+    else:
+        args = list(map(int, sys.argv[1:]))
+        defaults = [100, 100, 100]
+        bench(*(args + defaults[len(args):]))
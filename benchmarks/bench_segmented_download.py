@@ -0,0 +1,126 @@
+"""大文件下载基准：单连接流式下载对比分段下载
+
+本地起一个支持 Range 的 http 服务器，每个连接限速，模拟代理下单连接跑不满带宽的情况
+
+python benchmarks/bench_segmented_download.py [文件MB] [单连接限速MB/s] [分段数 ...]
+"""
+import hashlib
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    body = b""
+    rate = 0
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self.handle_request(head=True)
+
+    def do_GET(self):
+        self.handle_request()
+
+    def handle_request(self, head=False):
+        body = self.body if self.path == "/big.bin" else b"start"
+        start, end, status = 0, len(body) - 1, 200
+        match = re.match(r"bytes=(\d+)-(\d*)", self.headers.get("Range") or "")
+        if match:
+            start = int(match.group(1))
+            end = int(match.group(2)) if match.group(2) else end
+            status = 206
+        self.send_response(status)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("ETag", '"bench"')
+        if status == 206:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{len(body)}")
+        self.end_headers()
+        if head:
+            return
+        # 按连接限速
+        chunk = 64 * 1024
+        began = time.perf_counter()
+        for sent, i in enumerate(range(start, end + 1, chunk), 1):
+            self.wfile.write(body[i:min(i + chunk, end + 1)])
+            delay = sent * chunk / self.rate - (time.perf_counter() - began)
+            if delay > 0:
+                time.sleep(delay)
+
+
+def run_crawl(url, parts, store):
+    # 子进程里跑，twisted 的 reactor 不能重启
+    import scrapy
+    from scrapy.crawler import CrawlerProcess
+    from setudownloader.pipelines import BaseFilesPipeline
+
+    class BenchItem(scrapy.Item):
+        urls = scrapy.Field()
+        files = scrapy.Field()
+
+    class BenchSpider(scrapy.Spider):
+        name = "bench"
+        config = {}
+        start_urls = [url.replace("big.bin", "start")]
+
+        def parse(self, response):
+            yield BenchItem(urls=[url])
+
+    process = CrawlerProcess({
+        "ITEM_PIPELINES": {BaseFilesPipeline: 300},
+        "FILES_STORE": store,
+        "LOG_LEVEL": "ERROR",
+        "DOWNLOAD_HANDLERS": {"http": "setudownloader.handlers.StreamDownloadHandler"},
+        "DOWNLOAD_WARNSIZE": 0,
+        "DOWNLOAD_MAXSIZE": 0,
+        "CONCURRENT_REQUESTS_PER_DOMAIN": 8,
+        "STD_STREAM_DOWNLOAD": True,
+        "STD_SEGMENTED_DOWNLOAD": parts > 1,
+        "STD_SEGMENTED_MIN_SIZE": 1,
+        "STD_SEGMENTED_PARTS": parts,
+    })
+    process.crawl(BenchSpider)
+    process.start()
+
+
+def bench(size_mb, rate_mb, parts_list):
+    RangeHandler.body = os.urandom(size_mb * 1024 * 1024)
+    RangeHandler.rate = rate_mb * 1024 * 1024
+    md5 = hashlib.md5(RangeHandler.body).hexdigest()
+    server = ThreadingHTTPServer(("127.0.0.1", 0), RangeHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}/big.bin"
+    print(f"{size_mb} MiB file, {rate_mb} MiB/s per connection")
+    for parts in parts_list:
+        with tempfile.TemporaryDirectory() as store:
+            t = time.perf_counter()
+            subprocess.run([sys.executable, __file__, "--crawl", url, str(parts), store], check=True)
+            elapsed = time.perf_counter() - t
+            files = list(Path(store).rglob("*.bin"))
+            ok = len(files) == 1 and hashlib.md5(files[0].read_bytes()).hexdigest() == md5
+        mode = "single" if parts == 1 else f"{parts} parts"
+        print(f"{mode:>9} | {elapsed:7.2f}s | {size_mb / elapsed:7.2f} MiB/s | {'ok' if ok else 'FAIL'}")
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["--crawl"]:
+        run_crawl(sys.argv[2], int(sys.argv[3]), sys.argv[4])
+    else:
+        args = list(map(int, sys.argv[1:]))
+        size_mb = args[0] if args else 64
+        rate_mb = args[1] if len(args) > 1 else 8
+        bench(size_mb, rate_mb, args[2:] or (1, 2, 4, 8))
@@ -0,0 +1,91 @@
+import heapq
+import logging
+import os
+import time
+from scrapy import signals
+from scrapy.exceptions import DontCloseSpider, NotConfigured
+from setudownloader.define import NOTICE
+
+
+class AuthorScheduler:
+    # 常驻模式：爬虫跑完第一轮不关闭，reactor、连接池和 cookie 都留着
+    # 作者按 spider.planner 算的下次检查时间放在堆里，scrapy 空闲时（大约每5秒一次 spider_idle）把到期的作者交给爬虫检查
+    # config.json 改了就重新加载，新加的作者马上检查，删掉的作者出堆时丢掉
+    def __init__(self, crawler):
+        self.crawler = crawler
+        self.queue = []         # (下次检查的时间, 作者)
+        self.scheduled = set()  # 堆里的作者
+        self.active = False
+        self.seeded = False
+        self.config_mtime = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool("STD_DAEMON"):
+            raise NotConfigured
+        # ehentai 这种按地址下载的爬虫没有作者
+        if not getattr(crawler.spidercls, "author_checks", False):
+            raise NotConfigured
+        ext = cls(crawler)
+        crawler.signals.connect(ext.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(ext.spider_idle, signal=signals.spider_idle)
+        return ext
+
+    def spider_opened(self, spider):
+        if spider.sp_user or spider.sp_id:
+            spider.log("指定了作者或作品，常驻模式不检查 config 里的作者", logging.WARNING)
+            return
+        self.active = True
+        self.config_mtime = self._mtime(spider)
+
+    def _mtime(self, spider):
+        try:
+            return os.path.getmtime(spider.settings.get("CONFIG_PATH"))
+        except OSError:
+            return None
+
+    def _push(self, spider, authors, now=None):
+        # now 是刚交给爬虫检查的时间，检查还没完成、检查时间还没记下，先按这个时间排，请求失败的作者也不会马上又到期
+        for author in authors:
+            if author not in self.scheduled:
+                self.scheduled.add(author)
+                at = spider.planner.next_check(author) if now is None else now + spider.planner.interval(author, now)
+                heapq.heappush(self.queue, (at, author))
+
+    def _reload(self, spider):
+        mtime = self._mtime(spider)
+        if mtime is None or mtime == self.config_mtime:
+            return
+        self.config_mtime = mtime
+        config = spider.config
+        try:
+            spider._set_config()
+        except Exception as e:
+            spider._config = config
+            spider.log(f"config 重新加载失败，继续用原来的: {e!r}", logging.ERROR)
+            return
+        added = [author for author in spider.config if author not in self.scheduled]
+        spider.log(f"config 已重新加载，新增作者 {len(added)} 个", NOTICE)
+        self._push(spider, added)
+
+    def spider_idle(self, spider):
+        if not self.active:
+            return
+        if not self.seeded:
+            # 第一次空闲时 start_requests 已经检查完一轮，按检查过的时间排
+            self.seeded = True
+            self._push(spider, spider.config)
+        self._reload(spider)
+        now = time.time()
+        due = []
+        while self.queue and self.queue[0][0] <= now:
+            _, author = heapq.heappop(self.queue)
+            self.scheduled.discard(author)
+            if author in spider.config:
+                due.append(author)
+        if due:
+            spider.log(f"检查到期的作者 {len(due)} 个，还有 {len(self.queue)} 个在等", NOTICE)
+            for request in spider.check_authors(due):
+                self.crawler.engine.crawl(request)
+            self._push(spider, due, now)
+        raise DontCloseSpider
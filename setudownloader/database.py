@@ -0,0 +1,228 @@
+import atexit
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from itertools import groupby, islice
+from operator import lt
+
+logger = logging.getLogger(__name__)
+
+
+def upsert_sql(table, columns, keys=("id",)):
+    # 主键冲突时只更新给出的字段，不像 INSERT OR REPLACE 会把没给出的字段重置成默认值
+    updates = ", ".join(f"{c} = excluded.{c}" for c in columns if c not in keys)
+    return f"""
+        INSERT INTO `{table}` ({','.join(columns)})
+        VALUES ({', '.join(['?'] * len(columns))})
+        ON CONFLICT({','.join(keys)}) DO {f"UPDATE SET {updates}" if updates else "NOTHING"};
+    """
+
+
+class KnownIdIndex:
+    # 已入库ID索引，有序 int64 数组 + 二分查找，每个ID只占8字节，代替逐个ID去查库
+    # 联合主键 (gallery_id, page) 这种会打包成一个整数
+    PAGE_BITS = 20
+
+    def __init__(self, ids=()):
+        self._ids = array("q", sorted(set(map(self._key, ids))))
+
+    @classmethod
+    def pack(cls, id, page):
+        return (int(id) << cls.PAGE_BITS) | int(page)
+
+    @classmethod
+    def _key(cls, key):
+        if isinstance(key, tuple):
+            return cls.pack(*key)
+        return int(key)
+
+    @classmethod
+    def from_query(cls, cursor, sql, params=()):
+        # 直接构建数组，查询结果无序时再整体排序一次
+        index = cls()
+        rows = cursor.execute(sql, params)
+        if len(cursor.description) > 1:
+            index._ids.extend(cls.pack(*row) for row in rows)
+        else:
+            index._ids.extend(row[0] for row in rows)
+        ids = index._ids
+        if not all(map(lt, ids, islice(ids, 1, None))):
+            index._ids = array("q", sorted(set(ids)))
+        return index
+
+    @classmethod
+    def from_table(cls, cursor, table, columns):
+        # 某个字段为空的行不算已下载，理论上不会有字段为空，有就重新爬
+        fields = [row[1] for row in cursor.execute(f"PRAGMA table_info(`{table}`)")]
+        if not fields:
+            return cls()
+        where = " AND ".join(f"`{f}` IS NOT NULL" for f in fields)
+        keys = ", ".join(f"`{c}`" for c in columns)
+        return cls.from_query(cursor, f"SELECT {keys} FROM `{table}` WHERE {where};")
+
+    def __contains__(self, key):
+        key = self._key(key)
+        ids = self._ids
+        i = bisect_left(ids, key)
+        return i < len(ids) and ids[i] == key
+
+    def __len__(self):
+        return len(self._ids)
+
+    def add(self, key):
+        key = self._key(key)
+        ids = self._ids
+        if not ids or key > ids[-1]:    # 新作品ID一般是递增的
+            ids.append(key)
+            return
+        i = bisect_left(ids, key)
+        if i == len(ids) or ids[i] != key:
+            ids.insert(i, key)
+
+    def discard(self, key):
+        key = self._key(key)
+        ids = self._ids
+        i = bisect_left(ids, key)
+        if i < len(ids) and ids[i] == key:
+            del ids[i]
+
+
+class SqliteWriter(threading.Thread):
+    # 后台写库线程：写操作排队后在独立线程里 executemany 批量执行，按条数或时间合并提交
+    # 避免每行一次 commit(fsync) 卡住 twisted 的 reactor 线程
+    _FLUSH = object()
+    _STOP = object()
+    _TRANSACTION = object()
+
+    def __init__(self, db_path, batch_size=500, interval=1.0):
+        super().__init__(name=f"SqliteWriter-{os.path.basename(db_path)}", daemon=True)
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self.interval = interval
+        self._queue = queue.SimpleQueue()
+        self._closed = False
+        # 强制退出(连按两次 ctrl+c)时也把队列里的数据写完
+        atexit.register(self.close)
+
+    def execute(self, sql, params=()):
+        if self._closed:
+            raise RuntimeError(f"{self.name} is closed")
+        self._queue.put((sql, params))
+
+    def transaction(self, ops):
+        # 一组写操作 [(sql, params), ...] 放在同一个事务里，要么全部写入要么都不写
+        self.execute(self._TRANSACTION, list(ops))
+
+    def flush(self):
+        # 阻塞到队列里已有的写操作全部提交
+        if not self.is_alive():
+            return
+        done = threading.Event()
+        self._queue.put((self._FLUSH, done))
+        done.wait()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        atexit.unregister(self.close)
+        if self.is_alive():
+            self._queue.put((self._STOP, None))
+            self.join()
+
+    def run(self):
+        connect = sqlite3.connect(self.db_path, cached_statements=256)
+        connect.execute("PRAGMA journal_mode=WAL;")
+        connect.execute("PRAGMA synchronous=NORMAL;")
+        cursor = connect.cursor()
+        pending = 0
+        last_commit = time.monotonic()
+        op = None
+        try:
+            while True:
+                if op is None:
+                    timeout = max(0.0, self.interval - (time.monotonic() - last_commit)) if pending else None
+                    try:
+                        op = self._queue.get(timeout=timeout)
+                    except queue.Empty:
+                        connect.commit()
+                        pending, last_commit = 0, time.monotonic()
+                        continue
+
+                sql, params = op
+                op = None
+                if sql is self._FLUSH or sql is self._STOP:
+                    connect.commit()
+                    # 落盘：把 WAL 合并回主库
+                    connect.execute("PRAGMA wal_checkpoint(FULL);")
+                    pending, last_commit = 0, time.monotonic()
+                    if sql is self._STOP:
+                        break
+                    params.set()
+                    continue
+
+                if sql is self._TRANSACTION:
+                    self._run_transaction(cursor, params)
+                    pending += len(params)
+                    if pending >= self.batch_size or time.monotonic() - last_commit >= self.interval:
+                        connect.commit()
+                        pending, last_commit = 0, time.monotonic()
+                    continue
+
+                # 合并连续的同一条 sql 一起 executemany
+                batch = [params]
+                while len(batch) < self.batch_size:
+                    try:
+                        op = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if op[0] != sql:
+                        break
+                    batch.append(op[1])
+                    op = None
+                self._run_batch(cursor, sql, batch)
+                pending += len(batch)
+                if pending >= self.batch_size or time.monotonic() - last_commit >= self.interval:
+                    connect.commit()
+                    pending, last_commit = 0, time.monotonic()
+        finally:
+            cursor.close()
+            connect.close()
+
+    @staticmethod
+    def _begin(cursor):
+        # 没有打开的事务时 SAVEPOINT 自己就成了事务，RELEASE 时会单独提交，先 BEGIN 留给批量提交
+        if not cursor.connection.in_transaction:
+            cursor.execute("BEGIN;")
+
+    def _run_batch(self, cursor, sql, batch):
+        # 一批里有一行出错时 executemany 前面的行已经执行了，回滚这一批后逐行重写，只丢出错的行
+        self._begin(cursor)
+        cursor.execute("SAVEPOINT batch;")
+        try:
+            cursor.executemany(sql, batch)
+        except sqlite3.Error:
+            cursor.execute("ROLLBACK TO batch;")
+            for params in batch:
+                try:
+                    cursor.execute(sql, params)
+                except sqlite3.Error:
+                    logger.exception("%s write fail: %s %r", self.name, sql, params)
+        cursor.execute("RELEASE batch;")
+
+    def _run_transaction(self, cursor, ops):
+        # 用 savepoint 包起来，和其他写操作一起提交，出错时只回滚这一组
+        self._begin(cursor)
+        cursor.execute("SAVEPOINT tx;")
+        try:
+            for sql, group in groupby(ops, key=lambda op: op[0]):
+                cursor.executemany(sql, [params for _, params in group])
+        except sqlite3.Error:
+            cursor.execute("ROLLBACK TO tx;")
+            logger.exception("%s transaction fail: %s", self.name, ops[:1])
+        cursor.execute("RELEASE tx;")
@@ -0,0 +1,345 @@
+# 流式下载：文件类的响应不在内存里攒完整的 body，收到的数据块直接写到临时文件
+#
+# 在 settings.py 的 DOWNLOAD_HANDLERS 中启用，只对 meta 里带 stream_file 的请求生效
+# 中断的下载会留下 .part 文件，下次用 Range 请求续传
+
+import hashlib
+import json
+import logging
+import os
+import re
+import time
+from twisted.internet.defer import DeferredSemaphore, maybeDeferred
+from twisted.internet.task import deferLater
+from twisted.web.client import UNKNOWN_LENGTH
+from scrapy.core.downloader import Downloader
+from scrapy.core.downloader.handlers.http11 import HTTP11DownloadHandler, ScrapyAgent
+
+logger = logging.getLogger(__name__)
+
+class StreamFile:
+    # 流式下载的落盘目标，先写 .part 临时文件并增量计算 md5，校验通过后再改名到最终路径
+    # 下载中断时保留 .part 和服务器的 ETag/Last-Modified，下次用 Range + If-Range 续传
+    def __init__(self, path, expected_checksum=None):
+        self.path = str(path)
+        self.part_path = self.path + ".part"
+        self.meta_path = self.part_path + ".json"
+        self.expected_checksum = expected_checksum  # (算法, 值)，已知文件hash时最后校验
+        self.opened = False
+        self.invalid = False
+        self.resumed = False
+        self.expected_size = None
+        self.size = 0
+        self._file = None
+        self._hashes = {}
+
+    def prepare_request(self, request):
+        # 每次发出请求前调用（包括重试），有没下完的 .part 就续传
+        self.close()
+        request.headers.pop("Range", None)
+        request.headers.pop("If-Range", None)
+        offset = os.path.getsize(self.part_path) if os.path.exists(self.part_path) else 0
+        validator = self._load_meta().get("validator")
+        if offset and validator:
+            request.headers["Range"] = f"bytes={offset}-"
+            request.headers["If-Range"] = validator
+
+    def open(self, txresponse):
+        # 每次收到新的响应都调用（重试、重定向会复用同一个 StreamFile）
+        # 206 接着 .part 往后写，200 说明服务器不支持续传或文件变了，从头写
+        self.close()
+        os.makedirs(os.path.dirname(self.part_path), exist_ok=True)
+        offset = 0
+        self.invalid = False
+        self.expected_size = None if txresponse.length == UNKNOWN_LENGTH else txresponse.length
+        if txresponse.code == 206:
+            start, total = self._content_range(txresponse.headers)
+            part_size = os.path.getsize(self.part_path) if os.path.exists(self.part_path) else 0
+            if start is not None and start <= part_size:
+                offset = start
+                self.expected_size = total
+            else:
+                self.invalid = True
+        self._file = open(self.part_path, "r+b" if offset else "wb")
+        self._file.truncate(offset)
+        self._file.seek(offset)
+        self._reset_hashes()
+        if offset:
+            # 续传时把已有的部分重新算一遍hash
+            self._hash_part()
+        self.size = offset
+        self.resumed = bool(offset)
+        self.opened = True
+        self._save_meta(txresponse.headers)
+
+    def preallocate(self, size):
+        # 分段下载：先按文件大小占好位置，各段直接写到对应的偏移
+        self.discard()
+        os.makedirs(os.path.dirname(self.part_path), exist_ok=True)
+        with open(self.part_path, "wb") as f:
+            f.truncate(size)
+        self.expected_size = size
+        self.opened = True
+
+    def finish_segments(self):
+        # 分段全部下载完成后整体算一遍hash
+        self._reset_hashes()
+        self.size = self._hash_part()
+
+    def _reset_hashes(self):
+        self._hashes = {"md5": hashlib.md5()}
+        if self.expected_checksum:
+            self._hashes.setdefault(self.expected_checksum[0], hashlib.new(self.expected_checksum[0]))
+
+    def _hash_part(self):
+        size = 0
+        with open(self.part_path, "rb") as f:
+            while chunk := f.read(1024 * 1024):
+                for h in self._hashes.values():
+                    h.update(chunk)
+                size += len(chunk)
+        return size
+
+    def write(self, data):
+        self._file.write(data)
+        for h in self._hashes.values():
+            h.update(data)
+        self.size += len(data)
+
+    def getvalue(self):
+        # 响应读完时 scrapy 取 body，这里已经写到文件了，只返回空 body
+        self.close()
+        return b""
+
+    def truncate(self, size=0):
+        # 超过 DOWNLOAD_MAXSIZE 时 scrapy 会清空缓冲
+        if self._file:
+            self._file.truncate(size)
+
+    @property
+    def checksum(self):
+        return self._hashes["md5"].hexdigest() if self._hashes else None
+
+    def verify(self):
+        if not self.expected_checksum:
+            return True
+        algorithm, value = self.expected_checksum
+        return self._hashes[algorithm].hexdigest() == value.lower()
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
+    def commit(self):
+        self.close()
+        os.replace(self.part_path, self.path)
+        self._remove(self.meta_path)
+
+    def suspend(self):
+        # 下载失败，能续传就留着 .part
+        self.close()
+        self.opened = False
+        if self.invalid or not self._load_meta().get("validator"):
+            self.discard()
+
+    def discard(self):
+        self.close()
+        self._remove(self.part_path)
+        self._remove(self.meta_path)
+        self.opened = False
+
+    @staticmethod
+    def _remove(path):
+        if os.path.exists(path):
+            os.remove(path)
+
+    @staticmethod
+    def _content_range(headers):
+        # Content-Range: bytes 100-199/1000
+        value = (headers.getRawHeaders(b"content-range") or [b""])[0].decode("latin-1")
+        match = re.match(r"bytes (\d+)-\d+/(\d+|\*)", value)
+        if not match:
+            return None, None
+        total = match.group(2)
+        return int(match.group(1)), int(total) if total != "*" else None
+
+    def _load_meta(self):
+        try:
+            with open(self.meta_path, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_meta(self, headers):
+        validator = (headers.getRawHeaders(b"etag") or headers.getRawHeaders(b"last-modified") or [b""])[0]
+        # 弱 ETag 不能用于 If-Range
+        validator = validator.decode("latin-1")
+        if validator.startswith("W/"):
+            validator = ""
+        with open(self.meta_path, "w") as f:
+            json.dump({"validator": validator, "size": self.expected_size}, f)
+
+
+class SegmentFile:
+    # 分段下载中的一段 [start, end]，写到 StreamFile 预分配好的 .part 文件的对应位置
+    def __init__(self, part_path, start, end):
+        self.part_path = part_path
+        self.start = start
+        self.end = end
+        self.written = 0
+        self.opened = False
+        self.invalid = False
+        self._file = None
+
+    @property
+    def complete(self):
+        return not self.invalid and self.written == self.end - self.start + 1
+
+    def prepare_request(self, request):
+        # 重试时只请求这一段还没下载的部分
+        self.close()
+        request.headers["Range"] = f"bytes={self.start + self.written}-{self.end}"
+
+    def open(self, txresponse):
+        self.close()
+        start, _ = StreamFile._content_range(txresponse.headers)
+        # 服务器没按 Range 返回的数据不能写进文件
+        self.invalid = txresponse.code != 206 or start != self.start + self.written
+        self._file = open(self.part_path, "r+b")
+        self._file.seek(self.start + self.written)
+        self.opened = True
+
+    def write(self, data):
+        if self.invalid:
+            return
+        data = data[:self.end - self.start + 1 - self.written]
+        self._file.write(data)
+        self.written += len(data)
+
+    def getvalue(self):
+        self.close()
+        return b""
+
+    def truncate(self, size=0):
+        pass
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
+    suspend = discard = close
+
+
+class _StreamTxResponse:
+    # 包一层 twisted 的 response，读取 body 时把 _ResponseReader 的缓冲换成 StreamFile
+    def __init__(self, txresponse, stream):
+        self._txresponse = txresponse
+        self._stream = stream
+
+    def __getattr__(self, name):
+        return getattr(self._txresponse, name)
+
+    def deliverBody(self, protocol):
+        self._stream.open(self._txresponse)
+        protocol._bodybuf = self._stream
+        self._txresponse.deliverBody(protocol)
+
+
+class StreamAgent(ScrapyAgent):
+    def _cb_bodyready(self, txresponse, request):
+        stream = request.meta.get("stream_file")
+        if stream is not None:
+            if self._should_stream(txresponse):
+                txresponse = _StreamTxResponse(txresponse, stream)
+            elif txresponse.code == 416:    # .part 和服务器上的文件对不上
+                stream.discard()
+            else:   # 重定向、会重试的 5xx/429、错误页不写文件，能续传的 .part 留着
+                stream.suspend()
+        return super()._cb_bodyready(txresponse, request)
+
+    def _should_stream(self, txresponse):
+        # 错误页、文本提示（比如 ehentai 的额度不足）还是正常读到内存里
+        if txresponse.code not in (200, 206):
+            return False
+        content_type = txresponse.headers.getRawHeaders(b"content-type") or [b""]
+        return not content_type[0].startswith(b"text/")
+
+
+class StreamDownloadHandler(HTTP11DownloadHandler):
+    # STD_GLOBAL_CONCURRENCY：一个进程里同时跑几个爬虫时，所有爬虫加起来同时下载的请求数上限
+    # 每个爬虫的下载器只管自己的 CONCURRENT_REQUESTS，这里用进程内共享的信号量，真正发请求时才排队拿名额
+    # 在下载槽里等 DOWNLOAD_DELAY 的请求不占名额
+    global_slots = None
+
+    @classmethod
+    def set_global_limit(cls, limit):
+        # 一个进程只建一次，crawl_many 启动前按进程的设置建好，后面的爬虫都用这一个
+        if cls.global_slots is None and limit > 0:
+            cls.global_slots = DeferredSemaphore(limit)
+
+    def __init__(self, settings, crawler=None):
+        super().__init__(settings, crawler)
+        limit = settings.getint("STD_GLOBAL_CONCURRENCY")
+        if limit > 0:
+            StreamDownloadHandler.set_global_limit(limit)
+            if StreamDownloadHandler.global_slots.limit != limit:
+                logger.warning("STD_GLOBAL_CONCURRENCY=%d 和进程里其他爬虫的 %d 不一样，按 %d 算",
+                               limit, StreamDownloadHandler.global_slots.limit, StreamDownloadHandler.global_slots.limit)
+            self.global_slots = StreamDownloadHandler.global_slots
+        else:
+            self.global_slots = None
+        self._next_send = {}    # 下载槽: 下一个请求最早什么时候发
+
+    def download_request(self, request, spider):
+        if self.global_slots is None:
+            return self._download(request, spider)
+        dfd = self.global_slots.acquire()
+        dfd.addCallback(self._send, request, spider)
+        return dfd
+
+    def _send(self, _, request, spider):
+        # 排队等名额时下载槽还在按 DOWNLOAD_DELAY 往外放请求，同一个槽的几个请求可能一起拿到名额，发出前补上间隔
+        from twisted.internet import reactor
+
+        wait = self._reserve(request)
+        if wait > 0:
+            dfd = deferLater(reactor, wait, self._download, request, spider)
+        else:
+            dfd = maybeDeferred(self._download, request, spider)
+        return dfd.addBoth(self._release)
+
+    def _reserve(self, request):
+        downloader = self._crawler.engine.downloader if self._crawler else None
+        key = request.meta.get(Downloader.DOWNLOAD_SLOT)
+        slot = downloader.slots.get(key) if downloader and key is not None else None
+        if slot is None or not slot.delay:
+            return 0
+        # 随机延迟最短是 0.5 倍
+        delay = slot.delay * 0.5 if slot.randomize_delay else slot.delay
+        now = time.monotonic()
+        # 时间已经过了的槽不用记，kemono 每个数据节点一个槽，常驻模式下会越来越多
+        for passed in [k for k, t in self._next_send.items() if t <= now]:
+            del self._next_send[passed]
+        at = max(now, self._next_send.get(key, 0))
+        self._next_send[key] = at + delay
+        return at - now
+
+    def _release(self, result):
+        self.global_slots.release()
+        return result
+
+    def _download(self, request, spider):
+        stream = request.meta.get("stream_file")
+        if stream is not None:
+            stream.prepare_request(request)
+        agent = StreamAgent(
+            contextFactory=self._contextFactory,
+            pool=self._pool,
+            maxsize=getattr(spider, "download_maxsize", self._default_maxsize),
+            warnsize=getattr(spider, "download_warnsize", self._default_warnsize),
+            fail_on_dataloss=self._fail_on_dataloss,
+            crawler=self._crawler,
+        )
+        return agent.download_request(request)
@@ -5,28 +5,82 @@
 
 
 # useful for handling different item types with a single interface
+import heapq
 import json
 import logging
 import os
 import re
+import shutil
 import sqlite3
 import enlighten
+from itertools import count
 from itemadapter import ItemAdapter
 import scrapy
-from scrapy.pipelines.files import FilesPipeline, FileException
+from scrapy.pipelines.files import FilesPipeline, FileException, FSFilesStore
 from scrapy.exceptions import DropItem
 from scrapy.utils.log import failure_to_exc_info
 from scrapy.utils.request import referer_str
 from scrapy.settings import Settings
+from scrapy.http.request import NO_CALLBACK
 import scrapy.signals
 import setudownloader.signals
+from setudownloader.database import KnownIdIndex, SqliteWriter, upsert_sql
+from setudownloader.handlers import SegmentFile, StreamFile
+from twisted.internet.defer import Deferred, DeferredList
 
 logger = logging.getLogger(__name__)
 
+# media 表中每个文件的下载状态
+MEDIA_PENDING = "pending"
+MEDIA_DONE = "done"
+MEDIA_FAILED = "failed"
+MEDIA_404 = "404"
+# 老数据库补上的文件状态字段，之前入库的都是下载完成的
+MEDIA_STATE_COLUMNS = {
+    "state": f"TEXT NOT NULL DEFAULT '{MEDIA_DONE}'",
+    "size": "INT",
+    "checksum": "TEXT",
+}
+
+def link_file(src, dst):
+    # 同一个文件放到另一个位置：优先硬链接，跨分区时试 reflink（btrfs/xfs），都不行就复制
+    # 先放到临时文件再改名，失败时 dst 不会留下空的或不完整的文件，下次被当成已经下载过
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    tmp = dst + ".link"
+    try:
+        method = _link_to(src, tmp)
+        os.replace(tmp, dst)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return method
+
+
+def _link_to(src, tmp):
+    if os.path.exists(tmp):     # 上次中断留下的
+        os.remove(tmp)
+    try:
+        os.link(src, tmp)
+        return "hardlink"
+    except OSError:
+        pass
+    try:
+        import fcntl
+        with open(src, "rb") as fsrc, open(tmp, "wb") as fdst:
+            fcntl.ioctl(fdst.fileno(), 0x40049409, fsrc.fileno())   # FICLONE
+        return "reflink"
+    except (ImportError, OSError):
+        pass
+    shutil.copyfile(src, tmp)
+    return "copy"
+
+
 class SqlitePipeline:
     db_path: str
+    # 打开时预加载的已入库ID索引 {索引名: (表名, (主键字段, ...))}
+    index_tables: dict = {}
 
-    def __init__(self, db_path=None):
+    def __init__(self, db_path=None, batch_size=500, commit_interval=1.0):
         if db_path is not None:
             self.db_path = db_path
         elif not getattr(self, "db_path", None):
@@ -34,28 +88,115 @@ class SqlitePipeline:
         directory_path = os.path.dirname(self.db_path)
         if not os.path.exists(directory_path):
             os.makedirs(directory_path)
+        self.batch_size = batch_size
+        self.commit_interval = commit_interval
+        self._insert_sql = {}
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(
+            batch_size=crawler.settings.getint("STD_DB_BATCH_SIZE", 500),
+            commit_interval=crawler.settings.getfloat("STD_DB_COMMIT_INTERVAL", 1.0),
+        )
 
     def open_spider(self, spider):
+        # 主连接只做建表和读，写操作都交给后台写库线程
         self.connect = sqlite3.connect(self.db_path)
+        self.connect.execute("PRAGMA journal_mode=WAL;")
         self.cursor = self.connect.cursor()
         spider.cursor = self.cursor
         spider.connect = self.connect
         spider.db_path = self.db_path
+        self.build()
+        self.connect.commit()
+        self.index = spider.index = self.load_index(spider)
+        self.writer = spider.writer = SqliteWriter(self.db_path, self.batch_size, self.commit_interval)
+        self.writer.start()
+
+    def build(self):
+        pass
+
+    def add_columns(self, table, columns: dict):
+        # 给老数据库补字段，新字段要同时加到建库语句里
+        fields = {row[1] for row in self.cursor.execute(f"PRAGMA table_info(`{table}`)")}
+        for name, define in columns.items():
+            if name not in fields:
+                self.cursor.execute(f"ALTER TABLE `{table}` ADD COLUMN {name} {define};")
+
+    def load_index(self, spider):
+        # 强制下载时不需要查重
+        if getattr(spider, "force", False):
+            return {name: KnownIdIndex() for name in self.index_tables}
+        return {
+            name: KnownIdIndex.from_table(self.cursor, table, columns)
+            for name, (table, columns) in self.index_tables.items()
+        }
 
     def process_item(self, item, spider):
         return item
 
     def close_spider(self, spider):
+        self.writer.close()
         self.cursor.close()
         self.connect.close()
 
     def insert(self, table: str, data: dict):
-        sql = f"""
-            INSERT OR REPLACE INTO `{table}` ({','.join(data.keys())})
-            VALUES ({', '.join(['?']*len(data))});
-        """
-        self.cursor.execute(sql, tuple(data.values()))
-        self.connect.commit()
+        # 同样的表和字段复用同一条sql，sqlite会缓存编译好的语句
+        key = (table, tuple(data))
+        sql = self._insert_sql.get(key)
+        if sql is None:
+            sql = self._insert_sql[key] = f"""
+                INSERT OR REPLACE INTO `{table}` ({','.join(data.keys())})
+                VALUES ({', '.join(['?']*len(data))});
+            """
+        self.writer.execute(sql, tuple(data.values()))
+
+    def upsert(self, table: str, data: dict, keys=("id",)):
+        key = (table, tuple(data), keys)
+        sql = self._insert_sql.get(key)
+        if sql is None:
+            sql = self._insert_sql[key] = upsert_sql(table, tuple(data), keys)
+        self.writer.execute(sql, tuple(data.values()))
+
+    def media_states(self, item, count):
+        # 本次处理的每一页的下载状态 {页码: {"state", "size", "checksum"}}，续传时只有缺的页
+        pages = item.get("pages")
+        if pages is None:
+            pages = range(count)
+        if "files" not in item:
+            # 没经过文件管道的 item 不按文件状态判断，和以前一样按下载完记
+            done = {"state": MEDIA_DONE, "size": None, "checksum": None}
+            return {page: done for page in pages}
+        files = {f["page"]: f for f in item["files"]}
+        pending = {"state": MEDIA_PENDING, "size": None, "checksum": None}
+        return {page: files.get(page, pending) for page in pages}
+
+    def is_incomplete(self, states):
+        return any(s["state"] in (MEDIA_PENDING, MEDIA_FAILED) for s in states.values())
+
+
+class PriorityGate:
+    # 同时下载的文件数上限，超过时按请求的优先级排队，优先级一样的先来先下
+    def __init__(self, limit):
+        self.limit = limit
+        self.active = 0
+        self.waiting = []   # (-优先级, 序号, Deferred)
+        self.seq = count()
+
+    def acquire(self, priority=0):
+        dfd = Deferred()
+        heapq.heappush(self.waiting, (-priority, next(self.seq), dfd))
+        self._admit()
+        return dfd
+
+    def release(self):
+        self.active -= 1
+        self._admit()
+
+    def _admit(self):
+        while self.waiting and self.active < self.limit:
+            self.active += 1
+            heapq.heappop(self.waiting)[2].callback(None)
 
 
 class BaseFilesPipeline(FilesPipeline):
@@ -66,26 +207,249 @@ class BaseFilesPipeline(FilesPipeline):
         if isinstance(settings, dict) or settings is None:
             settings = Settings(settings)
         self.ignore_404_error = settings.getbool("STD_IGNORE_FILES_DOWNLOAD_ON_404")
+        self.stream_download = settings.getbool("STD_STREAM_DOWNLOAD")
+        self.segmented_download = settings.getbool("STD_SEGMENTED_DOWNLOAD")
+        self.segmented_min_size = settings.getint("STD_SEGMENTED_MIN_SIZE", 64 * 1024 * 1024)
+        self.segmented_parts = max(settings.getint("STD_SEGMENTED_PARTS", 4), 1)
+        # 文件请求由管道直接交给下载器，不经过调度队列，按先来后到下载，请求的优先级不起作用
+        # 按新旧排的时候文件在这里按优先级排队，新作品的文件先下
+        limit = settings.getint("STD_FILES_CONCURRENCY")
+        self.gate = PriorityGate(limit) if settings.getfloat("STD_FRESHNESS_DAYS") > 0 and limit > 0 else None
+
+    @property
+    def config(self):
+        # 常驻模式重新加载 config.json 后 spider.config 是新的字典，每次都从爬虫上取
+        return self.crawler.spider.config
+
+    # item 中所有文件链接的字段
+    urls_field = "urls"
+
+    def iter_media(self, item):
+        # (页码, 链接)，item 有 pages 时只下载这些页
+        pages = item.get("pages")
+        for page, url in enumerate(item[self.urls_field]):
+            if pages is None or page in pages:
+                yield page, url
+
+    def media_priority(self, item, info):
+        # 文件请求的优先级，不是 BaseSpider 的爬虫没有 fresh_priority，都按 0
+        fresh_priority = getattr(info.spider, "fresh_priority", None)
+        return fresh_priority(item.get("upload_date")) if fresh_priority else 0
+
+    def get_media_requests(self, item, info):
+        priority = self.media_priority(item, info)
+        return [scrapy.Request(u, callback=NO_CALLBACK, priority=priority) for _, u in self.iter_media(item)]
 
-    def open_spider(self, spider):
-        super().open_spider(spider)
-        self.config = spider.config
-    
     def item_completed(self, results, item, info):
-        # 下载完成后，验证下载成功
-        for ok, value in results:
-            if not ok:
-                logger.error(
-                    "%(class)s found errors processing",
-                    {"class": self.__class__.__name__},
-                    exc_info=failure_to_exc_info(value),
-                    extra={"spider": info.spider},
-                )
+        # 下载完成后，记录每个文件的状态
+        # item 有 files 字段时失败的文件也交给数据库管道记录，下次只补下载缺的文件
+        keep_state = self.files_result_field in item.fields
+        files = []
+        for (ok, value), (page, _) in zip(results, self.iter_media(item)):
+            if ok:
+                files.append({
+                    "page": page,
+                    "state": MEDIA_404 if value["status"] == "404" else MEDIA_DONE,
+                    "path": value["path"] or None,
+                    "size": value.get("size"),
+                    "checksum": value["checksum"] or None,
+                })
+                continue
+            logger.error(
+                "%(class)s found errors processing",
+                {"class": self.__class__.__name__},
+                exc_info=failure_to_exc_info(value),
+                extra={"spider": info.spider},
+            )
+            if not keep_state:
                 raise DropItem("download fail")
+            files.append({"page": page, "state": MEDIA_FAILED, "path": None, "size": None, "checksum": None})
+        if keep_state:
+            item[self.files_result_field] = files
         return item
+
+    def is_complete(self, item):
+        return all(f["state"] != MEDIA_FAILED for f in item.get(self.files_result_field) or ())
     
+    def media_to_download(self, request, info, *, item=None):
+        dfd = super().media_to_download(request, info, item=item)
+        dfd.addCallback(self._reuse_media, request, info, item)
+        dfd.addCallback(self._wait_turn, request)
+        dfd.addCallback(self._prepare_stream, request, info, item)
+        dfd.addBoth(self._pass_gate, request)
+        return dfd
+
+    def _wait_turn(self, result, request):
+        # 要下载的文件先排队，响应回来后在 media_downloaded/media_failed 里放行下一个
+        if result is not None or self.gate is None:
+            return result
+        request.meta["gate_slot"] = True
+        return self.gate.acquire(request.priority).addCallback(lambda _: None)
+
+    def _pass_gate(self, result, request):
+        # 分段下载完了或者准备下载时出错，不会再走 media_downloaded/media_failed，这里就放行
+        if result is not None:
+            self.leave_gate(request)
+        return result
+
+    def leave_gate(self, request):
+        if request.meta.pop("gate_slot", False):
+            self.gate.release()
+
+    def _reuse_media(self, result, request, info, item):
+        if result is None:
+            return self.reuse_media(request, info, item)
+        return result
+
+    def reuse_media(self, request, info, item):
+        # 本地已经有同一个文件时返回下载结果，不再发请求，返回 None 正常下载
+        return None
+
+    def _prepare_stream(self, result, request, info, item):
+        # 需要下载时，告诉下载器直接把响应写到文件里
+        if result is None and self.stream_download and isinstance(self.store, FSFilesStore):
+            path = self.file_path(request, info=info, item=item)
+            stream = request.meta["stream_file"] = StreamFile(
+                self.store._get_filesystem_path(path),
+                expected_checksum=self.expected_checksum(request, item),
+            )
+            # 有上次没下完的 .part 就按单连接续传
+            if self.segmented_download and not os.path.exists(stream.part_path):
+                return self._try_segmented(request, info, item, stream)
+        return result
+
+    def _try_segmented(self, request, info, item, stream):
+        # 先用 HEAD 拿文件大小，够大并且服务器支持 Range 才分段下载，否则返回 None 走普通下载
+        head = scrapy.Request(request.url, method="HEAD", headers=request.headers, callback=NO_CALLBACK, dont_filter=True)
+        dfd = self.crawler.engine.download(head)
+        dfd.addCallback(self._download_segments, request, info, item, stream)
+        dfd.addErrback(self._segments_failed, request, info, stream)
+        return dfd
+
+    def _download_segments(self, response, request, info, item, stream):
+        size = int(response.headers.get("Content-Length") or 0)
+        if response.status != 200 or response.headers.get("Accept-Ranges") != b"bytes" or size < self.segmented_min_size:
+            return None
+        stream.preallocate(size)
+        step = -(-size // self.segmented_parts)
+        bar_name = request.meta.get("progress_bar_name")
+        segments = []
+        for i, start in enumerate(range(0, size, step)):
+            segment = SegmentFile(stream.part_path, start, min(start + step, size) - 1)
+            meta = {"stream_file": segment}
+            if bar_name:    # 每一段一个进度条
+                meta["progress_bar_name"] = f"{bar_name}#{i + 1}"
+            # 重定向后的地址直接用，每段不用再跳一次
+            segment_request = scrapy.Request(response.url, headers=request.headers, meta=meta, callback=NO_CALLBACK, dont_filter=True)
+            dfd = self.crawler.engine.download(segment_request)
+            dfd.addCallback(self._check_segment, segment)
+            segments.append(dfd)
+        logger.debug("segmented download %s: %d bytes, %d parts", request.url, size, len(segments), extra={"spider": info.spider})
+        # 有一段失败时也要等其他段结束，不然删掉 .part 后还在下载的段打不开文件
+        dfd = DeferredList(segments, consumeErrors=True)
+        dfd.addCallback(self._segments_settled)
+        dfd.addCallback(self._segments_done, response, request, info, item, stream)
+        return dfd
+
+    def _segments_settled(self, results):
+        for ok, value in results:
+            if not ok:
+                return value
+        return results
+
+    def _check_segment(self, response, segment):
+        if not segment.complete:
+            raise FileException(f"segment-error: {response.status} {response.url}")
+        return response
+
+    def _segments_done(self, results, response, request, info, item, stream):
+        stream.finish_segments()
+        info.spider.crawler.stats.inc_value("file_status_count/segmented", spider=info.spider)
+        return self.stream_downloaded(stream, response, request, info, item=item)
+
+    def _segments_failed(self, failure, request, info, stream):
+        # 分段下载的 .part 没法续传，所有段都结束后直接删掉
+        stream.discard()
+        logger.warning(
+            "File (segmented): Error downloading file from %(request)s referred in <%(referer)s>: %(error)s",
+            {"request": request, "referer": referer_str(request), "error": failure.getErrorMessage()},
+            extra={"spider": info.spider},
+        )
+        return failure
+
+    def expected_checksum(self, request, item):
+        # 已知文件 hash 时返回 (算法, 值)，下载完成后校验
+        return None
+
+    def media_failed(self, failure, request, info):
+        self.leave_gate(request)
+        stream = request.meta.get("stream_file")
+        if stream is not None:
+            stream.suspend()
+        return super().media_failed(failure, request, info)
+
     def media_downloaded(self, response, request, info, *, item=None):
+        self.leave_gate(request)
+        stream = request.meta.get("stream_file")
+        if stream is not None and stream.opened:
+            return self.stream_downloaded(stream, response, request, info, item=item)
+        return self.body_downloaded(response, request, info, item=item)
+
+    def stream_downloaded(self, stream, response, request, info, *, item=None):
+        # 流式下载的文件已经在 .part 里了，校验大小后改名到最终路径
+        referer = referer_str(request)
+        if not stream.size:
+            stream.discard()
+            logger.warning(
+                "File (empty-content): Empty file from %(request)s referred "
+                "in <%(referer)s>: no-content",
+                {"request": request, "referer": referer},
+                extra={"spider": info.spider},
+            )
+            raise FileException("empty-content")
+
+        if stream.invalid or (stream.expected_size is not None and stream.size != stream.expected_size):
+            stream.suspend()
+            logger.warning(
+                "File (code: %(status)s): Error downloading file from "
+                "%(request)s referred in <%(referer)s>",
+                {"status": response.status, "request": request, "referer": referer},
+                extra={"spider": info.spider},
+            )
+            raise FileException("download-content-not-enough")
+
+        if not stream.verify():
+            stream.discard()
+            logger.warning(
+                "File (checksum-mismatch): Error downloading file from "
+                "%(request)s referred in <%(referer)s>",
+                {"request": request, "referer": referer},
+                extra={"spider": info.spider},
+            )
+            raise FileException("checksum-mismatch")
+
+        path = self.file_path(request, response=response, info=info, item=item)
+        stream.commit()
+        self.inc_stats(info.spider, "downloaded")
+        if stream.resumed:
+            info.spider.crawler.stats.inc_value("file_status_count/resumed", spider=info.spider)
+        return {
+            "url": request.url,
+            "path": path,
+            "checksum": stream.checksum,
+            "status": "downloaded",
+            "size": stream.size,
+        }
+
+    def body_downloaded(self, response, request, info, *, item=None):
         referer = referer_str(request)
+        stream = request.meta.get("stream_file")
+
+        if response.status == 416 and stream is not None:
+            # .part 和服务器上的文件对不上，删掉重新完整下载
+            stream.discard()
+            dfd = self.crawler.engine.download(request)
+            return dfd.addCallback(self.media_downloaded, request, info, item=item)
         
         if response.status != 200:
             logger.warning(
@@ -122,7 +486,9 @@ class BaseFilesPipeline(FilesPipeline):
                 )
                 raise FileException("download-content-not-enough")
         
-        return super().media_downloaded(response, request, info, item=item)
+        result = super().media_downloaded(response, request, info, item=item)
+        result["size"] = len(response.body)
+        return result
 
     def validate_and_normalize_filename(self, filename):
         # Windows不允许的特殊字符
@@ -140,12 +506,22 @@ class BaseFilesPipeline(FilesPipeline):
         return self.config.get(key, {}).get("path", "!other")
 
 
+_progress_manager = None
+
+def get_progress_manager():
+    # 同一个进程里的爬虫共用一个 manager，几个爬虫一起跑时进度条显示在一起，不会互相覆盖
+    global _progress_manager
+    if _progress_manager is None:
+        _progress_manager = enlighten.get_manager()
+    return _progress_manager
+
+
 class ProgressBarsPipeline:
     REQUEST_BAR_DEFAULT = "R"
     UNSHOW_SKIP_BAR = True
     
-    def __init__(self):
-        self.manager = manager = enlighten.get_manager()
+    def __init__(self, desc="D"):
+        self.manager = manager = get_progress_manager()
         # self.pbar = self.manager.counter(total=0, desc='D', unit='p')
         self.request_bar = {}
 
@@ -157,7 +533,7 @@ class ProgressBarsPipeline:
                 u'S:' + terminal.yellow2(u'{skip_count:{skip_count_len}}') + u' ' + \
                 u'{count}/{total} ' + \
                 u'[{elapsed}<{eta}, {rate:.2f}{unit_pad}{unit}/s]'
-            self.success = manager.counter(total=0, desc='D', unit='p', color='green3', bar_format=bar_format)
+            self.success = manager.counter(total=0, desc=desc, unit='p', color='green3', bar_format=bar_format)
             self.success.fields["skip_count"] = 0
             self.success.fields["skip_count_len"] = 1
             self.failures = self.success.add_subcounter('red2')
@@ -169,7 +545,7 @@ class ProgressBarsPipeline:
                 u'{count}/{total} ' + \
                 u'[{elapsed}<{eta}, {rate:.2f}{unit_pad}{unit}/s]'
 
-            self.success = manager.counter(total=-1, desc='D', unit='p', color='green3', bar_format=bar_format)
+            self.success = manager.counter(total=-1, desc=desc, unit='p', color='green3', bar_format=bar_format)
             self.skip = self.success.add_subcounter('yellow2')
             self.failures = self.success.add_subcounter('red2')
 
@@ -187,7 +563,7 @@ class ProgressBarsPipeline:
     
     @classmethod
     def from_crawler(cls, crawler):
-        pipe = cls()
+        pipe = cls(crawler.spidercls.name)
         crawler.signals.connect(pipe.on_headers_received, signal=scrapy.signals.headers_received)
         crawler.signals.connect(pipe.on_bytes_received, signal=scrapy.signals.bytes_received)
         crawler.signals.connect(pipe.on_response_downloaded, signal=scrapy.signals.response_downloaded)
@@ -0,0 +1,86 @@
+import time
+from datetime import datetime, timezone
+from statistics import median
+
+
+def _author_key(author):
+    # config 里 kemono 的作者是 (服务, ID)，和 sp_user 一样用逗号拼起来存
+    return ",".join(author) if isinstance(author, tuple) else str(author)
+
+
+def timestamp(value):
+    if isinstance(value, (int, float)):
+        return value
+    date = value if isinstance(value, datetime) else datetime.fromisoformat(value)
+    if date.tzinfo is None:     # kemono 的发布时间没有时区，按 UTC 算
+        date = date.replace(tzinfo=timezone.utc)
+    return date.timestamp()
+
+
+class PollPlanner:
+    # 按作者最近几次发布的时间估计多久会有新作品，给每个作者算下次检查的时间
+    # 间隔 = max(最近几次发布间隔的中位数, 距最后一次发布的时间) / 2，限制在 [最短, 最长] 之间
+    # 天天发的作者半天查一次，几年没发的作者按最长间隔查；没有记录的作者按最短间隔
+    HISTORY = 10    # 用最近几次发布算间隔
+
+    def __init__(self, spider, min_interval, max_interval):
+        self.spider = spider
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        spider.cursor.execute("""
+            CREATE TABLE IF NOT EXISTS poll
+            (
+                author      TEXT NOT NULL,
+                checked_at  DATETIME NOT NULL,
+                PRIMARY KEY (author)
+            );
+        """)
+        self.checked = {author: timestamp(checked_at) for author, checked_at in spider.cursor.execute("SELECT author, checked_at FROM poll;")}
+        self.history = None
+
+    @classmethod
+    def from_spider(cls, spider):
+        settings = spider.settings
+        return cls(spider, settings.getfloat("STD_POLL_MIN_INTERVAL"), settings.getfloat("STD_POLL_MAX_INTERVAL"))
+
+    def _history(self):
+        # {作者: [最近的发布时间戳, 从新到旧]}，作品入库后会变，每次检查前重新查
+        if self.history is None:
+            self.history = {}
+            for author, dates in self.spider.upload_history(self.HISTORY).items():
+                self.history[_author_key(author)] = sorted(map(timestamp, dates), reverse=True)
+        return self.history
+
+    def interval(self, author, now=None):
+        if not getattr(self.spider, "poll_plan", False):
+            return self.min_interval
+        dates = self._history().get(_author_key(author))
+        if not dates:
+            return self.min_interval
+        now = now or time.time()
+        gaps = [a - b for a, b in zip(dates, dates[1:])]
+        expect = max(median(gaps) if gaps else 0, now - dates[0])
+        return min(max(expect / 2, self.min_interval), self.max_interval)
+
+    def next_check(self, author, now=None):
+        checked = self.checked.get(_author_key(author))
+        if checked is None:
+            return now or time.time()
+        return checked + self.interval(author, now)
+
+    def due(self, authors, now=None):
+        # (到检查时间的作者, 还没到的作者)
+        now = now or time.time()
+        due, skipped = [], []
+        for author in authors:
+            (due if self.next_check(author, now) <= now else skipped).append(author)
+        return due, skipped
+
+    def mark_checked(self, authors):
+        now = time.time()
+        checked_at = datetime.fromtimestamp(now, timezone.utc).isoformat()
+        for author in authors:
+            key = _author_key(author)
+            self.checked[key] = now
+            self.spider.writer.execute("INSERT OR REPLACE INTO poll (author, checked_at) VALUES (?, ?);", (key, checked_at))
+        self.history = None
@@ -45,6 +45,9 @@ DOWNLOADER_MIDDLEWARES = {
 #EXTENSIONS = {
 #    "scrapy.extensions.telnet.TelnetConsole": None,
 #}
+EXTENSIONS = {
+    "setudownloader.daemon.AuthorScheduler": 500,
+}
 
 # Configure item pipelines
 # See https://docs.scrapy.org/en/latest/topics/item-pipeline.html
@@ -99,4 +102,67 @@ STD_COOKIES_DIR = "./setudownloader/cookies"
 CONFIG_PATH = "./setudownloader/config.json"
 
 # 下载文件时404，忽略下载文件并存储至数据库, False每次404不会存储数据库，每次下载就会警告
-STD_IGNORE_FILES_DOWNLOAD_ON_404 = True
\ No newline at end of file
+STD_IGNORE_FILES_DOWNLOAD_ON_404 = True
+
+# 数据库后台写入，攒够多少条或者隔多少秒提交一次
+STD_DB_BATCH_SIZE = 500
+STD_DB_COMMIT_INTERVAL = 1.0
+
+# 文件边下载边写盘，不在内存里缓存整个文件
+STD_STREAM_DOWNLOAD = True
+DOWNLOAD_HANDLERS = {
+    "http": "setudownloader.handlers.StreamDownloadHandler",
+    "https": "setudownloader.handlers.StreamDownloadHandler",
+}
+
+# 大文件分段下载，超过 STD_SEGMENTED_MIN_SIZE 字节的文件拆成 STD_SEGMENTED_PARTS 段同时下载
+# 分段请求和普通请求共用 CONCURRENT_REQUESTS_PER_DOMAIN 的并发数，中断后不能续传
+STD_SEGMENTED_DOWNLOAD = False
+STD_SEGMENTED_MIN_SIZE = 64 * 1024 * 1024
+STD_SEGMENTED_PARTS = 4
+
+# pixiv 按作者下载时，一次请求多少个作品的元数据，0为逐个请求
+STD_PIXIV_BATCH_SIZE = 48
+# pixiv 关注动态模式(-a follow=1)最多往前翻多少页，每页60个作品
+STD_PIXIV_FOLLOW_MAX_PAGES = 30
+
+# twitter 用户ID、用户名、媒体数的缓存时间（小时），过期后按ID批量刷新
+STD_TWITTER_USER_TTL = 24
+
+# kemono 同时下载中的附件总大小（字节）和数量上限，多个作品的附件一起下载，超过时排队，0为不限制
+STD_KEMONO_INFLIGHT_BYTES = 256 * 1024 * 1024
+STD_KEMONO_INFLIGHT_FILES = 32
+
+# ehentai 图片额度，开始前读 home.php 的额度，按预估消耗只排额度够的页，用完后剩下的页留到下次
+# 原图和重采样图每张的预估消耗，额度不够原图时是否改下重采样的图
+STD_EHENTAI_QUOTA = True
+STD_EHENTAI_ORIGINAL_COST = 5
+STD_EHENTAI_RESAMPLED_COST = 1
+STD_EHENTAI_RESAMPLED_FALLBACK = False
+
+# nhentai 图片节点，同样的路径在这些节点上都能下，按实际下载速度分配请求，失败时换节点，为空只用 i7
+# 同时下载的图片数量不超过 CONCURRENT_REQUESTS，轮到时才选节点
+# 失败的节点冷却多少秒，连续失败时翻倍
+STD_NHENTAI_IMAGE_HOSTS = ["i1.nhentai.net", "i2.nhentai.net", "i3.nhentai.net", "i5.nhentai.net", "i7.nhentai.net"]
+STD_NHENTAI_MIRROR_COOLDOWN = 30
+
+# 一个进程里同时跑几个爬虫时（python stdownloader.py all），所有爬虫加起来同时下载的请求数上限，0 不限制
+# 在 StreamDownloadHandler 里真正发请求时才占名额，DOWNLOAD_HANDLERS 换掉的话不生效
+STD_GLOBAL_CONCURRENCY = 32
+
+# 常驻模式（python stdownloader.py all --daemon），跑完一轮不退出，每个作者按 STD_POLL_* 的检查计划再检查
+# config.json 改了会自动重新加载，不用重启
+STD_DAEMON = False
+
+# 检查计划：按作者最近的发布频率算检查间隔（秒），经常发的作者查得勤，很久没发的少查
+# --due-only 时 pixiv/twitter 只检查到了检查时间的作者，kemono 靠 creators.txt 判断有没有更新，不按计划跳过
+STD_POLL_MIN_INTERVAL = 6 * 3600
+STD_POLL_MAX_INTERVAL = 14 * 24 * 3600
+STD_DUE_ONLY = False
+
+# 新作品优先：这么多天内发布的作品按发布时间排请求优先级，越新越先下，所有作者一起排
+# 更早的作品是补旧作，排在最后；0 不排，按作者和翻页的顺序下
+STD_FRESHNESS_DAYS = 7
+# 按新旧排时一个爬虫同时在下载的文件数（包括写文件的时间），超过的按优先级排队，新作品的文件插到前面
+# 太小下载器会空着，太大排队的少，新旧顺序不明显
+STD_FILES_CONCURRENCY = 32
@@ -1,20 +1,26 @@
 import json
 import logging
 import os
+import time
 import scrapy
 import setudownloader.signals
 from setudownloader.define import NOTICE, NOTICE_WARN
+from setudownloader.planner import PollPlanner, timestamp
 
 logging.addLevelName(NOTICE, "NOTICE")
 logging.addLevelName(NOTICE_WARN, "NOTICE WARN")
 
 class BaseSpider(scrapy.Spider):
+    poll_plan = False   # 按作者的发布频率安排检查时间，需要实现 upload_history
+    author_checks = False   # 能按作者检查新作品，常驻模式要用，需要实现 author_requests
     
     def __init__(self, name = None, **kwargs):
         self._set_command_line_arguments()
         super().__init__(name, **kwargs)
         self._total = 0
         self._skip = 0
+        self._planner = None
+        self._held = {}     # 作者: 交给管道还没入库的作品，和要等它们入库才能写的进度
     
     def _set_command_line_arguments(self):
         # -a 命令行参数补充
@@ -36,6 +42,91 @@ class BaseSpider(scrapy.Spider):
             count=self._skip
         )
 
+    def hold_item(self, author, item_id):
+        # 交给管道的作品，入库前这个作者后面的进度先不写
+        self._held.setdefault(author, {"items": set(), "writes": []})["items"].add(item_id)
+
+    def write_when_stored(self, author, sql, params):
+        # 之前交出去的作品都入库了再写，不然中断后进度越过了没入库的作品，下次就不会再下载
+        held = self._held.setdefault(author, {"items": set(), "writes": []})
+        held["writes"].append((set(held["items"]), sql, params))
+        self._flush_held(author)
+
+    def item_stored(self, author, item_id):
+        # 数据库管道入库后调用，没下载完记为续传的也算入库
+        held = self._held.get(author)
+        if held is None:
+            return
+        held["items"].discard(item_id)
+        for waiting, _, _ in held["writes"]:
+            waiting.discard(item_id)
+        self._flush_held(author)
+
+    def _flush_held(self, author):
+        held = self._held[author]
+        writes = held["writes"]
+        while writes and not writes[0][0]:
+            _, sql, params = writes.pop(0)
+            self.writer.execute(sql, params)
+        if not held["items"] and not writes:
+            del self._held[author]
+
+    def author_requests(self, authors):
+        # 检查这些作者有没有新作品的请求，authors 是 config 里的 key，常驻模式到了作者的检查时间时调用
+        return iter(())
+
+    def upload_history(self, limit):
+        # {config 里的作者: [最近 limit 个作品的发布时间]}
+        return {}
+
+    @property
+    def planner(self):
+        # 数据库在管道的 open_spider 里才打开，用到时再建
+        if self._planner is None:
+            self._planner = PollPlanner.from_spider(self)
+        return self._planner
+
+    def check_authors(self, authors):
+        # STD_DUE_ONLY 时跳过还没到检查时间的作者，指定作者时不按计划
+        authors = list(authors)
+        if not self.sp_user:
+            if self.poll_plan and self.settings.getbool("STD_DUE_ONLY"):
+                authors, skipped = self.planner.due(authors)
+                # 每个跳过的作者至少省下一个主页/时间线请求
+                stats = self.crawler.stats
+                stats.inc_value("plan/due", len(authors), spider=self)
+                stats.inc_value("plan/skipped", len(skipped), spider=self)
+                stats.inc_value("plan/requests_saved", len(skipped), spider=self)
+                self.log(f"按检查计划：检查 {len(authors)} 个作者，跳过 {len(skipped)} 个，少发 {len(skipped)} 个以上请求", NOTICE)
+        return self.author_requests(authors)
+
+    def author_checked(self, author):
+        # 作者的主页/时间线请求成功了才记检查时间，请求失败的作者下次还算到期
+        if not self.sp_user:
+            self.planner.mark_checked([author])
+
+    def start_authors(self, authors):
+        # start_requests 里的请求 scrapy 要等调度队列空了才取下一个，前面作者的旧作品都下完才轮到后面的作者
+        # 按新旧排的时候用 data: 空请求中转，所有作者的请求一起进调度队列，新作品才能排到所有旧作品前面
+        if self.settings.getfloat("STD_FRESHNESS_DAYS") <= 0:
+            return self.check_authors(authors)
+        return [scrapy.Request("data:,", callback=self._authors_parse, dont_filter=True, cb_kwargs={"authors": list(authors)})]
+
+    def _authors_parse(self, response, authors):
+        return self.check_authors(authors)
+
+    def fresh_priority(self, date):
+        # 作品请求的优先级：STD_FRESHNESS_DAYS 天内发布的按小时排，一小时内发布的是 -1，越旧越小
+        # 更早的和不知道发布时间的是 -(小时数 + 1)，补旧作排在最后；作者主页、第一页这些找作品的请求是 0 或更高，先于所有作品
+        days = self.settings.getfloat("STD_FRESHNESS_DAYS")
+        if days <= 0:
+            return 0
+        hours = int(days * 24)
+        if date is None:
+            return -hours - 1
+        age = int((time.time() - timestamp(date)) // 3600)
+        return -min(max(age, 0), hours) - 1
+
     @classmethod
     def from_crawler(cls, crawler, *args, **kwargs):
         spider = super().from_crawler(crawler, *args, **kwargs)
@@ -5,15 +5,16 @@ from urllib.parse import urlparse
 import scrapy
 import logging
 from datetime import datetime
-from setudownloader.pipelines import BaseFilesPipeline, ProgressBarsPipeline, SqlitePipeline
+from setudownloader.pipelines import MEDIA_404, MEDIA_DONE, MEDIA_PENDING, MEDIA_STATE_COLUMNS, BaseFilesPipeline, ProgressBarsPipeline, SqlitePipeline
+from setudownloader.database import KnownIdIndex, upsert_sql
 from setudownloader.middlewares import BaseDownloaderMiddleware
 from setudownloader.define import NOTICE, GetLogFileName
 import scrapy.signals
 from scrapy.http.request import NO_CALLBACK
 from setudownloader.spiders import BaseSpider
-from bs4 import BeautifulSoup
 from scrapy.http import TextResponse
 from scrapy.pipelines.files import FileException
+from scrapy.exceptions import IgnoreRequest
 
 class EHItem(scrapy.Item):
     title = scrapy.Field()
@@ -25,12 +26,64 @@ class EHItem(scrapy.Item):
 
     url = scrapy.Field()
     page = scrapy.Field()
+    resampled = scrapy.Field()  # 额度不够原图时下的重采样图
+
+
+# 额度不够时下了重采样图的页，不算下载完成，下次额度够了再下原图
+MEDIA_RESAMPLED = "resampled"
+
+
+class EHQuota:
+    # 账号的图片额度，开始时从 home.php 读当前用量和上限，之后按每张图的预估消耗扣
+    # 额度不够的图片页不再请求，token 已经存在数据库里，下次运行直接接着下
+    def __init__(self, original_cost=5, resampled_cost=1, fallback=False):
+        self.original_cost = original_cost
+        self.resampled_cost = resampled_cost
+        self.fallback = fallback    # 原图额度不够时改下重采样的图
+        self.used = None
+        self.limit = None
+        self.exhausted = False
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(
+            settings.getint("STD_EHENTAI_ORIGINAL_COST", 5),
+            settings.getint("STD_EHENTAI_RESAMPLED_COST", 1),
+            settings.getbool("STD_EHENTAI_RESAMPLED_FALLBACK"),
+        )
+
+    @property
+    def remaining(self):
+        if self.exhausted:
+            return 0
+        return None if self.limit is None else self.limit - self.used
+
+    def update(self, used, limit):
+        self.used, self.limit = used, limit
+
+    def take(self, original_only=False):
+        # 给一张图预留额度，返回 "original" / "resampled"，额度不够返回 None
+        # original_only: 已经有重采样图的页，只有原图额度够时才下
+        remaining = self.remaining
+        if remaining is None or remaining >= self.original_cost:
+            cost, kind = self.original_cost, "original"
+        elif self.fallback and not original_only and remaining >= self.resampled_cost:
+            cost, kind = self.resampled_cost, "resampled"
+        else:
+            return None
+        if self.used is not None:
+            self.used += cost
+        return kind
 
 
 class EHDownloadMiddleware(BaseDownloaderMiddleware):
     def process_request(self, request, spider):
         super().process_request(request, spider)
         request.headers['Referer'] = 'https://exhentai.net/'
+        # 额度已经用完，排队中的图片页不再请求
+        if request.callback == spider.sparse and spider.quota.exhausted:
+            spider.crawler.stats.inc_value("ehentai/quota_deferred", spider=spider)
+            raise IgnoreRequest("image limit exhausted")
 
     
     def process_response(self, request, response, spider: scrapy.Spider):
@@ -45,10 +98,8 @@ class EHDownloadMiddleware(BaseDownloaderMiddleware):
 class EHDBPipeline(SqlitePipeline):
     db_path = ".database/ehentai.db"
 
-    def open_spider(self, spider):
-        super().open_spider(spider)
-        self.build()
-        # self.check()
+    # media 表里还有扫描目录页时先存下的 pending 行，已下载的索引在 load_index 里按状态查
+    index_tables = {}
 
     def build(self):
         # 修改数据库，要同时修改建库语句
@@ -73,7 +124,20 @@ class EHDBPipeline(SqlitePipeline):
             );
         """
         self.cursor.executescript(sql)
-    
+        self.add_columns("media", MEDIA_STATE_COLUMNS)
+
+    def load_index(self, spider):
+        index = super().load_index(spider)
+        sql = f"SELECT gallery_id, page FROM media WHERE state IN ('{MEDIA_DONE}', '{MEDIA_404}');"
+        index["media"] = KnownIdIndex() if getattr(spider, "force", False) else KnownIdIndex.from_query(self.cursor, sql)
+        # 扫描目录页时记下的图片页token {(gid, 页码): token}，下次直接请求图片页，不用再翻目录页
+        # 只下了重采样图的页也有 token，额度够时直接重下原图
+        sql = "SELECT gallery_id, page, token, state FROM media WHERE state IN (?, ?) AND token IS NOT NULL;"
+        rows = self.cursor.execute(sql, (MEDIA_PENDING, MEDIA_RESAMPLED)).fetchall()
+        spider.page_tokens = {(gid, page): token for gid, page, token, _ in rows}
+        spider.resampled = {(gid, page) for gid, page, _, state in rows if state == MEDIA_RESAMPLED}
+        return index
+
     def process_item(self, item, spider):
         data = {
             "id": item["gid"],
@@ -88,16 +152,19 @@ class EHDBPipeline(SqlitePipeline):
             "page": item["page"],
             "url": item["url"][0],
             "token": item["media_token"],
+            "state": MEDIA_RESAMPLED if item.get("resampled") else MEDIA_DONE,
         }
         self.insert("media", data)
+        self.index["media"].add((item["gid"], item["page"]))
         spider.log(f'{item["gid"]}-{item["page"]} database save', logging.INFO)
         return item
 
 
 class EHFilesPipeline(BaseFilesPipeline):
+    urls_field = "url"
 
     def get_media_requests(self, item, info):
-        return [scrapy.Request(u, meta={"progress_bar_name":self.get_file_name(u, item)}) for u in item["url"]]
+        return [scrapy.Request(u, meta={"progress_bar_name":self.get_file_name(u, item)}) for _, u in self.iter_media(item)]
 
     def get_file_name(self, url, item):
         _path = Path(urlparse(url).path)
@@ -108,7 +175,10 @@ class EHFilesPipeline(BaseFilesPipeline):
         _path = Path(urlparse(request.url).path)
         title = self.validate_and_normalize_filename(item['title_jpn'] or item["title"])
         user_path = "!other"
-        media_path = f"{user_path}/ehentai/{title}/{_path.name}"
+        name = _path.name
+        if item.get("resampled"):   # 重采样图换个名字，下次下原图时不会当成已经下载过
+            name = f"{_path.stem}_resampled{_path.suffix}"
+        media_path = f"{user_path}/ehentai/{title}/{name}"
         return media_path
     
     def item_completed(self, results, item, info):
@@ -119,9 +189,13 @@ class EHFilesPipeline(BaseFilesPipeline):
         return item
 
     def media_downloaded(self, response, request, info, *, item=None):
+        self.leave_gate(request)    # 下面的检查可能不调 super() 就抛出
         if isinstance(response, TextResponse):
             if "you do not have enough" in response.text:
-                info.spider.crawler.engine.close_spider(info.spider, reason=str(response.text))
+                # 不直接关掉爬虫，下载中的图片继续，没下载的页留到下次
+                if not info.spider.quota.exhausted:
+                    info.spider.quota.exhausted = True
+                    info.spider.log(f"图片额度用完，剩下的页下次再下载: {response.text}", NOTICE)
                 raise FileException(response.text)
             elif "Invalid token" in response.text:
                 raise FileException(response.text)
@@ -157,48 +231,115 @@ class PixivSpider(BaseSpider):
         "AUTOTHROTTLE_START_DELAY": 2,
     }
 
+    # api.php 的 gdata 一次最多查25个画廊
+    GDATA_BATCH_SIZE = 25
+
+    def __init__(self, name=None, **kwargs):
+        super().__init__(name, **kwargs)
+        self.quota = EHQuota()  # 不限额度，from_crawler 里按设置重建，开始时再从 home.php 读用量
+        self.page_tokens = {}
+        self.resampled = set()  # 上次只下了重采样图的页 (gid, 页码)
+
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        spider = super().from_crawler(crawler, *args, **kwargs)
+        spider.quota = EHQuota.from_settings(crawler.settings)
+        return spider
+
     def start_requests(self):
         """
         -a参数
         url=https://exhentai.org/g/2569702/a6e2be081b/,...
+        url_file=urls.txt   画廊地址列表文件，一行一个（或者逗号分隔），#开头的行忽略
         fix=1   一直下载错误时尝试修复（可能是代理的问题）
         """
         # url = "https://exhentai.org/g/2569702/a6e2be081b/"
         pr = re.compile(r'(e[x-]hentai).org/g/(\d+)/(\w+)')
-        urls = getattr(self, "url", "").split(",")
-        for url in urls:
+        galleries = {}
+        for url in self._gallery_urls():
             match = pr.search(url)
             if match:
                 host = match.group(1)
                 gid = match.group(2)
                 token = match.group(3)
-                cb_kwargs = {
+                galleries.setdefault(int(gid), {
                     "url": url,
                     "host": host,
                     "gid": gid,
                     "token": token,
-                }
-                params = {
-                    "method": "gdata",
-                    "gidlist": [
-                        [int(gid), token]
-                    ],
-                    "namespace": 1
-                }
-                url = f"https://api.e-hentai.org/api.php"
-                yield scrapy.Request(url=url, method="POST", body=json.dumps(params), callback=self.g_parse, cb_kwargs=cb_kwargs)
+                })
             else:
                 msg = f"不匹配的地址:{url}"
                 print(msg)
                 self.log(msg, logging.WARN)
-    
-    def g_parse(self, response, **kwargs):
+        # 按批查询元数据，返回后再按画廊分开处理
+        gids = list(galleries)
+        batches = []
+        for i in range(0, len(gids), self.GDATA_BATCH_SIZE):
+            batch = {gid: galleries[gid] for gid in gids[i:i + self.GDATA_BATCH_SIZE]}
+            batches.append(self._gdata_request(batch))
+        if self.settings.getbool("STD_EHENTAI_QUOTA", True) and batches:
+            # 先查额度再开始排图片页
+            yield scrapy.Request("https://e-hentai.org/home.php", callback=self.home_parse, errback=self.home_failed,
+                                 dont_filter=True, cb_kwargs={"batches": batches})
+        else:
+            yield from batches
+
+    def home_parse(self, response, batches):
+        # You are currently at <strong>1,234</strong> towards a limit of <strong>5,000</strong>.
+        match = re.search(r"currently at <strong>([\d,]+)</strong> towards a limit of <strong>([\d,]+)</strong>", response.text)
+        if match:
+            used, limit = (int(v.replace(",", "")) for v in match.groups())
+            self.quota.update(used, limit)
+            self.log(f"图片额度 {used}/{limit}", NOTICE)
+        else:
+            self.log("没有读到图片额度，不限制下载数量", logging.WARNING)
+        yield from batches
+
+    def home_failed(self, failure):
+        self.log(f"查询图片额度失败，不限制下载数量: {failure.value}", logging.WARNING)
+        yield from failure.request.cb_kwargs["batches"]
+
+    def _gallery_urls(self):
+        urls = getattr(self, "url", "").split(",")
+        url_file = getattr(self, "url_file", None)
+        if url_file:
+            with open(url_file, "r", encoding="utf-8") as f:
+                for line in f:
+                    line = line.strip()
+                    if line and not line.startswith("#"):
+                        urls.extend(line.split(","))
+        return [url.strip() for url in urls if url.strip()]
+
+    def _gdata_request(self, galleries):
+        params = {
+            "method": "gdata",
+            "gidlist": [[gid, g["token"]] for gid, g in galleries.items()],
+            "namespace": 1
+        }
+        url = f"https://api.e-hentai.org/api.php"
+        return scrapy.Request(url=url, method="POST", body=json.dumps(params), callback=self.gdata_parse,
+                              dont_filter=True, cb_kwargs={"galleries": galleries})
+
+    def gdata_parse(self, response, galleries):
         result = json.loads(response.text)
         if "gmetadata" not in result:
-            self.log("gid或token有误", logging.ERROR)
+            self.log(f"查询画廊元数据失败: {result.get('error')} {[g['url'] for g in galleries.values()]}", logging.ERROR)
             return
-        
-        kwargs.update(result["gmetadata"][0])
+        for meta in result["gmetadata"]:
+            gallery = galleries.pop(int(meta.get("gid", 0)), None)
+            if gallery is None:
+                continue
+            if "error" in meta:
+                # 单个画廊的gid或token有误，不影响同一批的其他画廊
+                self.log(f"gid或token有误: {gallery['url']} {meta['error']}", logging.ERROR)
+                continue
+            yield from self.g_parse(meta, **gallery)
+        for gallery in galleries.values():
+            self.log(f"没有查到画廊元数据: {gallery['url']}", logging.ERROR)
+
+    def g_parse(self, meta, **kwargs):
+        kwargs.update(meta)
         kwargs["g_token"] = kwargs.get("token")
         url = f"https://{kwargs['host']}.org/g/{kwargs['gid']}/{kwargs['g_token']}/"
         filecount = int(kwargs["filecount"])
@@ -212,6 +353,16 @@ class PixivSpider(BaseSpider):
                 self.log(f"跳过{gid}-{i}", logging.DEBUG)
                 self.add_skip()
                 continue
+            elif (gid, i) in self.page_tokens:
+                # 之前扫描过目录页，直接请求图片页
+                m_token = self.page_tokens[(gid, i)]
+                _URL = f"https://{kwargs['host']}.org/s/{m_token}/{gid}-{i}"
+                request = self._sparse_request(_URL, {**kwargs, "page": i, "m_token": m_token})
+                if request:
+                    yield request
+            elif self.quota.remaining is not None and self.quota.remaining < self.quota.resampled_cost:
+                # 额度已经不够了，这页的目录页也先不翻
+                self.crawler.stats.inc_value("ehentai/quota_deferred", spider=self)
             else:
                 gpage = int((i-1) / 40)
                 need_scan_gpage2ipage.setdefault(gpage, []).append(i)
@@ -225,38 +376,52 @@ class PixivSpider(BaseSpider):
     def _check_pid_download(self, gid, page):
         if self.force:
             return False
-        sql = f"SELECT * FROM media WHERE gallery_id = {gid} and page = {page}"
-        result = self.cursor.execute(sql).fetchall()
-        if result:
-            if None in result[0]:   # 某个字段为空，重新爬，因为理论上不会有字段为空
-                return False
-        return bool(result)
+        return (gid, page) in self.index["media"]
     
     def parse(self, response, **kwargs):
-        bs = BeautifulSoup(response.text, features="lxml")
-        cur_page = bs.find_all(class_="gdtm")
+        # 直接用 scrapy 自带的 lxml 选择器，不再为每页建一棵 BeautifulSoup 树
+        cur_page = [thumb.css("a::attr(href)").get() for thumb in response.css(".gdtm")]
         pages = kwargs["pages"].copy()
         for page in pages[::-1]:
-            url = cur_page[page%40-1].find("a")["href"]
+            url = cur_page[page%40-1]
             kwargs["page"] = page
             # https://exhentai.org/s/2f6cc5669b/2849352-3
             pr = re.compile(r'e[x-]hentai.org/s/(\w+)/(\d+)-(\d+)')
             match = pr.search(url)
             if match:
                 kwargs["m_token"] = match.group(1)
-            yield scrapy.Request(url=url, callback=self.sparse, dont_filter=True, cb_kwargs=kwargs)
+                self._save_page_token(int(kwargs["gid"]), page, kwargs["m_token"])
+            request = self._sparse_request(url, kwargs)
+            if request:
+                yield request
 
-    def sparse(self, response, **kwargs):
-        bs = BeautifulSoup(response.text, features="lxml")
+    def _sparse_request(self, url, kwargs):
+        # 按额度排图片页，额度不够的页 token 已经存库，下次接着下
+        quality = self.quota.take(original_only=(int(kwargs["gid"]), kwargs["page"]) in self.resampled)
+        if quality is None:
+            self.crawler.stats.inc_value("ehentai/quota_deferred", spider=self)
+            return None
+        return scrapy.Request(url=url, callback=self.sparse, dont_filter=True, cb_kwargs={**kwargs, "quality": quality})
+
+    def _save_page_token(self, gid, page, token):
+        # 图片下载前先把图片页的token存下来，中断后下次不用再扫描目录页
+        self.page_tokens[(gid, page)] = token
+        data = {"gallery_id": gid, "page": page, "token": token, "state": MEDIA_PENDING}
+        self.writer.execute(upsert_sql("media", tuple(data), ("gallery_id", "page")), tuple(data.values()))
 
+    def sparse(self, response, **kwargs):
         urls = []
-        url = _url = bs.find(id="i3").find(id="img")["src"]
-        for _a in bs.find(id="i6").find_all("a"):
-            if "original" in _a.text:
-                url = _a["href"]
-                urls.append(_a["href"])
+        url = _url = response.css("#i3 #img::attr(src)").get()
+        for _a in response.css("#i6 a"):
+            if "original" in _a.xpath("string()").get():
+                url = _a.attrib["href"]
+                urls.append(url)
                 break
-        if getattr(self, "fix", False):
+        if kwargs.get("quality") == "resampled":
+            # 额度不够下原图，下重采样的图
+            urls = [_url]
+            self.crawler.stats.inc_value("ehentai/resampled", spider=self)
+        elif getattr(self, "fix", False):
             urls.append(_url)
         # next_url = bs.find(id="i4").find(id="next")
 
@@ -269,4 +434,5 @@ class PixivSpider(BaseSpider):
         item["gid"] = int(kwargs.get("gid"))
         item["url"] = urls
         item["page"] = int(kwargs.get("page"))
+        item["resampled"] = kwargs.get("quality") == "resampled"
         yield item
@@ -1,15 +1,30 @@
+from collections import deque
 from io import BytesIO
 import json
+import os
+import re
 import scrapy
 import logging
 from datetime import datetime
-from setudownloader.pipelines import ProgressBarsPipeline, SqlitePipeline, BaseFilesPipeline
+from urllib.parse import urlparse
+from setudownloader.pipelines import MEDIA_404, MEDIA_DONE, ProgressBarsPipeline, SqlitePipeline, BaseFilesPipeline, link_file
+from scrapy.pipelines.files import FSFilesStore
+from setudownloader.database import KnownIdIndex, upsert_sql
 from setudownloader.middlewares import BaseDownloaderMiddleware
 from scrapy.exceptions import DropItem
+from scrapy import signals
+from scrapy.settings import Settings
+from twisted.internet.defer import Deferred, maybeDeferred
 from setudownloader.define import NOTICE, GetLogFileName
 from setudownloader.spiders import BaseSpider
 from scrapy.http.request import NO_CALLBACK
 
+def path_sha256(path):
+    # kemono 的附件路径里就是文件的 sha256: /xx/yy/<sha256>.ext
+    name = path.rsplit("/", 1)[-1].split(".", 1)[0].lower()
+    return name if re.fullmatch(r"[0-9a-f]{64}", name) else None
+
+
 class KemonoItem(scrapy.Item):
     user_id = scrapy.Field()
     title = scrapy.Field()
@@ -18,26 +33,73 @@ class KemonoItem(scrapy.Item):
     id = scrapy.Field()
     file = scrapy.Field()
     content = scrapy.Field()
+    pages = scrapy.Field()  # 需要下载的附件序号，None为全部
+    files = scrapy.Field()  # 每个附件的下载状态
 
 
 class KemonoDownloadMiddleware(BaseDownloaderMiddleware):
+    # kemono.su/data/... 的文件都会 302 到编号的数据节点 (n1.kemono.su ...)，每个文件多一次经过代理的往返
+    # 按路径第一级目录记住上次成功的节点，后面同目录的文件直接请求节点，节点 404/5xx 时作废再走主站
+    def __init__(self, settings) -> None:
+        super().__init__(settings)
+        self.nodes = {}     # {"/data/ab": "https://n1.kemono.su"}
+
+    @staticmethod
+    def _node_key(url):
+        url = urlparse(url)
+        if url.netloc == "kemono.su" and url.path.startswith("/data/"):
+            return "/".join(url.path.split("/", 3)[:3])
+
     def process_request(self, request, spider):
         super().process_request(request, spider)
         request.headers['Referer'] = 'https://kemono.su'
-    
+        key = self._node_key(request.url)
+        if key is None:
+            return None
+        stats = spider.crawler.stats
+        node = self.nodes.get(key)
+        if node is None:
+            stats.inc_value("redirect_cache/miss", spider=spider)
+            return None
+        stats.inc_value("redirect_cache/hit", spider=spider)
+        url = urlparse(request.url)._replace(scheme="", netloc="").geturl()
+        return request.replace(url=node + url, meta={**request.meta, "kemono_node": (key, node, request.url)})
+
     def process_response(self, request, response, spider: scrapy.Spider):
         if response.status in [429, 403]:
             spider.log(f"response.status = {response.status}", NOTICE)
             spider.crawler.engine.close_spider(spider, reason="request fail")
+            return response
+        if "kemono_node" in request.meta:
+            if response.status == 404 or response.status >= 500:
+                return self._expire_node(request, spider, f"status {response.status}")
+        elif response.status in (200, 206) and request.meta.get("redirect_urls"):
+            # 主站重定向过来的，记住这个目录对应的节点
+            key = self._node_key(request.meta["redirect_urls"][0])
+            url = urlparse(response.url)
+            if key and url.netloc != "kemono.su":
+                self.nodes[key] = f"{url.scheme}://{url.netloc}"
         return response
 
+    def process_exception(self, request, exception, spider):
+        if "kemono_node" in request.meta:
+            return self._expire_node(request, spider, exception)
+
+    def _expire_node(self, request, spider, reason):
+        # 节点失效，作废缓存，这次的请求重新走主站
+        key, node, url = request.meta["kemono_node"]
+        if self.nodes.get(key) == node:
+            del self.nodes[key]
+            spider.crawler.stats.inc_value("redirect_cache/expired", spider=spider)
+            spider.log(f"数据节点 {node} 失效 ({reason})，{key} 重新走主站", logging.DEBUG)
+        meta = {k: v for k, v in request.meta.items() if k != "kemono_node"}
+        return request.replace(url=url, meta=meta, dont_filter=True)
+
 
 class KemonoDBPipeline(SqlitePipeline):
     db_path = ".database/kemono.db"
-
-    def open_spider(self, spider):
-        super().open_spider(spider)
-        self.build()
+    # 每个service一张表，索引名就是service
+    index_tables = {"fanbox": ("fanbox", ("id",))}
 
     def build(self):
         # 修改数据库，要同时修改建库语句
@@ -50,9 +112,49 @@ class KemonoDBPipeline(SqlitePipeline):
                 upload_date DATETIME NOT NULL,
                 PRIMARY KEY (id)
             );
+
+            CREATE TABLE IF NOT EXISTS media
+            (
+                service     TEXT NOT NULL,
+                post_id     INT NOT NULL,
+                page        INT NOT NULL,
+                name        TEXT,
+                path        TEXT NOT NULL,
+                state       TEXT NOT NULL DEFAULT 'pending',
+                size        INT,
+                checksum    TEXT,
+                PRIMARY KEY (service, post_id, page)
+            );
+
+            CREATE TABLE IF NOT EXISTS hash
+            (
+                sha256      TEXT NOT NULL,
+                path        TEXT NOT NULL,
+                size        INT,
+                checksum    TEXT,
+                PRIMARY KEY (sha256)
+            );
+
+            CREATE TABLE IF NOT EXISTS creator
+            (
+                service             TEXT NOT NULL,
+                id                  TEXT NOT NULL,
+                updated             TEXT,
+                newest_published    DATETIME,
+                PRIMARY KEY (service, id)
+            );
         """
         self.cursor.executescript(sql)
 
+    def load_index(self, spider):
+        index = super().load_index(spider)
+        sql = f"SELECT DISTINCT post_id FROM media WHERE service = ? AND state NOT IN ('{MEDIA_DONE}', '{MEDIA_404}');"
+        for service in self.index_tables:
+            index[f"{service}_incomplete"] = KnownIdIndex.from_query(self.cursor, sql, (service,))
+        # 已下载文件的 sha256: (路径, 大小, md5)，其他作品里的同一个文件直接链接过去
+        spider.hashes = {sha256: (path, size, checksum) for sha256, path, size, checksum in self.cursor.execute("SELECT * FROM hash;")}
+        return index
+
 
     def process_item(self, item, spider):
         if item["service"] == "fanbox":
@@ -63,24 +165,197 @@ class KemonoDBPipeline(SqlitePipeline):
                 "title": item["title"]
             }
             self.insert(item["service"], data)
+            self.index[item["service"]].add(item["id"])
         else:
-            return DropItem("不支持的service！")
+            # 不入库也要放行，不然这个作者的扫描进度一直等着它
+            spider.item_stored((item["service"], str(item["user_id"])), item["id"])
+            raise DropItem("不支持的service！")
+
+        states = self.media_states(item, len(item["file"]))
+        for i, f in enumerate(item["file"]):
+            if i not in states:     # 续传时已经下载完的附件不用动
+                continue
+            state = states[i]
+            data = {
+                "service": item["service"],
+                "post_id": item["id"],
+                "page": i,
+                "name": f["name"],
+                "path": f["path"],
+                "state": state["state"],
+                "size": state["size"],
+                "checksum": state["checksum"],
+            }
+            self.insert("media", data)
+            sha256 = path_sha256(f["path"])
+            if sha256 and state["state"] == MEDIA_DONE and state.get("path"):
+                self.insert("hash", {"sha256": sha256, "path": state["path"], "size": state["size"], "checksum": state["checksum"]})
+        spider.item_stored((item["service"], str(item["user_id"])), item["id"])
         spider.log(f'[{item["service"]}] [{item["user_id"]}] [{item["id"]}] database save', NOTICE)
+        incomplete = self.index[f'{item["service"]}_incomplete']
+        if self.is_incomplete(states):
+            incomplete.add(item["id"])
+            raise DropItem("download fail")
+        incomplete.discard(item["id"])
         return item
 
 
 
+class DownloadBudget:
+    # 同时下载中的文件总大小和数量的上限，超过时后面的附件排队，等前面的下载完再开始
+    # 大小不知道时先按已下载文件的平均大小估计，收到响应头后按 Content-Length 修正
+    def __init__(self, max_bytes, max_files):
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self.bytes = 0
+        self.charges = {}       # {请求的key: 占用的大小}
+        self.waiting = deque()  # (key, 大小, Deferred)
+        self.done = [0, 0]      # 已下载的 (文件数, 总大小)
+        self.peak = 0
+
+    def guess(self):
+        count, total = self.done
+        return total // count if count else 4 * 1024 * 1024
+
+    def acquire(self, key, size=None):
+        dfd = Deferred()
+        self.waiting.append((key, size or self.guess(), dfd))
+        self._admit()
+        return dfd
+
+    def resize(self, key, size):
+        if key in self.charges:
+            self.bytes += size - self.charges[key]
+            self.charges[key] = size
+            self.peak = max(self.peak, self.bytes)
+            self._admit()
+
+    def release(self, key, size=None):
+        if key not in self.charges:
+            return
+        self.bytes -= self.charges.pop(key)
+        if size:
+            self.done[0] += 1
+            self.done[1] += size
+        self._admit()
+
+    def _admit(self):
+        # 按顺序放行，队头放不下时后面的也不放，避免大文件一直等不到
+        # 没有下载中的文件时，比上限还大的文件也放行
+        while self.waiting:
+            key, size, dfd = self.waiting[0]
+            if self.charges and (len(self.charges) >= self.max_files or self.bytes + size > self.max_bytes):
+                break
+            self.waiting.popleft()
+            self.charges[key] = size
+            self.bytes += size
+            self.peak = max(self.peak, self.bytes)
+            dfd.callback(None)
+
+
 class KemonoFilesPipeline(BaseFilesPipeline):
+    urls_field = "file"
+
+    def __init__(self, store_uri, download_func=None, settings=None):
+        super().__init__(store_uri, download_func=download_func, settings=settings)
+        if isinstance(settings, dict) or settings is None:
+            settings = Settings(settings)
+        max_bytes = settings.getint("STD_KEMONO_INFLIGHT_BYTES", 256 * 1024 * 1024)
+        max_files = settings.getint("STD_KEMONO_INFLIGHT_FILES", 32)
+        self.budget = DownloadBudget(max_bytes, max_files) if max_bytes > 0 and max_files > 0 else None
+
+    def open_spider(self, spider):
+        super().open_spider(spider)
+        if self.budget:
+            self.crawler.signals.connect(self._headers_received, signal=signals.headers_received)
+
+    def close_spider(self, spider):
+        if self.budget:
+            spider.crawler.stats.set_value("budget/peak_bytes", self.budget.peak, spider=spider)
 
     def get_media_requests(self, item, info):
+        priority = self.media_priority(item, info)
         return [
             scrapy.Request(
                 f"https://kemono.su/data{u['path']}", 
                 callback=NO_CALLBACK, 
-                meta={"progress_bar_name": f"R{i+1}"}
-            ) for i, u in enumerate(item["file"])
+                meta={"progress_bar_name": f"R{i+1}"},
+                priority=priority,
+            ) for i, u in self.iter_media(item)
         ]
 
+    def expected_checksum(self, request, item):
+        sha256 = path_sha256(urlparse(request.url).path)
+        return ("sha256", sha256) if sha256 else None
+
+    def reuse_media(self, request, info, item):
+        # 别的作品、重新上传、别的作者/服务里下载过同一个文件，直接链接到这个作品的目录
+        checksum = self.expected_checksum(request, item)
+        known = checksum and getattr(info.spider, "hashes", {}).get(checksum[1])
+        if not known or not isinstance(self.store, FSFilesStore):
+            return None
+        src, size, md5 = known
+        path = self.file_path(request, info=info, item=item)
+        if src == path or not self._link_media(info, src, path):  # 原文件被删了就重新下载
+            return None
+        info.spider.crawler.stats.inc_value("dedup/requests_saved", spider=info.spider)
+        return {"url": request.url, "path": path, "checksum": md5, "status": "linked", "size": size}
+
+    def _link_media(self, info, src, path):
+        src_abs = self.store._get_filesystem_path(src)
+        if not os.path.exists(src_abs):
+            return False
+        method = link_file(src_abs, self.store._get_filesystem_path(path))
+        stats = info.spider.crawler.stats
+        self.inc_stats(info.spider, "linked")
+        stats.inc_value(f"dedup/{method}", spider=info.spider)
+        stats.inc_value("dedup/bytes_saved", os.path.getsize(src_abs), spider=info.spider)
+        info.spider.log(f"链接已有文件 {src} -> {path}", logging.DEBUG)
+        return True
+
+    def _prepare_stream(self, result, request, info, item):
+        # 要下载的附件先排队等下载额度
+        if result is not None or self.budget is None:
+            return super()._prepare_stream(result, request, info, item)
+        request.meta["budget_key"] = key = self._fingerprinter.fingerprint(request)
+        dfd = self.budget.acquire(key)
+        if not dfd.called:
+            info.spider.crawler.stats.inc_value("budget/waited", spider=info.spider)
+        dfd.addCallback(super()._prepare_stream, request, info, item)
+        return dfd
+
+    def media_to_download(self, request, info, *, item=None):
+        dfd = super().media_to_download(request, info, item=item)
+        return dfd.addBoth(self._pass_budget, request)
+
+    def _pass_budget(self, result, request):
+        # 分段下载完了或者准备下载时出错，不会再走 media_downloaded/media_failed，这里就还额度
+        if result is not None:
+            self._release_budget(result, request)
+        return result
+
+    def media_downloaded(self, response, request, info, *, item=None):
+        # 416 时会重新下载，返回的是 Deferred，等它结束再还额度
+        dfd = maybeDeferred(super().media_downloaded, response, request, info, item=item)
+        return dfd.addBoth(self._release_budget, request)
+
+    def media_failed(self, failure, request, info):
+        self._release_budget(failure, request)
+        return super().media_failed(failure, request, info)
+
+    def _release_budget(self, result, request):
+        key = request.meta.pop("budget_key", None)
+        if self.budget and key is not None:
+            size = result.get("size") if isinstance(result, dict) else None
+            self.budget.release(key, size)
+        return result
+
+    def _headers_received(self, headers, body_length, request, spider):
+        # 重定向的响应不算，等真正的文件响应；没有 Content-Length 时 body_length 是 twisted 的 UNKNOWN_LENGTH（字符串）
+        key = request.meta.get("budget_key")
+        if key and isinstance(body_length, int) and body_length >= 0 and b"Location" not in headers:
+            self.budget.resize(key, body_length)
+
     def _path_by_item(self, item, name):
         user_id = item['user_id']
         service = item["service"]
@@ -108,13 +383,27 @@ class KemonoFilesPipeline(BaseFilesPipeline):
     def item_completed(self, results, item, info):
         # 下载完成后，验证下载成功
         super().item_completed(results, item, info)
+        # 这次下载的文件马上加到 hash 索引里，后面的作品就能直接用
+        hashes = getattr(info.spider, "hashes", {})
+        for f in item.get("files") or ():
+            if f["state"] != MEDIA_DONE or not f["path"]:
+                continue
+            media = item["file"][f["page"]]
+            # 同一次运行里链接相同的文件 scrapy 只下载一次，其他作品拿到的是第一个作品里的路径
+            path = self._path_by_item(item, f'{f["page"]+1}_{media["name"]}')
+            if f["path"] != path and isinstance(self.store, FSFilesStore):
+                if not os.path.exists(self.store._get_filesystem_path(path)) and self._link_media(info, f["path"], path):
+                    f["path"] = path
+            sha256 = path_sha256(media["path"])
+            if sha256:
+                hashes.setdefault(sha256, (f["path"], f["size"], f["checksum"]))
         content = item["content"].encode('utf-8')
         if content:
             path = self.content_path(item)
             buf = BytesIO(content)
             buf.seek(0)
             self.store.persist_file(path, buf, info)
-        if results:
+        if results and self.is_complete(item):
             info.spider.log(f'[{item["service"]}][{item["id"]}] download success', logging.INFO)
         return item
 
@@ -127,6 +416,8 @@ class KemonoSpider(BaseSpider):
     name = "kemono"
     allowed_domains = ["kemono.su"]
     start_urls = ["https://kemono.su"]
+    poll_plan = False   # creators.txt 一个请求就能知道所有作者有没有更新，不用按发布频率估计
+    author_checks = True
 
     # 自定义setting
     custom_settings = {
@@ -143,26 +434,79 @@ class KemonoSpider(BaseSpider):
         "LOG_LEVEL": "WARNING",
         "LOG_FILE": GetLogFileName("kemono"),
         "DOWNLOAD_WARNSIZE": 1024 * 1024 * 1024 * 1,
-        "CONCURRENT_ITEMS": 1,  # 限制处理中的item数量
     }
 
+    def __init__(self, name=None, **kwargs):
+        super().__init__(name, **kwargs)
+        self._resumed = set()
+
     def start_requests(self):
         # https://kemono.su/api/v1/fanbox/user/14496985
         if getattr(self, "sp_user", None):
-            ulst = [self.sp_user.split(",")]
+            yield self._scan_request(*self.sp_user.split(","))
         else:
-            ulst = self.config.keys()    
+            yield from self.check_authors(self.config.keys())
+
+    def author_requests(self, ulst):
+        # 先拿所有作者的更新时间，没更新的作者不用扫
+        url = "https://kemono.su/api/v1/creators.txt"
+        yield scrapy.Request(url=url, callback=self.creators_parse, errback=self.creators_failed, dont_filter=True,
+                             cb_kwargs={"ulst": list(ulst)})
+
+    def creators_parse(self, response, ulst):
+        # ex: [{"favorited": 1, "id": "14496985", "indexed": 1622000000, "name": "xx", "service": "fanbox", "updated": 1700000000}, ...]
+        updated = {(c["service"], str(c["id"])): str(c["updated"]) for c in json.loads(response.text)}
         for service, user in ulst:
-            cb_kwargs = {
-                "user": str(user),
-                "service": service,
-            }
-            url = f"https://kemono.su/api/v1/{service}/user/{user}"
-            self.log(f"[{user}] [{service}] scaner", NOTICE)
-            yield scrapy.Request(url=url, callback=self.parse, dont_filter=True, cb_kwargs=cb_kwargs)
+            now = updated.get((service, str(user)))
+            last, _ = self._creator(service, user)
+            if not self.force and now is not None and now == last:
+                self.log(f"[{user}] [{service}] 没有更新，跳过", NOTICE)
+                self.author_checked((service, user))
+                yield from self._resume_items(service, str(user))
+                continue
+            yield self._scan_request(service, user, updated=now)
+
+    def creators_failed(self, failure):
+        self.log(f"作者列表请求失败，扫描所有作者: {failure.getErrorMessage()}", logging.WARNING)
+        for service, user in failure.request.cb_kwargs["ulst"]:
+            yield self._scan_request(service, user)
+
+    def _creator(self, service, user):
+        # (上次完整扫描时 creators.txt 里的更新时间, 上次完整扫描时最新作品的发布时间)
+        sql = "SELECT updated, newest_published FROM creator WHERE service = ? AND id = ?;"
+        return self.cursor.execute(sql, (service, str(user))).fetchone() or (None, None)
+
+    def _scan_request(self, service, user, updated=None):
+        cb_kwargs = {
+            "user": str(user),
+            "service": service,
+            "updated": updated,
+            "until": None if self.force else self._creator(service, user)[1],
+        }
+        url = f"https://kemono.su/api/v1/{service}/user/{user}"
+        self.log(f"[{user}] [{service}] scaner", NOTICE)
+        return scrapy.Request(url=url, callback=self.parse, dont_filter=True, cb_kwargs=cb_kwargs)
+
+    def _finish_scan(self, cb_kwargs):
+        # 完整扫描完、交出去的作品也都入库了才记录，中断的话下次还从头扫到上次的位置
+        data = {"service": cb_kwargs["service"], "id": cb_kwargs["user"]}
+        if cb_kwargs.get("updated") is not None:
+            data["updated"] = cb_kwargs["updated"]
+        dates = [d for d in (cb_kwargs.get("newest"), cb_kwargs.get("until")) if d]
+        if dates:
+            data["newest_published"] = max(dates, key=datetime.fromisoformat)
+        self.write_when_stored((cb_kwargs["service"], cb_kwargs["user"]), upsert_sql("creator", tuple(data), ("service", "id")), tuple(data.values()))
 
     def parse(self, response, **cb_kwargs):
         result = json.loads(response.text)
+        if not cb_kwargs.get("page"):
+            self.author_checked((cb_kwargs["service"], cb_kwargs["user"]))
+            yield from self._resume_items(cb_kwargs["service"], cb_kwargs["user"])
+            if result:  # 作品从新到旧排列
+                cb_kwargs["newest"] = result[0]["published"]
+        # 翻到上次完整扫描时最新的作品就不用再往下翻了
+        until = cb_kwargs.get("until")
+        caught_up = until and any(datetime.fromisoformat(d["published"]) <= datetime.fromisoformat(until) for d in result)
         self.add_total(len(result))
         for data in result:
             if data["file"] and data["file"] not in data["attachments"]:
@@ -185,22 +529,63 @@ class KemonoSpider(BaseSpider):
                 self.log(f"跳过 {service}-{pid}", logging.INFO)
                 self.add_skip()
                 continue
+            if self._check_incomplete(kitem["service"], kitem["id"]):
+                if (service, pid) in self._resumed:
+                    self.add_total(-1)
+                    continue
+                kitem["pages"] = self._missing_pages(kitem["service"], kitem["id"])
+            self.hold_item((cb_kwargs["service"], cb_kwargs["user"]), pid)
             yield kitem
              
-        if len(result) == 50:
+        if len(result) == 50 and not caught_up:
             cb_kwargs["page"] = cb_kwargs.get("page", 0) + 50
             url = f"https://kemono.su/api/v1/{cb_kwargs['service']}/user/{cb_kwargs['user']}?o={cb_kwargs['page']}"
-            yield scrapy.Request(url=url, callback=self.parse, dont_filter=True, cb_kwargs=cb_kwargs)
+            # 下一页的作品都比这一页最后一个旧，按它排，第一页是默认的 0，先于所有作者的后面几页
+            priority = self.fresh_priority(result[-1]["published"])
+            yield scrapy.Request(url=url, callback=self.parse, dont_filter=True, priority=priority, cb_kwargs=cb_kwargs)
+        else:
+            self._finish_scan(cb_kwargs)
+
+    def _resume_items(self, service, user):
+        # 没下载完的作品直接从数据库续传，不用等扫描翻到
+        if self.force or service not in self.index:
+            return
+        sql = f"""
+            SELECT id, title, upload_date FROM `{service}` WHERE user_id = ? AND id IN
+            (SELECT post_id FROM media WHERE service = ? AND state NOT IN ('{MEDIA_DONE}', '{MEDIA_404}'));
+        """
+        for pid, title, upload_date in self.cursor.execute(sql, (user, service)).fetchall():
+            sql = "SELECT name, path FROM media WHERE service = ? AND post_id = ? ORDER BY page;"
+            kitem = KemonoItem()
+            kitem["user_id"] = user
+            kitem["title"] = title
+            kitem["service"] = service
+            kitem["upload_date"] = datetime.fromisoformat(upload_date)
+            kitem["id"] = str(pid)
+            kitem["file"] = [{"name": name, "path": path} for name, path in self.cursor.execute(sql, (service, pid)).fetchall()]
+            kitem["content"] = ""   # 内容第一次已经保存过了
+            kitem["pages"] = self._missing_pages(service, pid)
+            self._resumed.add((service, str(pid)))
+            self.add_total(1)
+            self.log(f"[{service}-{pid}] 续传附件: {kitem['pages']}", logging.INFO)
+            yield kitem
     
     def _check_download(self, service, pid):
         if self.force:
             return False
-        sql = f"SELECT * FROM {service} WHERE id = {pid}"
-        result = self.cursor.execute(sql).fetchall()
-        if result:
-            if None in result[0]:   # 某个字段为空，重新爬，因为理论上不会有字段为空
-                return False
-        return bool(result)
+        index = self.index.get(service)
+        return index is not None and pid in index and not self._check_incomplete(service, pid)
+
+    def _check_incomplete(self, service, pid):
+        if self.force:
+            return False
+        index = self.index.get(f"{service}_incomplete")
+        return index is not None and pid in index
+
+    def _missing_pages(self, service, pid):
+        # 上次没下载成功的附件
+        sql = f"SELECT page FROM media WHERE service = ? AND post_id = ? AND state NOT IN ('{MEDIA_DONE}', '{MEDIA_404}');"
+        return [page for page, in self.cursor.execute(sql, (service, pid))]
     
 
 
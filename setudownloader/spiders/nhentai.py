@@ -1,51 +1,220 @@
 import json
+import time
+from collections import deque
 from pathlib import Path
 import re
 from urllib.parse import urlparse
 import scrapy
 import logging
 from datetime import datetime
-from setudownloader.pipelines import BaseFilesPipeline, ProgressBarsPipeline, SqlitePipeline
+from setudownloader.pipelines import MEDIA_404, MEDIA_DONE, MEDIA_FAILED, MEDIA_STATE_COLUMNS, BaseFilesPipeline, ProgressBarsPipeline, SqlitePipeline
+from setudownloader.database import KnownIdIndex, upsert_sql
 from setudownloader.middlewares import BaseDownloaderMiddleware
 from setudownloader.define import NOTICE, GetLogFileName
 import scrapy.signals
+from scrapy.exceptions import IgnoreRequest
 from scrapy.http.request import NO_CALLBACK
 from setudownloader.spiders import BaseSpider
-from bs4 import BeautifulSoup
 from scrapy.pipelines.files import FileException
+from twisted.internet.defer import Deferred
 
 class NHItem(scrapy.Item):
+    # 一个画廊一个item，url 是所有页的链接，第 i 个是第 i+1 页
     title = scrapy.Field()
     title_jpn = scrapy.Field()
     filecount = scrapy.Field()
     gid = scrapy.Field()
 
     url = scrapy.Field()
-    page = scrapy.Field()
+    pages = scrapy.Field()  # 这次要下载的页（url 的下标），续传时只有缺的页
+    files = scrapy.Field()  # 每页的下载结果，失败的页也记下来，下次只补这些页
+
+
+class NHMirrors:
+    # nhentai 的图片在几个图片节点上路径都一样，按实际下载的首字节延迟和速度给节点打分
+    # 同时下载的图片数量有上限，轮到一个请求时再选预计最快完成的节点（同时下载中的请求越多越慢）
+    # 不在排队时就选好，不然整个画廊的请求在测出速度之前就分完了，失败的节点冷却一段时间
+    ALPHA = 0.3     # 指数移动平均的权重
+
+    def __init__(self, hosts, limit, cooldown=30):
+        self.hosts = list(hosts)
+        self.limit = max(limit, 1)
+        self.cooldown = cooldown
+        self.stats = {host: {"latency": None, "speed": None, "inflight": 0, "fails": 0, "down_until": 0} for host in self.hosts}
+        self.size = None    # 平均文件大小
+        self.inflight = 0
+        self.waiting = deque()  # (不选的节点, Deferred)
+
+    def __contains__(self, host):
+        return host in self.stats
+
+    def _ewma(self, old, new):
+        return new if old is None else old + self.ALPHA * (new - old)
+
+    def estimate(self, host):
+        # 预计这个节点下载一个文件要多久，没下载过的节点先试一个请求，结果回来之前不再分给它
+        st = self.stats[host]
+        if st["latency"] is None:
+            return float("inf") if st["inflight"] else 0
+        transfer = self.size / st["speed"] if self.size and st["speed"] else 0
+        return (st["latency"] + transfer) * (1 + st["inflight"])
+
+    def pick(self, exclude=()):
+        hosts = [h for h in self.hosts if h not in exclude]
+        if not hosts:
+            return None
+        now = time.monotonic()
+        # 全部都在冷却的话也只能选一个最快的
+        healthy = [h for h in hosts if self.stats[h]["down_until"] <= now] or hosts
+        return min(healthy, key=self.estimate)
+
+    def acquire(self, exclude=()):
+        # 返回的 Deferred 在轮到这个请求时带着选好的节点触发
+        dfd = Deferred()
+        self.waiting.append((exclude, dfd))
+        self._admit()
+        return dfd
+
+    def _admit(self):
+        while self.waiting and self.inflight < self.limit:
+            exclude, dfd = self.waiting.popleft()
+            host = self.pick(exclude)
+            if host:
+                self.inflight += 1
+                self.stats[host]["inflight"] += 1
+            dfd.callback(host)
+
+    def release(self, host):
+        self.inflight -= 1
+        self.stats[host]["inflight"] -= 1
+        self._admit()
+
+    def done(self, host, latency, transfer, size):
+        st = self.stats[host]
+        st["fails"] = 0
+        st["latency"] = self._ewma(st["latency"], latency)
+        if size:
+            self.size = self._ewma(self.size, size)
+            if transfer > 0:
+                st["speed"] = self._ewma(st["speed"], size / transfer)
+        self.release(host)
+
+    def fail(self, host):
+        # 连续失败的节点冷却时间翻倍
+        st = self.stats[host]
+        st["fails"] += 1
+        st["down_until"] = time.monotonic() + self.cooldown * 2 ** min(st["fails"] - 1, 5)
+        self.release(host)
 
 
 class NHDownloadMiddleware(BaseDownloaderMiddleware):
+    def __init__(self, settings) -> None:
+        super().__init__(settings)
+        hosts = settings.getlist("STD_NHENTAI_IMAGE_HOSTS")
+        cooldown = settings.getint("STD_NHENTAI_MIRROR_COOLDOWN", 30)
+        self.mirrors = NHMirrors(hosts, settings.getint("CONCURRENT_REQUESTS"), cooldown) if hosts else None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        s = super().from_crawler(crawler)
+        crawler.signals.connect(s.headers_received, signal=scrapy.signals.headers_received)
+        return s
+
     def process_request(self, request, spider):
         super().process_request(request, spider)
         request.headers['Referer'] = 'https://nhentai.net/'
+        if self.mirrors is None or "mirror_start" in request.meta:
+            return None
+        # 图片请求排队，轮到时按节点的速度分配
+        url = request.meta.get("mirror_url", request.url)
+        if urlparse(url).netloc not in self.mirrors:
+            return None
+        dfd = self.mirrors.acquire(request.meta.get("mirror_tried", ()))
+        dfd.addCallback(self._assign, request, url, spider)
+        return dfd
+
+    def _assign(self, mirror, request, url, spider):
+        if mirror is None:
+            return None
+        spider.crawler.stats.inc_value(f"mirror/picked/{mirror}", spider=spider)
+        meta = {**request.meta, "mirror": mirror, "mirror_url": url, "mirror_start": time.monotonic()}
+        return request.replace(url=urlparse(url)._replace(netloc=mirror).geturl(), meta=meta, dont_filter=True)
+
+    def headers_received(self, headers, body_length, request, spider):
+        if "mirror_start" in request.meta:
+            request.meta["mirror_headers"] = time.monotonic()
+
+    def _finish(self, request):
+        # 这次下载结束，RetryMiddleware 重试时重新排队选节点
+        request.meta.pop("mirror_start")
+        request.meta.pop("mirror_headers", None)
+        return request.meta["mirror"]
+
+    def _failover(self, request, spider, reason):
+        # 这个节点下载失败，换一个还没试过的节点
+        mirror = self._finish(request)
+        self.mirrors.fail(mirror)
+        tried = (*request.meta.get("mirror_tried", ()), mirror)
+        if not self.mirrors.pick(tried):
+            return None
+        spider.log(f"图片节点 {mirror} 失败({reason})，换节点: {request.meta['mirror_url']}", logging.INFO)
+        spider.crawler.stats.inc_value("mirror/failover", spider=spider)
+        meta = {**request.meta, "mirror_tried": tried}
+        return request.replace(url=request.meta["mirror_url"], meta=meta, dont_filter=True)
+
+    def _not_found(self, request, spider):
+        # 404 多半是这页本来就没有，不是节点的问题，不算节点失败，只换一个节点确认一次
+        mirror = self._finish(request)
+        self.mirrors.release(mirror)
+        if request.meta.get("mirror_404"):
+            return None
+        tried = (*request.meta.get("mirror_tried", ()), mirror)
+        if not self.mirrors.pick(tried):
+            return None
+        spider.log(f"图片节点 {mirror} 404，换一个节点确认: {request.meta['mirror_url']}", logging.INFO)
+        spider.crawler.stats.inc_value("mirror/recheck_404", spider=spider)
+        meta = {**request.meta, "mirror_tried": tried, "mirror_404": True}
+        return request.replace(url=request.meta["mirror_url"], meta=meta, dont_filter=True)
 
-    
     def process_response(self, request, response, spider: scrapy.Spider):
+        if "mirror_start" in request.meta:
+            if response.status == 404:
+                retry = self._not_found(request, spider)
+                if retry:
+                    return retry
+            elif response.status >= 500 or response.status in [429, 403]:
+                retry = self._failover(request, spider, response.status)
+                if retry:
+                    return retry
+            else:
+                now = time.monotonic()
+                headers_at = request.meta.get("mirror_headers", now)
+                stream = request.meta.get("stream_file")
+                size = stream.size if stream is not None and stream.opened else len(response.body)
+                # download_latency 是下载器发出请求到收到响应头的时间，不含排队
+                latency = request.meta.get("download_latency", headers_at - request.meta["mirror_start"])
+                self.mirrors.done(self._finish(request), latency, now - headers_at, size)
         if response.status in [429, 403]:
             spider.log(f"response.status = {response.status}", NOTICE)
             spider.crawler.engine.close_spider(spider, reason="request fail")
         elif response.status in [404]:
             spider.log(f"404Error url: <{request.url}>", logging.WARNING)
         return response
+
+    def process_exception(self, request, exception, spider):
+        if "mirror_start" not in request.meta:
+            return None
+        if isinstance(exception, IgnoreRequest):
+            self.mirrors.release(self._finish(request))
+            return None
+        return self._failover(request, spider, type(exception).__name__)
     
 
 class NHDBPipeline(SqlitePipeline):
     db_path = ".database/nhentai.db"
 
-    def open_spider(self, spider):
-        super().open_spider(spider)
-        self.build()
-        # self.check()
+    # media 表里有失败的页，已下载的索引在 load_index 里按状态查
+    index_tables = {}
 
     def build(self):
         # 修改数据库，要同时修改建库语句
@@ -68,33 +237,51 @@ class NHDBPipeline(SqlitePipeline):
             );
         """
         self.cursor.executescript(sql)
-    
+        self.add_columns("media", MEDIA_STATE_COLUMNS)
+
+    def load_index(self, spider):
+        index = super().load_index(spider)
+        sql = f"SELECT gallery_id, page FROM media WHERE state IN ('{MEDIA_DONE}', '{MEDIA_404}');"
+        index["media"] = KnownIdIndex() if getattr(spider, "force", False) else KnownIdIndex.from_query(self.cursor, sql)
+        return index
+
     def process_item(self, item, spider):
+        # 画廊和这次处理的所有页在一个事务里写入
         data = {
             "id": item["gid"],
             "title": item["title"],
             "title_jpn": item["title_jpn"],
             "count": item["filecount"],
         }
-        self.insert("gallery", data)
-        data = {
-            "gallery_id": item["gid"],
-            "page": item["page"],
-            "url": item["url"][0],
-        }
-        self.insert("media", data)
-        spider.log(f'{item["gid"]}-{item["page"]} database save', logging.INFO)
+        ops = [(upsert_sql("gallery", tuple(data)), tuple(data.values()))]
+        states = self.media_states(item, len(item["url"]))
+        for i, state in states.items():
+            data = {
+                "gallery_id": item["gid"],
+                "page": i + 1,
+                "url": item["url"][i],
+                "state": state["state"],
+                "size": state["size"],
+                "checksum": state["checksum"],
+            }
+            ops.append((upsert_sql("media", tuple(data), ("gallery_id", "page")), tuple(data.values())))
+        self.writer.transaction(ops)
+        done = [i + 1 for i, state in states.items() if state["state"] in (MEDIA_DONE, MEDIA_404)]
+        for page in done:
+            self.index["media"].add((item["gid"], page))
+        spider.log(f'{item["gid"]} database save: {len(done)}/{len(states)}', logging.INFO)
         return item
 
 
 class NHFilesPipeline(BaseFilesPipeline):
+    urls_field = "url"
 
     def get_media_requests(self, item, info):
-        return [scrapy.Request(u, meta={"progress_bar_name":self.get_file_name(u, item)}) for u in item["url"]]
+        return [scrapy.Request(u, meta={"progress_bar_name":self.get_file_name(u, item)}) for _, u in self.iter_media(item)]
 
     def get_file_name(self, url, item):
         _path = Path(urlparse(url).path)
-        return f"{item["page"]}-{_path.name}"
+        return f"{item["gid"]}-{_path.name}"
 
     def file_path(self, request, response=None, info=None, *, item=None):
         # 文件名处理
@@ -107,14 +294,25 @@ class NHFilesPipeline(BaseFilesPipeline):
     def item_completed(self, results, item, info):
         # 下载完成后，验证下载成功
         super().item_completed(results, item, info)
-        if results:
-            info.spider.log(f'{item["gid"]}-{item["page"]} download success: {[v.get("status") for k, v in results]}', NOTICE)
+        failed = [f["page"] + 1 for f in item["files"] if f["state"] == MEDIA_FAILED]
+        if failed:
+            info.spider.log(f'{item["gid"]} download fail pages: {failed}', logging.WARNING)
+        elif results:
+            info.spider.log(f'{item["gid"]} download success: {len(results)} pages', NOTICE)
         return item
 
 
 class NHProgressBarsPipeline(ProgressBarsPipeline):
     REQUEST_BAR_DEFAULT = False
 
+    def process_item(self, item, spider):
+        # 进度按页数算
+        failed = sum(f["state"] == MEDIA_FAILED for f in item["files"])
+        self.success.update(len(item["files"]) - failed)
+        if failed:
+            self.failures.update(failed)
+        return item
+
 
 
 class PixivSpider(BaseSpider):
@@ -132,7 +330,8 @@ class PixivSpider(BaseSpider):
             "setudownloader.spiders.nhentai.NHProgressBarsPipeline": 901,
         },
         "DOWNLOADER_MIDDLEWARES": {
-            "setudownloader.spiders.nhentai.NHDownloadMiddleware": 543,
+            # 在 RetryMiddleware(550) 之后处理响应，图片节点失败时先换节点，不在同一个节点上重试
+            "setudownloader.spiders.nhentai.NHDownloadMiddleware": 560,
         },
         "LOG_FILE": GetLogFileName(Path(__file__).stem),
         "LOG_LEVEL": "WARNING",
@@ -176,36 +375,38 @@ class PixivSpider(BaseSpider):
             "p": "png",
         }
         self.add_total(counts)
+        urls = []
+        pages = []
         page = 0
         for p in result["images"]["pages"]:
             page += 1
-            if self._check_pid_download(gid, page):
-                self.log(f"跳过{gid}-{page}", logging.DEBUG)
-                self.add_skip()
-                continue
             if p["t"] not in ext_dict:
                 self.log(f"类型不支持: {page}, {p}", logging.ERROR)
                 return
-            
             ext = ext_dict[p["t"]]
-            item = NHItem()
-            item["title"] = result["title"].get("english", "")
-            item["title_jpn"] = result["title"].get("japanese", "")
-            item["filecount"] = int(counts)
-            item["gid"] = int(gid)
-            item["url"] = [f"https://i7.nhentai.net/galleries/{media_id}/{page}.{ext}"]
-            item["page"] = page
-            yield item
+            urls.append(f"https://i7.nhentai.net/galleries/{media_id}/{page}.{ext}")
+            if self._check_pid_download(gid, page):
+                self.log(f"跳过{gid}-{page}", logging.DEBUG)
+                self.add_skip()
+                continue
+            pages.append(page - 1)
+        if not pages:
+            return
+
+        # 整个画廊一个item，缺的页在文件管道里同时下载
+        item = NHItem()
+        item["title"] = result["title"].get("english", "")
+        item["title_jpn"] = result["title"].get("japanese", "")
+        item["filecount"] = int(counts)
+        item["gid"] = int(gid)
+        item["url"] = urls
+        item["pages"] = pages
+        yield item
 
     def _check_pid_download(self, gid, page):
         if self.force:
             return False
-        sql = f"SELECT * FROM media WHERE gallery_id = {gid} and page = {page}"
-        result = self.cursor.execute(sql).fetchall()
-        if result:
-            if None in result[0]:   # 某个字段为空，重新爬，因为理论上不会有字段为空
-                return False
-        return bool(result)
+        return (gid, page) in self.index["media"]
     
    
 
@@ -1,15 +1,24 @@
 import json
+import re
+import time
+from bisect import bisect_right
+from collections import Counter, defaultdict
+from itertools import groupby
 from pathlib import Path
-from urllib.parse import urlparse
+from urllib.parse import urlencode, urlparse
 import scrapy
 import logging
 from datetime import datetime
-from setudownloader.pipelines import BaseFilesPipeline, ProgressBarsPipeline, SqlitePipeline
+from setudownloader.pipelines import MEDIA_404, MEDIA_DONE, MEDIA_FAILED, MEDIA_STATE_COLUMNS, BaseFilesPipeline, ProgressBarsPipeline, SqlitePipeline
+from setudownloader.database import KnownIdIndex
+from scrapy.exceptions import DropItem
 from setudownloader.middlewares import BaseDownloaderMiddleware
 from setudownloader.define import NOTICE, GetLogFileName
 import scrapy.signals
 from scrapy.http.request import NO_CALLBACK
+from twisted.internet.defer import DeferredList
 from setudownloader.spiders import BaseSpider
+from setudownloader.planner import timestamp
 
 class PixivItem(scrapy.Item):
     user_name = scrapy.Field() # 作者名
@@ -22,6 +31,10 @@ class PixivItem(scrapy.Item):
     upload_date = scrapy.Field()  # 上传日期
 
     urls = scrapy.Field()  # 所有图片原始链接
+    pages = scrapy.Field()  # 需要下载的页，None为全部
+    files = scrapy.Field()  # 每个文件的下载状态
+    urls_derived = scrapy.Field()  # 链接是按p0推算的，有页下载失败时再请求 /pages 拿真实链接
+    suffix_guessed = scrapy.Field()  # 扩展名也是猜的（批量接口只有缩略图），下载前按这次下载成功的扩展名重新猜
 
 
 class PixivDownloadMiddleware(BaseDownloaderMiddleware):
@@ -39,15 +52,16 @@ class PixivDownloadMiddleware(BaseDownloaderMiddleware):
         elif response.status in [404]:
             spider.log(f"404Error request user: {request.cb_kwargs.get("user_id")}, url: <{request.url}>", logging.WARNING)
         return response
+
+    def spider_opened(self, spider):
+        super().spider_opened(spider)
+        # 登录账号的UID，PHPSESSID 的格式是 "UID_随机串"
+        spider.account_id = next((c.value.split("_")[0] for c in self.cookies if c.name == "PHPSESSID" and "_" in c.value), None)
     
 
 class PixivDBPipeline(SqlitePipeline):
     db_path = ".database/pixiv.db"
-
-    def open_spider(self, spider):
-        super().open_spider(spider)
-        self.build()
-        # self.check()
+    index_tables = {"illust": ("illust", ("id",))}
 
     def build(self):
         # 修改数据库，要同时修改建库语句
@@ -79,6 +93,9 @@ class PixivDBPipeline(SqlitePipeline):
                 suffix      TEXT NOT NULL,
                 is_download BOOLEAN NOT NULL,
                 is_delete   BOOLEAN NOT NULL,
+                state       TEXT NOT NULL DEFAULT 'done',
+                size        INT,
+                checksum    TEXT,
                 PRIMARY KEY (illust_id, page),
                 FOREIGN KEY(illust_id) REFERENCES illust(id) ON DELETE CASCADE ON UPDATE CASCADE
             );
@@ -89,11 +106,17 @@ class PixivDBPipeline(SqlitePipeline):
         # 更新新字段时，可能会重新爬取大量元数据
         if update_sql:
             self.cursor.executescript(update_sql)
+        self.add_columns("media", MEDIA_STATE_COLUMNS)
+
+    def load_index(self, spider):
+        index = super().load_index(spider)
+        index["incomplete"] = self.check()
+        return index
     
     def check(self):
-        # 检查数据库没有下载的meida数据 TODO
-        sql = "SELECT * FROM media WHERE is_download = 0;"
-        obj = list(self.cursor.execute(sql))
+        # 检查数据库没有下载完的meida数据，这些作品下次只补下载缺的文件，不再请求元数据
+        sql = f"SELECT DISTINCT illust_id FROM media WHERE state NOT IN ('{MEDIA_DONE}', '{MEDIA_404}');"
+        return KnownIdIndex.from_query(self.cursor, sql)
 
     def process_item(self, item, spider):
         data = {
@@ -112,24 +135,44 @@ class PixivDBPipeline(SqlitePipeline):
         }
         self.insert("illust", data)
 
+        states = self.media_states(item, len(item["urls"]))
         for i, url in enumerate(item["urls"]):
+            if i not in states:     # 续传时已经下载完的页不用动
+                continue
+            state = states[i]
             data = {
                 "illust_id": item["illust_id"],
                 "page": i,
                 "url": url,
                 "suffix": Path(urlparse(url).path).suffix,
-                "is_download": True,
-                "is_delete": False
+                "is_download": state["state"] in (MEDIA_DONE, MEDIA_404),
+                "is_delete": False,
+                "state": state["state"],
+                "size": state["size"],
+                "checksum": state["checksum"],
             }
             self.insert("media", data)
+        self.index["illust"].add(item["illust_id"])
         spider.log(f'[{item["user_id"]}] {item["user_name"]} [{item["illust_id"]}] database save', NOTICE)
+        if self.is_incomplete(states):
+            self.index["incomplete"].add(item["illust_id"])
+            raise DropItem("download fail")
+        self.index["incomplete"].discard(item["illust_id"])
         return item
 
 
 class PixivFilesPipeline(BaseFilesPipeline):
+    ORIGINAL_SUFFIXES = (".png", ".jpg", ".gif")   # 原图只有这几种扩展名，按常见程度排
+
+    def open_spider(self, spider):
+        super().open_spider(spider)
+        self.suffixes = defaultdict(Counter)    # 作者UID: 这次下载成功的原图扩展名计数
 
     def get_media_requests(self, item, info):
-        return [scrapy.Request(u, callback=NO_CALLBACK, meta={"progress_bar_name":self.get_file_name(u)}) for u in item["urls"]]
+        if item.get("suffix_guessed") and item.get("pages") is None:
+            self._reguess_suffix(item)
+        priority = self.media_priority(item, info)
+        return [scrapy.Request(u, callback=NO_CALLBACK, meta={"progress_bar_name":self.get_file_name(u)}, priority=priority) for _, u in self.iter_media(item)]
 
     def get_file_name(self, url):
         _path = Path(urlparse(url).path)
@@ -146,10 +189,110 @@ class PixivFilesPipeline(BaseFilesPipeline):
     def item_completed(self, results, item, info):
         # 下载完成后，验证下载成功
         super().item_completed(results, item, info)
-        if results:
+        self._count_suffixes(item)
+        if item.get("urls_derived") and any(f["state"] != MEDIA_DONE for f in item["files"]):
+            return self.retry_suffixes(item, info, {})
+        if results and self.is_complete(item):
             info.spider.log(f'[{item["illust_id"]}] download success', logging.INFO)
         return item
 
+    def retry_suffixes(self, item, info, tried):
+        # 推算链接的扩展名是猜的，没下载成功的页先在图片服务器上换扩展名试，都试过了再请求 /pages
+        # tried: 页码: 这一页试过的扩展名
+        files = {f["page"]: f for f in item["files"]}
+        pages = []
+        for page, f in files.items():
+            if f["state"] == MEDIA_DONE:
+                continue
+            stem, suffix = item["urls"][page].rsplit(".", 1)
+            tried.setdefault(page, {"." + suffix})
+            left = [s for s in self.ORIGINAL_SUFFIXES if s not in tried[page]]
+            if left:
+                tried[page].add(left[0])
+                item["urls"][page] = stem + left[0]
+                pages.append(page)
+        if not pages:
+            return self.refetch_pages(item, info)
+        info.spider.crawler.stats.inc_value("pixiv/suffix_retry", len(pages), spider=info.spider)
+        old_pages = item.get("pages")
+        item["pages"] = pages
+        dlist = [self._process_request(r, info, item) for r in self.get_media_requests(item, info)]
+        dfd = DeferredList(dlist, consumeErrors=True)
+        dfd.addCallback(self._merge_suffixes, item, info, files, old_pages, tried)
+        return dfd
+
+    def _merge_suffixes(self, results, item, info, files, old_pages, tried):
+        BaseFilesPipeline.item_completed(self, results, item, info)
+        self._count_suffixes(item)
+        files.update((f["page"], f) for f in item["files"])
+        item["files"] = [files[page] for page in sorted(files)]
+        item["pages"] = old_pages
+        if any(f["state"] != MEDIA_DONE for f in item["files"]):
+            return self.retry_suffixes(item, info, tried)
+        if self.is_complete(item):
+            info.spider.log(f'[{item["illust_id"]}] download success', logging.INFO)
+        return item
+
+    def _reguess_suffix(self, item):
+        # 批量接口推算链接时只看了一个作品的扩展名，下载前按这个作者这次已经下载成功的重新猜
+        counts = self.suffixes[item["user_id"]]
+        if counts:
+            suffix = counts.most_common(1)[0][0]
+            item["urls"] = [url.rsplit(".", 1)[0] + suffix for url in item["urls"]]
+
+    def _count_suffixes(self, item):
+        if item["illust_type"] == 2:    # 动图是 zip
+            return
+        counts = self.suffixes[item["user_id"]]
+        for f in item["files"]:
+            if f["state"] == MEDIA_DONE:
+                counts["." + item["urls"][f["page"]].rsplit(".", 1)[1]] += 1
+
+    def refetch_pages(self, item, info):
+        # 换扩展名也下不到，请求 /pages 拿到真实链接，只重新下载链接变了的页
+        item["urls_derived"] = False
+        url = f'https://www.pixiv.net/ajax/illust/{item["illust_id"]}/pages'
+        dfd = self.crawler.engine.download(scrapy.Request(url, callback=NO_CALLBACK, dont_filter=True))
+        dfd.addCallback(self._redownload_pages, item, info)
+        dfd.addErrback(self._refetch_failed, item, info)
+        return dfd
+
+    def _redownload_pages(self, response, item, info):
+        result = json.loads(response.text)
+        if response.status != 200 or result["error"]:
+            raise ValueError(f"pages请求失败 data:{result}")
+        urls = [i["urls"]["original"] for i in result["body"]]
+        files = {f["page"]: f for f in item["files"]}
+        pages = [page for page, f in files.items() if f["state"] != MEDIA_DONE and page < len(urls) and urls[page] != item["urls"][page]]
+        info.spider.log(f'[{item["illust_id"]}] 推算链接失败，重新下载页: {pages}', logging.INFO)
+        item["urls"] = urls
+        if not pages:
+            return item
+        old_pages = item.get("pages")
+        item["pages"] = pages
+        dlist = [self._process_request(r, info, item) for r in self.get_media_requests(item, info)]
+        dfd = DeferredList(dlist, consumeErrors=True)
+        dfd.addCallback(self._merge_pages, item, info, files, old_pages)
+        return dfd
+
+    def _merge_pages(self, results, item, info, files, old_pages):
+        BaseFilesPipeline.item_completed(self, results, item, info)
+        self._count_suffixes(item)
+        files.update((f["page"], f) for f in item["files"])
+        item["files"] = [files[page] for page in sorted(files)]
+        item["pages"] = old_pages
+        if self.is_complete(item):
+            info.spider.log(f'[{item["illust_id"]}] download success', logging.INFO)
+        return item
+
+    def _refetch_failed(self, failure, item, info):
+        # 拿不到真实链接，推算链接的404不能当成文件不存在，标记失败下次续传
+        info.spider.log(f'[{item["illust_id"]}] pages请求失败: {failure.getErrorMessage()}', logging.WARNING)
+        for f in item["files"]:
+            if f["state"] == MEDIA_404:
+                f["state"] = MEDIA_FAILED
+        return item
+
 
 
 class PixivProgressBarsPipeline(ProgressBarsPipeline):
@@ -161,6 +304,8 @@ class PixivSpider(BaseSpider):
     name = "pixiv"
     allowed_domains = ["pixiv.net"]
     start_urls = ["https://pixiv.net"]
+    poll_plan = True
+    author_checks = True
 
     # 自定义setting
     custom_settings = {
@@ -176,6 +321,20 @@ class PixivSpider(BaseSpider):
         # "LOG_LEVEL": "DEBUG",
     }
 
+    account_id = None   # 登录账号的UID，下载中间件从cookie里取
+
+    def __init__(self, name=None, **kwargs):
+        super().__init__(name, **kwargs)
+        self._suffix_cache = {}    # 作者UID: 原图最常用的扩展名
+        self._follow_uids = set()   # 关注动态模式下要下载的作者
+        self._profile_queued = set()
+        self._feed_newest = 0       # 关注动态开始翻页前库里最新作品的ID
+        self._pid_dates = None      # ([已知作品ID], [对应的发布时间戳])，估计作品发布时间用
+
+    def _set_command_line_arguments(self):
+        super()._set_command_line_arguments()
+        self.follow = False     # 关注动态增量模式，只看关注作者的最新作品，没关注的作者还是全量查
+
     def start_requests(self):
         # https://www.pixiv.net/ajax/user/41989573/profile/all
         if self.sp_id:      # 按作品ID的模式
@@ -186,16 +345,95 @@ class PixivSpider(BaseSpider):
                     self.log(f"跳过pid: {pid}", logging.DEBUG)
                     self.add_skip()
                     continue
+                elif self._check_pid_incomplete(pid):
+                    # start_requests 里不能直接返回item，用 data: 空请求中转一下
+                    yield scrapy.Request("data:,", callback=self._resume_parse, dont_filter=True, cb_kwargs={"pid": pid})
                 else:
-                    url = f"https://www.pixiv.net/ajax/illust/{pid}"
-                    yield scrapy.Request(url=url, callback=self.illust_parse, dont_filter=True)
+                    yield self._illust_request(pid)
         else:           # 按作者ID的模式
             uids = list(self.config.keys())
             if self.sp_user:
                 uids = self.sp_user.split(",")
-            for uid in uids:
-                url = f"https://www.pixiv.net/ajax/user/{uid}/profile/all"
-                yield scrapy.Request(url=url, callback=self.profile_parse, dont_filter=True, cb_kwargs={"user_id": str(uid)})
+            if self.follow and self.account_id:
+                self._follow_uids = set(map(str, uids))
+                self._feed_newest = self.cursor.execute("SELECT MAX(id) FROM illust;").fetchone()[0] or 0
+                yield self._feed_request(1)
+                yield self._following_request("show", 0, set())
+                return
+            elif self.follow:
+                self.log("没有登录cookie，不能用关注动态模式，改为全量查询", logging.WARNING)
+            yield from self.start_authors(uids)
+
+    def author_requests(self, uids):
+        self._pid_dates = None  # 常驻模式下库里多了作品，重新估计
+        for uid in uids:
+            yield self._profile_request(uid)
+
+    def _profile_request(self, uid):
+        self._profile_queued.add(str(uid))
+        url = f"https://www.pixiv.net/ajax/user/{uid}/profile/all"
+        return scrapy.Request(url=url, callback=self.profile_parse, dont_filter=True, cb_kwargs={"user_id": str(uid)})
+
+    def _feed_request(self, page):
+        url = f"https://www.pixiv.net/ajax/follow_latest/illust?p={page}&mode=all"
+        return scrapy.Request(url=url, callback=self.feed_parse, dont_filter=True, cb_kwargs={"page": page})
+
+    def _following_request(self, rest, offset, following):
+        url = f"https://www.pixiv.net/ajax/user/{self.account_id}/following?offset={offset}&limit=100&rest={rest}"
+        return scrapy.Request(url=url, callback=self.following_parse, dont_filter=True,
+                              cb_kwargs={"rest": rest, "offset": offset, "following": following})
+
+    def feed_parse(self, response, page):
+        # 关注作者的最新作品，从新到旧翻页，翻到一页作品全部已入库就停
+        # ex: https://www.pixiv.net/ajax/follow_latest/illust?p=1&mode=all
+        result = json.loads(response.text)
+        if result["error"]:
+            self.log(f"关注动态请求失败，改为全量查询 data:{result}", logging.WARNING)
+            yield from map(self._profile_request, self._follow_uids - self._profile_queued)
+            return
+        body = result["body"]
+        thumbnails = body["thumbnails"]["illust"]
+        works = {w["id"]: w for w in thumbnails if w["userId"] in self._follow_uids}
+        # 这一页所有作者的作品都比开始前库里最新的旧或者已入库就翻到头了，没有要下载的作者的作品也算
+        # 要在生成item之前判断，item入库后会加到索引里
+        caught_up = thumbnails and all(int(w["id"]) <= self._feed_newest or w["id"] in self.index["illust"] for w in thumbnails)
+        self.add_total(len(works))
+        new_pids = defaultdict(list)
+        for pid, work in works.items():
+            if self._check_pid_download(pid):
+                self.log(f"跳过pid: {pid}", logging.DEBUG)
+                self.add_skip()
+            elif self._check_pid_incomplete(pid):
+                yield self._resume_item(pid)
+            else:
+                new_pids[work["userId"]].append(pid)
+        for user_id, pids in new_pids.items():
+            yield from self._batch_items(user_id, works, pids)
+
+        max_pages = self.settings.getint("STD_PIXIV_FOLLOW_MAX_PAGES")
+        if caught_up or body["page"]["isLastPage"] or page >= max_pages:
+            self.log(f"关注动态查到第{page}页结束", NOTICE)
+        else:
+            yield self._feed_request(page + 1)
+
+    def following_parse(self, response, rest, offset, following):
+        # 关注动态里只有关注了的作者，没关注的作者还要按 profile/all 全量查
+        # ex: https://www.pixiv.net/ajax/user/41989573/following?offset=0&limit=100&rest=show
+        result = json.loads(response.text)
+        if result["error"]:
+            self.log(f"关注列表请求失败 data:{result}", logging.WARNING)
+            users, total = [], 0
+        else:
+            users, total = result["body"]["users"], result["body"]["total"]
+        following.update(u["userId"] for u in users)
+        if users and offset + len(users) < total:
+            yield self._following_request(rest, offset + len(users), following)
+        elif rest == "show" and not result["error"]:    # 公开关注查完再查私密关注
+            yield self._following_request("hide", 0, following)
+        else:
+            unfollowed = self._follow_uids - following - self._profile_queued
+            self.log(f"关注 {len(following)} 人，没关注的作者 {len(unfollowed)} 人全量查询", NOTICE)
+            yield from map(self._profile_request, unfollowed)
 
     def profile_parse(self, response, **cb_kwargs):
         result = json.loads(response.text)
@@ -209,28 +447,190 @@ class PixivSpider(BaseSpider):
         artworks.extend(illusts)
         artworks.extend(manga)
         user_id = cb_kwargs.get("user_id")
+        self.author_checked(user_id)
         user_name = self.config.get(user_id, {}).get("path", "no name")
         self.log(f"[{user_id}] {user_name} 作品数量为：{len(artworks)}", NOTICE)
         self.add_total(len(artworks))
 
+        new_pids = []
         for pid in artworks:
             if self._check_pid_download(pid):
                 self.log(f"跳过pid: {pid}", logging.DEBUG)
                 self.add_skip()
                 continue
+            elif self._check_pid_incomplete(pid):
+                yield self._resume_item(pid)
             else:
-                url = f"https://www.pixiv.net/ajax/illust/{pid}"
-                yield scrapy.Request(url=url, callback=self.illust_parse, dont_filter=True)
+                new_pids.append(pid)
+        new_pids.sort(key=int, reverse=True)    # profile/all 是字典顺序，从新到旧排
+        yield from self._illusts_requests(user_id, new_pids)
+
+    def _illust_request(self, pid, priority=0):
+        url = f"https://www.pixiv.net/ajax/illust/{pid}"
+        return scrapy.Request(url=url, callback=self.illust_parse, dont_filter=True, priority=priority)
+
+    def _illusts_requests(self, user_id, pids):
+        # 同一个作者的作品一次最多请求 STD_PIXIV_BATCH_SIZE 个的元数据
+        # pids 从新到旧，按估计的发布时间分优先级，新作品和旧作品不放在一批里
+        batch_size = self.settings.getint("STD_PIXIV_BATCH_SIZE")
+        for priority, group in groupby(pids, key=lambda pid: self.fresh_priority(self._pid_date(pid))):
+            group = list(group)
+            if batch_size <= 0:
+                yield from (self._illust_request(pid, priority) for pid in group)
+                continue
+            for i in range(0, len(group), batch_size):
+                chunk = group[i:i + batch_size]
+                query = urlencode([("ids[]", pid) for pid in chunk] + [("work_category", "illustManga"), ("is_first_page", 0)])
+                url = f"https://www.pixiv.net/ajax/user/{user_id}/profile/illusts?{query}"
+                yield scrapy.Request(url=url, callback=self.illusts_parse, errback=self.illusts_failed, dont_filter=True,
+                                     priority=priority, cb_kwargs={"user_id": user_id, "pids": chunk})
+
+    def _pid_date(self, pid):
+        # profile/all 只有作品ID，ID 全站递增，按数据库里已知作品的 ID 和发布时间插值估计，比已知的都新的往后推
+        # 库里没有比它旧的作品时不知道，返回 None
+        if self._pid_dates is None:
+            ids, dates = [], []
+            # 以前存的是最后一次上传的时间，改过的旧作品会比后面的作品晚，从新到旧取最小值
+            for known, date in self.cursor.execute("SELECT id, upload_date FROM illust ORDER BY id DESC;"):
+                ids.append(known)
+                dates.append(min(timestamp(date), dates[-1]) if dates else timestamp(date))
+            self._pid_dates = ids[::-1], dates[::-1]
+        ids, dates = self._pid_dates
+        pid = int(pid)
+        if len(ids) < 2 or pid < ids[0]:
+            return None
+        i = bisect_right(ids, pid)
+        a, b = (i - 1, i) if i < len(ids) else (0, -1)
+        if ids[a] == ids[b]:
+            return dates[a]
+        return min(dates[a] + (pid - ids[a]) * (dates[b] - dates[a]) / (ids[b] - ids[a]), time.time())
+
+    def illusts_parse(self, response, user_id, pids):
+        # ex: https://www.pixiv.net/ajax/user/41989573/profile/illusts?ids[]=82775556&work_category=illustManga&is_first_page=0
+        result = json.loads(response.text)
+        works = {} if result["error"] else result["body"]["works"]
+        yield from self._batch_items(user_id, works, pids)
+
+    def _batch_items(self, user_id, works, pids):
+        # 用列表接口里的作品数据直接生成item
+        suffix = self._guess_suffix(user_id)
+        probe = [pid for pid in pids if works.get(str(pid), {}).get("illustType") in (0, 1) and works[str(pid)].get("pageCount") == 1][:1]
+        if suffix is None and probe:
+            # 新作者不知道原图扩展名，先完整请求一个作品看看
+            pids = [pid for pid in pids if pid not in probe]
+            yield scrapy.Request(url=f"https://www.pixiv.net/ajax/illust/{probe[0]}", callback=self.suffix_parse, dont_filter=True,
+                                 priority=self.fresh_priority(works[str(probe[0])].get("createDate")),
+                                 cb_kwargs={"user_id": user_id, "works": works, "pids": pids})
+            return
+        yield from self._works_items(works, pids, suffix or ".jpg")
+
+    def suffix_parse(self, response, user_id, works, pids):
+        original = json.loads(response.text)["body"]["urls"]["original"] or ""
+        self._suffix_cache[user_id] = Path(urlparse(original).path).suffix or ".jpg"
+        yield self.illust_parse(response)
+        yield from self._works_items(works, pids, self._suffix_cache[user_id])
+
+    def _works_items(self, works, pids, suffix):
+        for pid in pids:
+            work = works.get(str(pid))
+            item = self._work_item(work, suffix) if work else None
+            if item is None:    # 批量接口里没有或者缺字段的作品，单独请求
+                yield self._illust_request(pid, self.fresh_priority(self._pid_date(pid)))
+            elif item["illust_type"] == 2:  # 动图
+                page_url = f'https://www.pixiv.net/ajax/illust/{pid}/ugoira_meta'
+                yield scrapy.Request(page_url, callback=self.ugoira_parse, priority=self.fresh_priority(item["upload_date"]), cb_kwargs={"item": item})
+            elif item["page_count"] > 1:
+                # 多页的扩展名猜错了每页都是一个404，直接请求 /pages 拿真实链接
+                page_url = f'https://www.pixiv.net/ajax/illust/{pid}/pages'
+                yield scrapy.Request(page_url, callback=self.parse, priority=self.fresh_priority(item["upload_date"]), cb_kwargs={"item": item})
+            else:
+                yield item
+
+    def illusts_failed(self, failure):
+        kwargs = failure.request.cb_kwargs
+        self.log(f"[{kwargs['user_id']}] 批量请求元数据失败，改为逐个请求: {failure.getErrorMessage()}", logging.WARNING)
+        yield from (self._illust_request(pid, failure.request.priority) for pid in kwargs["pids"])
+
+    def _work_item(self, work, suffix):
+        # 批量接口只有缩略图，单页作品的原图链接按缩略图的日期路径推算，扩展名按这个作者以前的作品猜
+        # ex: https://i.pximg.net/c/250x250_80_a2/img-master/img/2020/06/30/00/00/00/82775556_p0_square1200.jpg
+        match = re.search(r"/img/(\d{4}/\d{2}/\d{2}/\d{2}/\d{2}/\d{2})/(\d+)_p0", work.get("url") or "")
+        if not match or not work.get("createDate"):
+            return None
+        item = PixivItem()
+        item["user_name"] = work["userName"]
+        item["user_id"] = int(work["userId"])
+        item["illust_id"] = int(work["id"])
+        item["illust_type"] = int(work["illustType"])
+        item["page_count"] = page_count = int(work["pageCount"])
+        # upload_date 存首次发布的时间，和逐个请求的作品一样，检查计划按它估计发布频率
+        item["upload_date"] = datetime.strptime(work["createDate"], "%Y-%m-%dT%H:%M:%S%z")
+        item["illust_title"] = work["title"]
+        item["urls"] = []
+        if item["illust_type"] != 2 and page_count == 1:
+            date, pid = match.groups()
+            item["urls"] = [f"https://i.pximg.net/img-original/img/{date}/{pid}_p0{suffix}"]
+            item["urls_derived"] = item["suffix_guessed"] = True
+        return item
+
+    def _guess_suffix(self, user_id):
+        if user_id not in self._suffix_cache:
+            sql = """
+                SELECT media.suffix FROM media JOIN illust ON media.illust_id = illust.id
+                WHERE illust.user_id = ? GROUP BY media.suffix ORDER BY COUNT(*) DESC LIMIT 1;
+            """
+            row = self.cursor.execute(sql, (user_id,)).fetchone()
+            if not row:
+                return None
+            self._suffix_cache[user_id] = row[0]
+        return self._suffix_cache[user_id]
     
+    def upload_history(self, limit):
+        sql = """
+            SELECT user_id, upload_date FROM (
+                SELECT user_id, upload_date, ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY upload_date DESC) AS n FROM illust
+            ) WHERE n <= ?;
+        """
+        history = {}
+        for user_id, upload_date in self.cursor.execute(sql, (limit,)):
+            history.setdefault(str(user_id), []).append(upload_date)
+        return history
+
     def _check_pid_download(self, pid):
         if self.force:
             return False
-        sql = f"SELECT * FROM illust WHERE id = {pid}"
-        result = self.cursor.execute(sql).fetchall()
-        if result:
-            if None in result[0]:   # 某个字段为空，重新爬，因为理论上不会有字段为空
-                return False
-        return bool(result)
+        return pid in self.index["illust"] and pid not in self.index["incomplete"]
+
+    def _check_pid_incomplete(self, pid):
+        if self.force:
+            return False
+        return pid in self.index["incomplete"]
+
+    def _resume_parse(self, response, pid):
+        return self._resume_item(pid)
+
+    def _resume_item(self, pid):
+        # 上次有文件没下载成功，从数据库还原item，只下载缺的页
+        sql = """
+            SELECT illust.user_id, user.name, illust.title, illust.type, illust.page_count, illust.upload_date
+            FROM illust LEFT JOIN user ON illust.user_id = user.id WHERE illust.id = ?;
+        """
+        user_id, user_name, title, illust_type, page_count, upload_date = self.cursor.execute(sql, (pid,)).fetchone()
+        sql = "SELECT page, url, state FROM media WHERE illust_id = ? ORDER BY page;"
+        medias = self.cursor.execute(sql, (pid,)).fetchall()
+        item = PixivItem()
+        item["user_name"] = user_name
+        item["user_id"] = user_id
+        item["illust_id"] = int(pid)
+        item["illust_title"] = title
+        item["illust_type"] = illust_type
+        item["page_count"] = page_count
+        item["upload_date"] = upload_date
+        item["urls"] = [url for _, url, _ in medias]
+        item["pages"] = [page for page, _, state in medias if state not in (MEDIA_DONE, MEDIA_404)]
+        item["urls_derived"] = True     # 库里的链接可能是推算的
+        self.log(f"[{pid}] 续传页: {item['pages']}", logging.INFO)
+        return item
     
 
     def illust_parse(self, response):
@@ -245,20 +645,26 @@ class PixivSpider(BaseSpider):
         item["illust_id"] = illust_id = int(result["illustId"])
         item["illust_type"] = illust_type = int(result["illustType"])
         item["page_count"] = page_count = int(result["pageCount"])
-        item["upload_date"] = datetime.strptime(result["uploadDate"], "%Y-%m-%dT%H:%M:%S%z")
+        item["upload_date"] = datetime.strptime(result.get("createDate") or result["uploadDate"], "%Y-%m-%dT%H:%M:%S%z")
         item["illust_title"] = result["title"]
         item["urls"] = []
         
         if illust_type == 2:    # 动图
             page_url = f'https://www.pixiv.net/ajax/illust/{illust_id}/ugoira_meta'
-            return scrapy.Request(page_url, callback=self.ugoira_parse, cb_kwargs={"item": item})
+            return scrapy.Request(page_url, callback=self.ugoira_parse, priority=self.fresh_priority(item["upload_date"]), cb_kwargs={"item": item})
         else:
+            original = result['urls']['original']
             if page_count == 1: # 只有一页就跳过, 减少请求次数:
-                item['urls'].append(result['urls']['original'])
+                item['urls'].append(original)
+                return item
+            elif original and "_p0." in original:
+                # 多页的原图链接只有页码不同 xxx_p0.png -> xxx_pN.png，直接推算，下载失败时再请求 /pages
+                item['urls'] = [original.replace("_p0.", f"_p{i}.") for i in range(page_count)]
+                item['urls_derived'] = True
                 return item
             else:
                 page_url = f'https://www.pixiv.net/ajax/illust/{illust_id}/pages'
-                return scrapy.Request(page_url, callback=self.parse, cb_kwargs={"item": item})
+                return scrapy.Request(page_url, callback=self.parse, priority=self.fresh_priority(item["upload_date"]), cb_kwargs={"item": item})
     
     def parse(self, response, item):
         result = json.loads(response.text)
@@ -4,9 +4,11 @@ from pathlib import Path
 import sqlite3
 import scrapy
 import logging
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 from setudownloader.define import NOTICE, NOTICE_WARN, GetLogFileName
-from setudownloader.pipelines import BaseFilesPipeline, ProgressBarsPipeline, SqlitePipeline
+from setudownloader.pipelines import MEDIA_404, MEDIA_DONE, MEDIA_STATE_COLUMNS, BaseFilesPipeline, ProgressBarsPipeline, SqlitePipeline
+from scrapy.exceptions import DropItem
+from setudownloader.database import KnownIdIndex, upsert_sql
 from setudownloader.middlewares import BaseDownloaderMiddleware
 from urllib.parse import urlencode, urlparse
 from scrapy.statscollectors import MemoryStatsCollector
@@ -26,6 +28,26 @@ class TwitterItem(scrapy.Item):
 
     file_urls = scrapy.Field()  # 下载链接
     media_type = scrapy.Field()
+    config_name = scrapy.Field()  # config里的用户名，改名后文件还放在原来的目录
+    pages = scrapy.Field()  # 需要下载的页，None为全部
+    files = scrapy.Field()  # 每个文件的下载状态
+
+
+# user 表的翻页进度
+# newest_id: 上次完整翻完时最新的推文ID，翻到比它旧的推文就停
+# bottom_cursor, walk_newest_id: 没翻完的那次从哪个 cursor 接着翻，以及那次翻页开始时最新的推文ID
+USER_WALK_COLUMNS = {
+    "newest_id": "INT",
+    "bottom_cursor": "TEXT",
+    "walk_newest_id": "INT",
+}
+# 用户信息缓存，resolved_at 超过 STD_TWITTER_USER_TTL 小时后按ID批量刷新
+# config_name 是 config 里写的用户名，用户改名后还能找到缓存
+USER_CACHE_COLUMNS = {
+    "media_count": "INT",
+    "resolved_at": "DATETIME",
+    "config_name": "TEXT",
+}
 
 
 class TwitterDownloadMiddleware(BaseDownloaderMiddleware):
@@ -40,10 +62,13 @@ class TwitterDownloadMiddleware(BaseDownloaderMiddleware):
 
 class TwitterDBPipeline(SqlitePipeline):
     db_path = ".database/twitter.db"
+    index_tables = {"tweet": ("tweet", ("id",))}
 
-    def open_spider(self, spider):
-        super().open_spider(spider)
-        self.build()
+    def load_index(self, spider):
+        index = super().load_index(spider)
+        sql = f"SELECT DISTINCT tweet_id FROM media WHERE state NOT IN ('{MEDIA_DONE}', '{MEDIA_404}');"
+        index["incomplete"] = KnownIdIndex.from_query(self.cursor, sql)
+        return index
 
     def build(self):
         # 修改数据库，要同时修改建库语句
@@ -54,6 +79,12 @@ class TwitterDBPipeline(SqlitePipeline):
                 screen_name TEXT NOT NULL,
                 name        TEXT NOT NULL,
                 queried     BOOLEAN DEFAULT FALSE,
+                newest_id       INT,
+                bottom_cursor   TEXT,
+                walk_newest_id  INT,
+                media_count     INT,
+                resolved_at     DATETIME,
+                config_name     TEXT,
                 PRIMARY KEY (id)
             );
 
@@ -75,6 +106,9 @@ class TwitterDBPipeline(SqlitePipeline):
                 suffix      TEXT NOT NULL,
                 is_download BOOLEAN NOT NULL,
                 is_delete   BOOLEAN NOT NULL,
+                state       TEXT NOT NULL DEFAULT 'done',
+                size        INT,
+                checksum    TEXT,
                 PRIMARY KEY (tweet_id, page),
                 FOREIGN KEY(tweet_id) REFERENCES tweet(id) ON DELETE CASCADE ON UPDATE CASCADE
             );
@@ -85,6 +119,14 @@ class TwitterDBPipeline(SqlitePipeline):
         # 更新新字段时，可能会重新爬取大量元数据
         if update_sql:
             self.cursor.executescript(update_sql)
+        self.add_columns("media", MEDIA_STATE_COLUMNS)
+        self.add_columns("user", USER_WALK_COLUMNS)
+        self.add_columns("user", USER_CACHE_COLUMNS)
+        # 以前完整查过的用户，用已入库的最新推文当作翻页的截止点
+        self.cursor.execute("""
+            UPDATE user SET newest_id = (SELECT MAX(id) FROM tweet WHERE tweet.user_id = user.id)
+            WHERE queried AND newest_id IS NULL;
+        """)
 
     def process_item(self, item, spider):
         data = {
@@ -92,7 +134,7 @@ class TwitterDBPipeline(SqlitePipeline):
             "name": item["user_name"],
             "screen_name": item["user_screen_name"]
         }
-        self.insert("user", data)
+        self.upsert("user", data)   # 不能覆盖翻页进度
 
         data = {
             "id": item["tweet_id"],
@@ -102,22 +144,37 @@ class TwitterDBPipeline(SqlitePipeline):
         }
         self.insert("tweet", data)
 
+        states = self.media_states(item, len(item["urls"]))
         for i, url in enumerate(item["urls"]):
+            if i not in states:     # 续传时已经下载完的页不用动
+                continue
+            state = states[i]
             data = {
                 "tweet_id": item["tweet_id"],
                 "page": i,
                 "url": url,
                 "suffix": Path(urlparse(url).path).suffix,
-                "is_download": True,
-                "is_delete": False
+                "is_download": state["state"] in (MEDIA_DONE, MEDIA_404),
+                "is_delete": False,
+                "state": state["state"],
+                "size": state["size"],
+                "checksum": state["checksum"],
             }
             self.insert("media", data)
+        self.index["tweet"].add(item["tweet_id"])
+        spider.item_stored(str(item["user_id"]), item["tweet_id"])
         spider.log(f'[{item["user_screen_name"]}] {item["user_name"]} [{item["tweet_id"]}] database save', NOTICE)
+        if self.is_incomplete(states):
+            self.index["incomplete"].add(item["tweet_id"])
+            raise DropItem("download fail")
+        self.index["incomplete"].discard(item["tweet_id"])
         return item
 
 
 
 class TwitterFilesPipeline(BaseFilesPipeline):
+    urls_field = "file_urls"
+
     def process_item(self, item, spider):
         # item预处理
         if item["media_type"] == "photo":
@@ -136,16 +193,20 @@ class TwitterFilesPipeline(BaseFilesPipeline):
             if media_type:
                 media_ext = mimetypes.guess_extension(media_type)
         user_id = item['user_screen_name']
+        config_name = item.get("config_name") or user_id
+        if config_name.lower() != user_id.lower():  # 改名了
+            user_id = config_name
         tweet_id = item['tweet_id']
         page = item["file_urls"].index(request.url)
-        user_path = self.get_base_path(str(user_id))
+        user_path = self.get_base_path(str(config_name))
         media_path = f"{user_path}/twitter/{user_id}/{tweet_id}_p{page}{media_ext}"
         return media_path
     
     def item_completed(self, results, item, info):
         # 下载完成后，验证下载成功
         super().item_completed(results, item, info)
-        info.spider.log(f'[{item["tweet_id"]}] download success', logging.INFO)
+        if self.is_complete(item):
+            info.spider.log(f'[{item["tweet_id"]}] download success', logging.INFO)
         return item
 
 
@@ -163,11 +224,16 @@ userMediaApiPar = '{{"userId":"{}","count":{},{}"includePromotedContent":false,"
 userInfoApi = 'https://twitter.com/i/api/graphql/Vf8si2dfZ1zmah8ePYPjDQ/UserByScreenNameWithoutResults'
 userInfoApiPar = '{{"screen_name":"{}","withHighlightedLabel":false}}'
 
+usersByIdsApi = 'https://twitter.com/i/api/graphql/itEhGywpgX9b3GJCzOtSrA/UsersByRestIds'
+usersByIdsBatch = 50     # 一次最多查多少个用户
+
 
 class TwitterSpider(BaseSpider):
     name = Path(__file__).stem
     allowed_domains = ["twitter.com"]
     start_urls = ["https://twitter.com"]
+    poll_plan = True
+    author_checks = True
 
     # 自定义setting
     custom_settings = {
@@ -185,30 +251,128 @@ class TwitterSpider(BaseSpider):
         "STD_COOKIES_FILE": "/root/picture/ssdownloader/setudownloader/cookies/twitter.com_cookies.txt",
     }
 
+    def __init__(self, name=None, **kwargs):
+        super().__init__(name, **kwargs)
+        self._walks = {}    # 用户ID: 这次翻页的进度
+        self._resumed = set()
+
     def start_requests(self):
-        self.unames = unames = list(self.config)
+        unames = list(self.config)
         if getattr(self, "sp_user", None):
-            self.unames = unames = [self.sp_user]
-        for uname in self.unames:
-            params = {'variables': userInfoApiPar.format(uname)}
-            yield scrapy.FormRequest(url=userInfoApi, formdata=params, callback=self.user_parse, cb_kwargs={"user_screen_name":uname}, priority=4)
+            unames = [self.sp_user]
+        self.unames = []    # 实际检查的用户，author_requests 里加
+        yield from self.start_authors(unames)
+
+    def author_requests(self, unames):
+        # 缓存没过期的用户直接翻媒体页，过期的按ID批量刷新，没缓存的按用户名查
+        ttl = timedelta(hours=self.settings.getfloat("STD_TWITTER_USER_TTL"))
+        now = datetime.now(timezone.utc)
+        stale = []
+        for uname in unames:
+            if uname not in self.unames:    # 常驻模式下新加的用户
+                self.unames.append(uname)
+            cached = self._cached_user(uname)
+            if cached is None:
+                yield self._user_request(uname)
+            elif cached.pop("resolved_at") > now - ttl:
+                self.log(f"[{cached['user_screen_name']}] {cached['user_name']} 作品数量为：{cached['media_count']}（缓存）", NOTICE)
+                yield from self._start_user(cached)
+            else:
+                stale.append(cached)
+        for i in range(0, len(stale), usersByIdsBatch):
+            yield self._users_request(stale[i:i + usersByIdsBatch])
+
+    def _cached_user(self, uname):
+        sql = """
+            SELECT id, screen_name, name, media_count, resolved_at FROM user
+            WHERE (config_name = ? OR screen_name = ?) AND resolved_at IS NOT NULL ORDER BY config_name = ? DESC LIMIT 1;
+        """
+        row = self.cursor.execute(sql, (uname, uname, uname)).fetchone()
+        if row is None:
+            return None
+        user_id, screen_name, name, media_count, resolved_at = row
+        return {
+            "user_id": str(user_id),
+            "user_screen_name": screen_name,
+            "media_count": media_count,
+            "user_name": name,
+            "config_name": uname,
+            "resolved_at": datetime.fromisoformat(resolved_at),
+        }
+
+    def _user_request(self, uname):
+        params = {'variables': userInfoApiPar.format(uname)}
+        return scrapy.FormRequest(url=userInfoApi, formdata=params, callback=self.user_parse, dont_filter=True, cb_kwargs={"user_screen_name":uname}, priority=4)
+
+    def _users_request(self, cached):
+        params = {
+            'variables': json.dumps({"userIds": [c["user_id"] for c in cached], "withSafetyModeUserFields": True}),
+            'features': userMediaApiParCommon
+        }
+        url = usersByIdsApi + "?" + urlencode(params)
+        return scrapy.Request(url=url, callback=self.users_parse, errback=self.users_failed, dont_filter=True, priority=4, cb_kwargs={"cached": cached})
+
+    def _user_cb(self, user_data, config_name):
+        return {
+            "user_id" : user_data["rest_id"],
+            "user_screen_name" : user_data["legacy"]["screen_name"],
+            "media_count" : user_data["legacy"]["media_count"],
+            "user_name" : user_data["legacy"]["name"],
+            "config_name": config_name,
+        }
 
     def user_parse(self, response, **cb_kwargs):
         result = json.loads(response.text)
         user_data = result["data"]["user"]
         if "legacy" not in user_data:
-            self.unames.remove(cb_kwargs.get('user_screen_name'))
+            if cb_kwargs.get('user_screen_name') in self.unames:
+                self.unames.remove(cb_kwargs.get('user_screen_name'))
             self.log(f"[{cb_kwargs.get('user_screen_name')}] user error", NOTICE_WARN)
             return
-        cb = {
-            "user_id" : user_data["rest_id"],
-            "user_screen_name" : user_data["legacy"]["screen_name"],
-            "media_count" : user_data["legacy"]["media_count"],
-            "user_name" : user_data["legacy"]["name"],
-        }
+        cb = self._user_cb(user_data, cb_kwargs["user_screen_name"])
         self.log(f"[{cb['user_screen_name']}] {cb['user_name']} 作品数量为：{cb['media_count']}", NOTICE)
-        self.skipCount = {}
-        return self.parse(**cb)
+        self._save_user(cb)
+        yield from self._start_user(cb)
+
+    def users_parse(self, response, cached):
+        # 按ID批量刷新用户信息，ID不变用户名变了就是改名了
+        result = json.loads(response.text)
+        users = {}
+        for user in result.get("data", {}).get("users", []):
+            user_data = user.get("result") or {}
+            if "legacy" in user_data:
+                users[user_data["rest_id"]] = user_data
+        for c in cached:
+            user_data = users.get(c["user_id"])
+            if user_data is None:   # 冻结、删号或者ID查不到，再按用户名查一次
+                yield self._user_request(c["config_name"])
+                continue
+            cb = self._user_cb(user_data, c["config_name"])
+            if cb["user_screen_name"].lower() != c["user_screen_name"].lower():
+                self.log(f"[{c['user_screen_name']}] 改名为 {cb['user_screen_name']}，config: {c['config_name']}", NOTICE_WARN)
+            self.log(f"[{cb['user_screen_name']}] {cb['user_name']} 作品数量为：{cb['media_count']}", NOTICE)
+            self._save_user(cb)
+            yield from self._start_user(cb)
+
+    def users_failed(self, failure):
+        cached = failure.request.cb_kwargs["cached"]
+        self.log(f"批量查询用户失败，改为逐个查询: {failure.getErrorMessage()}", logging.WARNING)
+        yield from (self._user_request(c["config_name"]) for c in cached)
+
+    def _save_user(self, cb):
+        data = {
+            "id": int(cb["user_id"]),
+            "screen_name": cb["user_screen_name"],
+            "name": cb["user_name"],
+            "media_count": cb["media_count"],
+            "resolved_at": datetime.now(timezone.utc).isoformat(sep=" "),
+            "config_name": cb["config_name"],
+        }
+        self.writer.execute(upsert_sql("user", tuple(data)), tuple(data.values()))
+
+    def _start_user(self, cb):
+        self._start_walk(cb)
+        yield from self.parse(**cb)
 
     def parse(self, response = None, **kwargs):
         if response:
@@ -218,6 +382,9 @@ class TwitterSpider(BaseSpider):
             except:
                 self.log(f"result error, {kwargs}", logging.WARNING)
                 return
+            if not kwargs.get("cursor"):    # 第一页
+                self.author_checked(kwargs["config_name"])
+                yield from self._resume_items(kwargs)
             cursorValue = None
             itemArray = []
             for instruction in instructions:
@@ -233,11 +400,14 @@ class TwitterSpider(BaseSpider):
                     itemArray.append(itemData)
 
             self.add_total(len(itemArray))
+            tweet_ids = []
+            upload_dates = []
             for itemData in itemArray:
                 if itemData is None:
                     self.add_total(-1)
                     continue
                 tweetItem = TwitterItem()
+                tweetItem["config_name"] = kwargs.get("config_name")
                 if "tweet" in itemData:
                     itemData = itemData["tweet"]
                 tweetItem["tweet_id"] = tweet_id = int(itemData["rest_id"])
@@ -266,60 +436,157 @@ class TwitterSpider(BaseSpider):
                         self.log(f"未知媒体类型: {media_type}\nitem: {tweetItem}", logging.WARNING)
                         continue
 
-                if str(user_screen_name) != kwargs["user_screen_name"] or str(user_id) != kwargs["user_id"]:
+                if str(user_id) != kwargs["user_id"]:
                     self.log(f"数据有误： {tweetItem}", logging.ERROR)
                     continue
+                if user_screen_name != kwargs["user_screen_name"]:
+                    # 缓存没过期的时候用户改了名，按推文里的新名字更新缓存，后面的页也用新名字
+                    self.log(f"[{kwargs['user_screen_name']}] 改名为 {user_screen_name}，config: {kwargs['config_name']}", NOTICE_WARN)
+                    kwargs.update(user_screen_name=user_screen_name, user_name=user_name)
+                    self._save_user(kwargs)
+                # 只有对上了的推文才算翻过，截止点不会越过被丢掉的推文
+                tweet_ids.append(tweet_id)
+                upload_dates.append(tweetItem["upload_date"])
                 
                 if self._check_pid_download(tweet_id):
                     self.add_skip()
                     self.log(f"跳过tid: {tweet_id}", logging.DEBUG)
-                    if self._check_user_queried(user_id):
-                        self.skipCount[kwargs["user_id"]] = self.skipCount.get(kwargs["user_id"], 0) + 1
                     continue
+                if self._check_pid_incomplete(tweet_id):
+                    if tweet_id in self._resumed:   # 开始时已经从数据库续传了
+                        self.add_total(-1)
+                        continue
+                    tweetItem["pages"] = self._missing_pages(tweet_id)
 
+                self.hold_item(kwargs["user_id"], tweet_id)
                 yield tweetItem
 
-            if cursorValue and itemArray and self.skipCount.get(kwargs["user_id"], 0) < 10:
-                cursorPar = '"cursor":"{}",'.format(cursorValue)
-                params = {
-                    'variables': userMediaApiPar.format(kwargs["user_id"], 200, cursorPar),
-                    'features': userMediaApiParCommon
-                }
-                url = userMediaApi + "?" + urlencode(params)
-                yield scrapy.Request(url=url, callback=self.parse, dont_filter=True, priority=2, cb_kwargs=kwargs)
+            nextCursor = self._next_cursor(kwargs, tweet_ids, cursorValue)
+            if nextCursor and itemArray:
+                # 下一页的推文都比这一页最旧的旧，按它排；跳到上次中断的位置是补旧作
+                oldest = min(upload_dates) if upload_dates and nextCursor == cursorValue else None
+                yield self._media_request(kwargs, nextCursor, priority=self.fresh_priority(oldest))
+            else:
+                self._finish_walk(kwargs)
         else:
-            params = {
-                'variables': userMediaApiPar.format(kwargs["user_id"], 200, ""),
-                'features': userMediaApiParCommon
-            }
-            url = userMediaApi + "?" + urlencode(params)
-            yield scrapy.Request(url=url, callback=self.parse, dont_filter=True, priority=3, cb_kwargs=kwargs)
+            yield self._media_request(kwargs, None, priority=3)
+
+    def _media_request(self, kwargs, cursor, priority):
+        cursorPar = '"cursor":"{}",'.format(cursor) if cursor else ""
+        params = {
+            'variables': userMediaApiPar.format(kwargs["user_id"], 200, cursorPar),
+            'features': userMediaApiParCommon
+        }
+        url = userMediaApi + "?" + urlencode(params)
+        return scrapy.Request(url=url, callback=self.parse, dont_filter=True, priority=priority, cb_kwargs=dict(kwargs, cursor=cursor))
+
+    def _start_walk(self, kwargs):
+        # 读取用户的翻页进度
+        sql = "SELECT newest_id, bottom_cursor, walk_newest_id FROM user WHERE id = ?;"
+        newest_id, bottom_cursor, walk_newest_id = self.cursor.execute(sql, (kwargs["user_id"],)).fetchone() or (None, None, None)
+        self._walks[kwargs["user_id"]] = {
+            "mark": None if self.force else newest_id,
+            "cursor": bottom_cursor if walk_newest_id is not None else None,
+            "resume_above": walk_newest_id,
+            "top": None,
+        }
+
+    def _next_cursor(self, kwargs, tweet_ids, cursor):
+        # 推文从新到旧排列，这一页翻过了上次的截止点就不再往下翻
+        # 上次没翻完的，翻到上次开始的位置后直接跳到上次停下的 cursor
+        walk = self._walks[kwargs["user_id"]]
+        if not tweet_ids:
+            return cursor
+        if walk["top"] is None:
+            walk["top"] = max(tweet_ids)
+        oldest = min(tweet_ids)
+        if walk["mark"] is not None and oldest <= walk["mark"]:
+            self.log(f"[{kwargs['user_screen_name']}] 翻到上次的位置 {walk['mark']}", logging.INFO)
+            return None
+        # 记下这一页的 cursor，中断后从这一页重新翻，这一页的推文可能还没下载完
+        save_cursor = kwargs.get("cursor") or cursor
+        if walk["cursor"] and oldest <= walk["resume_above"]:
+            self.log(f"[{kwargs['user_screen_name']}] 跳到上次中断的位置", logging.INFO)
+            cursor = save_cursor = walk["cursor"]
+            walk["cursor"] = None
+        if cursor:
+            self._save_walk(kwargs, bottom_cursor=save_cursor, walk_newest_id=walk["top"])
+        return cursor
+
+    def _finish_walk(self, kwargs):
+        walk = self._walks.pop(kwargs["user_id"], None)
+        if walk is None:
+            return
+        newest_id = max(filter(None, (walk["top"], walk["mark"])), default=None)
+        self._save_walk(kwargs, newest_id=newest_id, bottom_cursor=None, walk_newest_id=None)
+
+    def _save_walk(self, kwargs, **fields):
+        # 翻页进度等这之前交出去的推文都入库了再写，推文在管道里丢了的话进度不会越过它
+        data = {"id": int(kwargs["user_id"]), "screen_name": kwargs["user_screen_name"], "name": kwargs["user_name"], **fields}
+        self.write_when_stored(kwargs["user_id"], upsert_sql("user", tuple(data)), tuple(data.values()))
+
+    def _resume_items(self, kwargs):
+        # 没下载完的推文直接从数据库续传，不用等翻页翻到
+        sql = f"""
+            SELECT tweet.id, tweet.page_count, tweet.upload_date FROM tweet
+            WHERE tweet.user_id = ? AND tweet.id IN (SELECT tweet_id FROM media WHERE state NOT IN ('{MEDIA_DONE}', '{MEDIA_404}'));
+        """
+        if self.force:
+            return
+        for tweet_id, page_count, upload_date in self.cursor.execute(sql, (kwargs["user_id"],)).fetchall():
+            urls = [url for url, in self.cursor.execute("SELECT url FROM media WHERE tweet_id = ? ORDER BY page;", (tweet_id,))]
+            tweetItem = TwitterItem()
+            tweetItem["tweet_id"] = tweet_id
+            tweetItem["config_name"] = kwargs.get("config_name")
+            tweetItem["user_name"] = kwargs["user_name"]
+            tweetItem["user_screen_name"] = kwargs["user_screen_name"]
+            tweetItem["user_id"] = int(kwargs["user_id"])
+            tweetItem["page_count"] = page_count
+            tweetItem["upload_date"] = upload_date
+            tweetItem["urls"] = urls
+            tweetItem["media_type"] = "photo" if urls and "pbs.twimg.com/media/" in urls[0] else "video"
+            tweetItem["pages"] = self._missing_pages(tweet_id)
+            self._resumed.add(tweet_id)
+            self.add_total(1)
+            self.log(f"[{tweet_id}] 续传页: {tweetItem['pages']}", logging.INFO)
+            yield tweetItem
 
     def _check_pid_download(self, pid):
         if self.force:
             return False
-        sql = f"SELECT * FROM tweet WHERE id = {pid}"
-        result = self.cursor.execute(sql).fetchall()
-        if result:
-            if None in result[0]:   # 某个字段为空，重新爬，因为理论上不会有字段为空
-                return False
-        return bool(result)
-
-    def _check_user_queried(self, uid):
-        sql = f"SELECT queried FROM user WHERE id = {uid}"
-        result = self.cursor.execute(sql).fetchall()
-        if result:
-            return bool(result[0][0])
-        return False
+        return pid in self.index["tweet"] and pid not in self.index["incomplete"]
+
+    def _check_pid_incomplete(self, pid):
+        if self.force:
+            return False
+        return pid in self.index["incomplete"]
+
+    def upload_history(self, limit):
+        # config 里写的可能是改名前的用户名，两个名字都对上
+        sql = """
+            SELECT user.config_name, user.screen_name, recent.upload_date FROM (
+                SELECT user_id, upload_date, ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY upload_date DESC) AS n FROM tweet
+            ) AS recent JOIN user ON user.id = recent.user_id WHERE recent.n <= ?;
+        """
+        history = {}
+        for config_name, screen_name, upload_date in self.cursor.execute(sql, (limit,)):
+            for name in {config_name, screen_name} - {None}:
+                history.setdefault(name, []).append(upload_date)
+        return history
+
+    def _missing_pages(self, pid):
+        # 上次没下载成功的页
+        sql = f"SELECT page FROM media WHERE tweet_id = ? AND state NOT IN ('{MEDIA_DONE}', '{MEDIA_404}');"
+        return [page for page, in self.cursor.execute(sql, (pid,))]
 
     def update_user_queried(self):
         connect = sqlite3.connect(self.db_path)
         cursor = connect.cursor()
         for uname in self.unames:
-            sql = f"UPDATE user SET queried = TRUE WHERE screen_name = ?;"
-            cursor.execute(sql, (uname,))
-            connect.commit()
+            sql = f"UPDATE user SET queried = TRUE WHERE screen_name = ? OR config_name = ?;"
+            cursor.execute(sql, (uname, uname))
             self.log(f"{uname} queried=true", NOTICE)
+        connect.commit()
         cursor.close()
         connect.close()
 
@@ -6,7 +6,13 @@ from setudownloader.settings import CONFIG_PATH
 import os
 import json
 import sys
+import argparse
 from scrapy.cmdline import execute
+from scrapy.crawler import CrawlerProcess
+from scrapy.utils.project import get_project_settings
+from setudownloader.define import GetLogFileName
+from setudownloader.handlers import StreamDownloadHandler
+from setudownloader.pipelines import get_progress_manager
 
 CONFIG_PATH_BAK = CONFIG_PATH + ".bak"
 
@@ -26,6 +32,97 @@ def _create_config_copy():
     shutil.copy2(CONFIG_PATH, CONFIG_PATH_BAK)
     os.chmod(CONFIG_PATH_BAK, 0o444)
 
+def _config_spiders(names, config_path):
+    # all: config.json 里配置了作者的爬虫
+    with open(config_path, "r") as _f:
+        keys = {key for entry in json.load(_f) for key in entry}
+    return [name for name in names if name in keys]
+
+
+# scrapy crawl 自己带值的选项，要声明出来，不然值会被当成爬虫名，原样交给单个爬虫的 execute
+SCRAPY_VALUE_OPTIONS = ("-o", "--output", "-O", "--overwrite-output", "-t", "--output-format",
+                        "-L", "--loglevel", "--logfile", "--pidfile")
+
+
+class _Passthrough(argparse.Action):
+    def __call__(self, parser, namespace, values, option_string=None):
+        namespace.passthrough += [option_string, values]
+
+
+def _pairs(parser, values, option):
+    pairs = {}
+    for value in values:
+        key, sep, value = value.partition("=")
+        if not sep:
+            parser.error(f"{option} 的格式是 NAME=VALUE: {key}")
+        pairs[key] = value
+    return pairs
+
+
+def _parse_args(argv):
+    # 爬虫名 [爬虫名...] [-a 参数=值] [-s 设置=值] [--daemon] [--due-only]，-a 的参数每个爬虫都会收到
+    # 其他选项（-L INFO、--nolog、-o x.json 等）只能用在单个爬虫，原样交给 scrapy crawl
+    parser = argparse.ArgumentParser(prog="stdownloader.py")
+    parser.add_argument("names", nargs="+", metavar="spider", help="爬虫名，all 是 config 里配置了作者的所有爬虫")
+    parser.add_argument("-a", dest="spargs", action="append", default=[], metavar="NAME=VALUE", help="爬虫参数")
+    parser.add_argument("-s", dest="settings", action="append", default=[], metavar="NAME=VALUE", help="设置")
+    parser.add_argument("--daemon", action="store_true", help="常驻，到了作者的检查时间再查")
+    parser.add_argument("--due-only", action="store_true", help="只检查到了检查时间的作者")
+    for option in SCRAPY_VALUE_OPTIONS:
+        parser.add_argument(option, action=_Passthrough, help=argparse.SUPPRESS)
+    parser.set_defaults(passthrough=[])
+    args, unknown = parser.parse_known_intermixed_args(argv)
+    kwargs = _pairs(parser, args.spargs, "-a")
+    options = _pairs(parser, args.settings, "-s")
+    if args.daemon:
+        options["STD_DAEMON"] = True
+    if args.due_only:
+        options["STD_DUE_ONLY"] = True
+    passthrough = args.passthrough + unknown
+    if passthrough and (len(args.names) > 1 or args.names == ["all"] or args.daemon):
+        parser.error(f"{' '.join(passthrough)} 只能用在单个爬虫")
+    return args.names, kwargs, options, passthrough
+
+
+def crawl_many(names, kwargs, options):
+    # 几个爬虫在同一个 CrawlerProcess 里一起跑，各自的 custom_settings、管道和数据库不变
+    # 共用 reactor 和进度条，所有爬虫的下载并发加起来不超过 STD_GLOBAL_CONCURRENCY
+    settings = get_project_settings()
+    settings.setdict(options, priority="cmdline")
+    # 日志的 root handler 只有一个，各爬虫自己的 LOG_FILE 会互相覆盖，统一写到一个文件
+    settings.set("LOG_FILE", GetLogFileName("all"), priority="cmdline")
+    process = CrawlerProcess(settings)
+    if names == ["all"]:
+        names = _config_spiders(sorted(process.spider_loader.list()), settings.get("CONFIG_PATH"))
+    # 全局并发的信号量整个进程只有一个，爬虫自己设置的值不一样时下载处理器里会警告
+    StreamDownloadHandler.set_global_limit(settings.getint("STD_GLOBAL_CONCURRENCY"))
+    crawlers = []
+    for name in names:
+        crawler = process.create_crawler(name)
+        process.crawl(crawler, **kwargs)
+        crawlers.append(crawler)
+    process.start()
+    get_progress_manager().stop()
+    # 常驻模式只能 Ctrl+C 退出，结束原因是 shutdown
+    return _summary(crawlers, ("finished", "shutdown") if settings.getbool("STD_DAEMON") else ("finished",))
+
+
+def _summary(crawlers, ok_reasons):
+    print(f"{'spider':<10}{'result':<18}{'items':>8}{'files':>8}{'skip':>8}{'errors':>8}{'saved':>8}{'time':>10}")
+    ok = True
+    for crawler in crawlers:
+        stats = crawler.stats.get_stats()
+        reason = stats.get("finish_reason", "not started")
+        ok = ok and reason in ok_reasons
+        skip = stats.get("file_status_count/uptodate", 0) + stats.get("file_status_count/linked", 0)
+        # log_count/ERROR 是所有爬虫共用 root logger 数出来的，这里只算自己的异常和丢弃的 item
+        errors = stats.get("downloader/exception_count", 0) + stats.get("item_dropped_count", 0)
+        print(f"{crawler.spidercls.name:<10}{reason:<18}{stats.get('item_scraped_count', 0):>8}"
+              f"{stats.get('file_status_count/downloaded', 0):>8}{skip:>8}"
+              f"{errors:>8}{stats.get('plan/requests_saved', 0):>8}{stats.get('elapsed_time_seconds', 0):>9.0f}s")
+    return 0 if ok else 1
+
+
 def main(argv):
     # if os.path.exists(CONFIG_PATH):
     #     # config格式检查
@@ -36,7 +133,13 @@ def main(argv):
  
     # execute(argv=["scrapy", "crawl", "pixiv"])
     # execute(argv=["scrapy", "crawl", "twitter"])
-    execute(argv=["scrapy", "crawl", argv[0]] + argv[1:])
+    names, kwargs, options, passthrough = _parse_args(argv)
+    if len(names) > 1 or names == ["all"] or options.get("STD_DAEMON"):
+        sys.exit(crawl_many(names, kwargs, options))
+    argv = ["scrapy", "crawl", names[0]]
+    argv += [arg for key, value in kwargs.items() for arg in ("-a", f"{key}={value}")]
+    argv += [arg for key, value in options.items() for arg in ("-s", f"{key}={value}")]
+    execute(argv=argv + passthrough)
 
 
 if __name__ == "__main__":